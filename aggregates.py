@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import numpy as np
+
+
+def month_index(month: str) -> int:
+    """Converts a month in the format 'YYYY-MM' to a consecutive integer
+
+    Args:
+        month (str): A month in the format 'YYYY-MM'
+
+    Returns:
+        int: the number of months since year 0
+    """
+    year, m = month.split('-')
+    return int(year) * 12 + int(m) - 1
+
+
+class _Series:
+    """Months, total prefix sums and per-category prefix sums held for one location"""
+
+    def __init__(self, counts: dict[int, dict[str, int]]):
+        self.months = np.array(sorted(counts), dtype=np.int64)
+        self.categories = sorted({c for month in counts.values() for c in month})
+        column = {c: i for i, c in enumerate(self.categories)}
+        table = np.zeros((len(self.months) + 1, len(self.categories)), dtype=np.int64)
+        for row, month in enumerate(self.months, start=1):
+            for category, count in counts[int(month)].items():
+                table[row, column[category]] = count
+        self.category_prefix = np.cumsum(table, axis=0)
+        self.total_prefix = self.category_prefix.sum(axis=1)
+
+    def bounds(self, start: int, end: int) -> tuple[int, int]:
+        return int(np.searchsorted(self.months, start, 'left')), int(np.searchsorted(self.months, end, 'right'))
+
+
+class MonthlyAggregates:
+    """Month-indexed crime counts per location and per (location, category)
+
+    Counts are kept as prefix sums over each location's months, so the total or the category
+    breakdown of any date range is the difference of two rows regardless of how many months
+    the range covers. Prefix sums are rebuilt lazily the first time a location is queried after
+    new months were added.
+
+    With a ``shared`` store every month added is also written there for ``ttl`` seconds, and a
+    month missing from memory is looked up there, so background callback jobs, which each run in
+    a process of their own and end with it, reuse the months loaded by earlier jobs. Locations
+    marked fresh stay so for ``ttl`` seconds across the processes sharing the store.
+
+    Args:
+        shared (diskcache.Cache | None): A store shared between processes
+        ttl (float): Number of seconds months stay in the shared store and locations stay fresh
+        name (str): Prefixes this store's keys in the shared store
+    """
+
+    def __init__(self, shared=None, ttl: float = 3600, name: str = 'aggregates'):
+        self.shared = shared
+        self.ttl = ttl
+        self.name = name
+        self._counts: dict[str, dict[int, dict[str, int]]] = {}
+        self._series: dict[str, _Series] = {}
+        self._fresh: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, location: str, month: str) -> str:
+        return '{}:{}:{}'.format(self.name, location, month)
+
+    def _add_local(self, location: str, month: str, categories: dict[str, int]) -> None:
+        with self._lock:
+            self._counts.setdefault(location, {})[month_index(month)] = dict(categories)
+            self._series.pop(location, None)
+
+    def add(self, location: str, month: str, categories: dict[str, int]) -> None:
+        """Records the crime count per category of a location for one month
+
+        Args:
+            location (str): A city name in the UK
+            month (str): A month in the format 'YYYY-MM'
+            categories (dict[str, int]): Category mapped to its crime count, empty if no crimes were reported
+        """
+        self.add_many({(location, month): categories})
+
+    def add_many(self, months: dict[tuple[str, str], dict[str, int]]) -> None:
+        """Records several months at once, written to the shared store in a single transaction
+
+        Args:
+            months (dict): (location, month) mapped to the crime count per category
+        """
+        for (location, month), categories in months.items():
+            self._add_local(location, month, categories)
+        if self.shared is not None and months:
+            with self.shared.transact():
+                for (location, month), categories in months.items():
+                    self.shared.set(self._key(location, month), dict(categories), expire=self.ttl)
+
+    def has(self, location: str, month: str) -> bool:
+        """Returns whether a month has been recorded for a location, in this process or the shared store"""
+        with self._lock:
+            if month_index(month) in self._counts.get(location, {}):
+                return True
+        if self.shared is None:
+            return False
+        categories = self.shared.get(self._key(location, month))
+        if categories is None:
+            return False
+        self._add_local(location, month, categories)
+        return True
+
+    def fresh(self, location: str) -> bool:
+        """Returns whether a location was marked fresh less than ttl seconds ago"""
+        with self._lock:
+            if self._fresh.get(location, 0) > time.time():
+                return True
+        return self.shared is not None and self.shared.get('{}-fresh:{}'.format(self.name, location)) is not None
+
+    def mark_fresh(self, locations: list[str]) -> None:
+        """Marks locations as fresh for ttl seconds, e.g. once every month of theirs was loaded from a database"""
+        with self._lock:
+            for location in locations:
+                self._fresh[location] = time.time() + self.ttl
+        if self.shared is not None:
+            for location in locations:
+                self.shared.set('{}-fresh:{}'.format(self.name, location), True, expire=self.ttl)
+
+    def _get_series(self, location: str) -> _Series | None:
+        with self._lock:
+            series = self._series.get(location)
+            if series is None and location in self._counts:
+                series = self._series[location] = _Series(self._counts[location])
+            return series
+
+    def totals(self, locations: list[str], start: str, end: str) -> dict[str, int]:
+        """Returns the total crime count of each location between two months, inclusive
+
+        Args:
+            locations (list[str]): A list of city names
+            start (str): The first month in the format 'YYYY-MM'
+            end (str): The last month in the format 'YYYY-MM'
+
+        Returns:
+            dict: location mapped to its total crime count, for every location with recorded months
+        """
+        s, e = month_index(start), month_index(end)
+        r = {}
+        for location in locations:
+            series = self._get_series(location)
+            if series is not None:
+                i, j = series.bounds(s, e)
+                r[location] = int(series.total_prefix[j] - series.total_prefix[i])
+        return r
+
+    def categories(self, location: str, start: str, end: str) -> dict[str, int]:
+        """Returns the crime count per category of a location between two months, inclusive
+
+        Args:
+            location (str): A city name in the UK
+            start (str): The first month in the format 'YYYY-MM'
+            end (str): The last month in the format 'YYYY-MM'
+
+        Returns:
+            dict: category mapped to its crime count, without categories that have no crimes in the range
+        """
+        series = self._get_series(location)
+        if series is None:
+            return {}
+        i, j = series.bounds(month_index(start), month_index(end))
+        counts = series.category_prefix[j] - series.category_prefix[i]
+        return {c: int(n) for c, n in zip(series.categories, counts) if n}
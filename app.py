@@ -2,26 +2,35 @@
 
 from __future__ import annotations
 
-from dash import Dash, DiskcacheManager, CeleryManager, html, dcc, callback, Output, Input, State, ctx
+from dash import Dash, DiskcacheManager, CeleryManager, ClientsideFunction, Patch, html, dcc, Output, Input, State
 from dash.exceptions import PreventUpdate
-import pandas as pd
-import plotly
-import plotly.express as px
-import plotly.graph_objects as go
+import numpy as np
+import diskcache
+import hashlib
 import json
 import os
-from datetime import date
+import time
+from typing import TYPE_CHECKING, Callable
 import dash_bootstrap_components as dbc
-import requests
 import functools
-import mysql.connector
+from flask_caching import Cache
 from dash_extensions import DeferScript
 from dash.dependencies import Component
 from plotly.graph_objects import Figure
-# Initialize the app - incorporate a Dash Bootstrap theme
-external_stylesheets = [dbc.themes.CERULEAN]
-app = Dash(__name__, external_stylesheets=external_stylesheets)
-server = app.server
+from flask import Response, g, request
+from police_api import API_URL, CrimeSummary, FetchCache, client, summarise_crimes
+from metrics import Metrics, SamplingProfiler, cache_samples, request_samples
+from response_cache import NotCached
+import datastore
+from datastore import get_backend
+from aggregates import MonthlyAggregates
+from gazetteer import Gazetteer, load_gazetteer
+from density import GRID_RESOLUTION, cell_centres, merge_cells
+# pandas and plotly.express take most of a cold start, so the functions using them import them
+# when first called. Nothing is read from disk or created until create_app runs, or until the app,
+# server or a cache is first used, see __getattr__ at the end of this module
+if TYPE_CHECKING:
+    import pandas as pd
 
 COLORS = {
     "content-background": "#180373",
@@ -32,12 +41,29 @@ CONTENT_STYLE = {
     "background-color": '#0e0340'
 }
 
-df_g = pd.read_csv("gb_latlon.csv")
+PROGRESS_STYLE = {'width':'100%', 'height':'4px', 'display':'block', 'accent-color':COLORS['general']}
+
+GAZETTEER_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gb_latlon.csv")
+
+
+def get_gazetteer() -> Gazetteer:
+    """Returns the cities of GAZETTEER_CSV, read on the first call only"""
+    return load_gazetteer(GAZETTEER_CSV)
+
+
+# Number of matching cities offered by the location dropdown for each search
+DROPDOWN_PAGE_SIZE = 20
+
+# What the map draws: a marker per city, or a heatmap of the crimes per cell of the density grid
+MAP_LAYERS = ['Cities', 'Crime density']
+
+# Number of per-city results the browser keeps in the 'lru-cache' session store, see assets/lru_cache.js
+CLIENT_CACHE_SIZE = int(os.environ.get('CLIENT_CACHE_SIZE', '500'))
 
 url_bar_and_content_div = html.Div([
     dcc.Location(id='url', refresh=False),
     html.Div(id='page-content'),
-    dcc.Store(id='lru-cache', storage_type='session', data='')
+    dcc.Store(id='lru-cache', storage_type='session', data={'size': CLIENT_CACHE_SIZE, 'order': [], 'entries': {}})
 ], style={"background-color": COLORS['content-background'], "height":"100vh"})
 
 
@@ -61,7 +87,6 @@ def date_range(start_year: int, start_month: int, end_year: int, end_month: int)
             s = start_month
             e = 13
         if y == end_year:
-            s = 1
             e = end_month + 1
         y = str(y)
         for m in range(s, e):
@@ -76,482 +101,721 @@ def date_range(start_year: int, start_month: int, end_year: int, end_month: int)
 
 d = date_range(2020, 1, 2023, 12)
 
-def fetch_data(lat: float, lng: float):
+def fetch_data(lat: float, lng: float, date: str | None = None):
     """Post request including latitude and longitude coordinates sent to Police API, crime data returned as json object
     
     Args:
         lat (float): The latitude of the desired city
         lng (float): The longitude of the desired city
+        date (str | None): The month in the format 'YYYY-MM', or None for the latest month
     
     Returns:
-        list: a json object containing crime data for desired city
+        list: a json object containing crime data for desired city, or "" if the month is not available, or not recorded while offline
     """
     payload = {'lat':lat, 'lng':lng}
-    r = requests.post("https://data.police.uk/api/crimes-street/all-crime", params=payload)
+    if date is not None:
+        payload['date'] = date
+    try:
+        r = client.fetch(API_URL, params=payload)
+    except NotCached:
+        return ""
     if r.status_code == 404:
         return ""
     else:
         res = r.json()
         return res
 
+def fetch_summary(lat: float, lng: float, date: str | None = None) -> CrimeSummary | None:
+    """Post request including latitude and longitude coordinates sent to Police API, the crimes summarised while the response is read
+    
+    Args:
+        lat (float): The latitude of the desired city
+        lng (float): The longitude of the desired city
+        date (str | None): The month in the format 'YYYY-MM', or None for the latest month
+    
+    Returns:
+        CrimeSummary | None: the crime count, the count per category and the crimes per cell of the density grid, or None if the month is not available, or not recorded while offline
+    """
+    payload = {'lat':lat, 'lng':lng}
+    if date is not None:
+        payload['date'] = date
+    try:
+        r = client.fetch(API_URL, params=payload, stream=True)
+    except NotCached:
+        return None
+    with r:
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        r.raw.decode_content = True
+        return summarise_crimes(r.raw, grid=GRID_RESOLUTION)
+
+# Shared by every callback so that update_graph_1 and update_map, which fire on the same inputs,
+# make at most one request per city between them. Background jobs run in processes of their own,
+# so create_app also keeps results in the diskcache they share, under keys renamed whenever
+# CrimeSummary changes so that entries of an earlier layout are not read back
+fetch_cache = FetchCache(lambda lat, lng, month: fetch_summary(lat, lng, month), ttl=3600, maxsize=256, name='summary-cells')
+
+# Latency of the callbacks and of their stages, Police API requests and cache lookups, served on
+# /metrics for every process sharing the background cache once create_app ran. Setting PROFILE_INTERVAL
+# samples the callbacks' stacks every so many seconds, served as folded stacks on /metrics/profile
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '0'))
+metrics = Metrics(profiler=SamplingProfiler(PROFILE_INTERVAL) if PROFILE_INTERVAL else None)
+metrics.describe('dashboard_callback_seconds', 'histogram', 'Duration of each Dash callback, by outcome')
+metrics.describe('dashboard_stage_seconds', 'histogram', 'Duration of each stage of a Dash callback')
+metrics.describe('dashboard_http_request_seconds', 'histogram', 'Duration of each HTTP request, by route, including Dash serialising callback outputs')
+metrics.describe('dashboard_cache_lookups_total', 'counter', 'Cache lookups, by cache and result')
+metrics.describe('police_api_requests_total', 'counter', 'Police API requests, by status or error')
+metrics.describe('police_api_request_seconds', 'histogram', 'Duration of each Police API request')
+metrics.register(lambda: request_samples(client.timings))
+metrics.register(lambda: cache_samples(dict(fetch_cache.stats), 'summary'))
+metrics.register(lambda: cache_samples(dict(client.cache.stats), 'police_responses') if client.cache is not None else {})
+
+
+def start_timer() -> None:
+    g.started = time.perf_counter()
+
+
+def record_request(response: Response) -> Response:
+    if 'started' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe('dashboard_http_request_seconds', time.perf_counter() - g.started, route=route)
+    return response
+
+
+def metrics_endpoint() -> Response:
+    """Serves the metrics in Prometheus' text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def profile_endpoint() -> Response | tuple[str, int]:
+    """Serves the sampled callback stacks in the folded format of flamegraph.pl and speedscope"""
+    if metrics.profiler is None:
+        return 'Profiling is off, set PROFILE_INTERVAL to turn it on', 404
+    return Response(metrics.folded(), mimetype='text/plain')
+
+# Data ingested by db_main.py, selected with CRIME_BACKEND=mysql or CRIME_BACKEND=parquet. The live
+# API is used for anything the backend cannot answer unless CRIME_API_FALLBACK=0
+db = get_backend()
+API_FALLBACK = os.environ.get('CRIME_API_FALLBACK', '1') == '1'
+
+
+# Crime counts per month, filled from the database and the Police API as date ranges are requested.
+# Background jobs end with their process, so create_app also keeps them in the diskcache they share
+AGGREGATE_TTL = 3600
+aggregates = MonthlyAggregates(ttl=AGGREGATE_TTL)
+
+
+def load_months(locations: list[str], coordinates: list[tuple[float, float]], months: list[str], progress: Callable[[int, int], None] | None = None) -> None:
+    """Makes sure the aggregate store holds every month in the range for each location
+    
+    Locations are loaded from the database at most once per AGGREGATE_TTL seconds. Months still
+    missing afterwards are fetched from the Police API, each (city, month) at most once per
+    AGGREGATE_TTL seconds, a month the API has not published being recorded as empty.
+    
+    Args:
+        locations (list[str]): A list of city names
+        coordinates (list[tuple[float, float]]): The latitude and longitude of each city
+        months (list[str]): A list of months in the format 'YYYY-MM'
+        progress (Callable | None): Called with (done, total) as months are fetched from the Police API
+    """
+    stale = [location for location in locations if not aggregates.fresh(location)] if db is not None else []
+    if stale:
+        try:
+            counts = {}
+            for location, month, category, total in db.monthly_categories(stale):
+                counts.setdefault((location, month), {})[category] = total
+            aggregates.add_many(counts)
+            aggregates.mark_fresh(stale)
+        except datastore.BACKEND_ERRORS:
+            if not API_FALLBACK:
+                raise
+    if not API_FALLBACK:
+        return
+    missing = [(location, lat, lng, month) for location, (lat, lng) in zip(locations, coordinates) for month in months if not aggregates.has(location, month)]
+    results = fetch_cache.get_all([(lat, lng, month) for location, lat, lng, month in missing], progress=progress)
+    aggregates.add_many({(location, month): summary.categories if summary is not None else {}
+                         for (location, lat, lng, month), summary in zip(missing, results)})
+
+
+def get_totals(locations: list[str], coordinates: list[tuple[float, float]], months: list[str] | None = None, progress: Callable[[int, int], None] | None = None) -> list[int]:
+    """Total crime counts for each location, read from the database where possible and from the Police API otherwise
+    
+    Args:
+        locations (list[str]): A list of city names
+        coordinates (list[tuple[float, float]]): The latitude and longitude of each city
+        months (list[str] | None): The months to sum over in the format 'YYYY-MM', or None for the latest month
+        progress (Callable | None): Called with (done, total) as requests to the Police API complete
+        
+    Returns:
+        list[int]: the total crime count for each city
+    """
+    if months:
+        load_months(locations, coordinates, months, progress)
+        totals = aggregates.totals(locations, months[0], months[-1])
+        return [totals.get(location, 0) for location in locations]
+    totals = {}
+    if db is not None:
+        try:
+            totals = db.totals(locations)
+        except datastore.BACKEND_ERRORS:
+            if not API_FALLBACK:
+                raise
+    missing = [i for i, location in enumerate(locations) if location not in totals]
+    if API_FALLBACK and missing:
+        results = fetch_cache.get_many([coordinates[i] for i in missing], progress=progress)
+        for i, summary in zip(missing, results):
+            totals[locations[i]] = len(summary) if summary is not None else 0
+    return [totals.get(location, 0) for location in locations]
+
+
+def get_category_counts(location: str, lat: float, lng: float, months: list[str] | None = None) -> pd.Series:
+    """Crime count per category for a location, read from the database where possible and from the Police API otherwise
+    
+    Args:
+        location (str): A city name in the UK
+        lat (float): The latitude of the city
+        lng (float): The longitude of the city
+        months (list[str] | None): The months to sum over in the format 'YYYY-MM', or None for the latest month
+        
+    Returns:
+        pd.Series: crime counts indexed by category, largest first
+    """
+    import pandas as pd
+    if months:
+        load_months([location], [(lat, lng)], months)
+        counts = aggregates.categories(location, months[0], months[-1])
+        return pd.Series(counts, dtype=int).sort_values(ascending=False, kind='stable')
+    counts = {}
+    if db is not None:
+        try:
+            counts = db.categories(location)
+        except datastore.BACKEND_ERRORS:
+            if not API_FALLBACK:
+                raise
+    if not counts and API_FALLBACK:
+        summary = fetch_cache.get(lat, lng)
+        if summary is not None:
+            counts = summary.categories
+    return pd.Series(counts, dtype=int).sort_values(ascending=False, kind='stable')
+
+
+def get_rates(dropdown_input: list[str], months: list[str] | None = None, progress: Callable[[int, int], None] | None = None,
+              coordinates: bool = True) -> pd.DataFrame:
+    """Total and fractional counts, optionally with latitude and longitude coordinates, computed for every city in dropdown_input at once
     
+    The fractional count is the total per 100 inhabitants, rounded to 3 decimal places.
+    
+    Args:
+        dropdown_input (list[str]): A list of city names
+        months (list[str] | None): The months to sum over in the format 'YYYY-MM', or None for the latest month
+        progress (Callable | None): Called with (done, total) as requests to the Police API complete
+        coordinates (bool): Whether to include the lat and lng columns
+        
+    Returns:
+        pd.DataFrame: a dataframe with location, total and fractional columns, plus lat and lng if asked for, one row per city
+    """
+    import pandas as pd
+    lat, lng, population = get_gazetteer().lookup_many(dropdown_input)
+    with metrics.stage('fetch'):
+        totals = get_totals(dropdown_input, list(zip(lat.tolist(), lng.tolist())), months, progress)
+    with metrics.stage('aggregate'):
+        totals = np.asarray(totals, dtype=np.int64)
+        d = {'location': list(dropdown_input), 'total': totals, 'fractional': np.round(totals / population * 100, 3)}
+        if coordinates:
+            d['lat'] = lat
+            d['lng'] = lng
+        return pd.DataFrame(d)
+
+
 # Get totals from db
-def get_count_graph(dropdown_input: list[str]) -> pd.DataFrame:
+def get_count_graph(dropdown_input: list[str], months: list[str] | None = None) -> pd.DataFrame:
     """Total and fractional counts for each city in dropdown_input derived and stored in pandas dataframe
     
     Args:
         dropdown_input (list[str]): A list of city names
+        months (list[str] | None): The months to sum over in the format 'YYYY-MM', or None for the latest month
         
     Returns:
         pd.DataFrame: a dataframe containing total and fractional counts for each city
     """
-    l_ = []
-    t_ = []
-    f_ = []
-    la_ = []
-    ln_ = []
-    for location in dropdown_input:
-        df = df_g[df_g['city'] == location]
-        lat = float(df.lat)
-        lng = float(df.lng)
-        p = int(df.population)
-        data = fetch_data(lat, lng)
-        t = len(data)
-        f = t/p
-        l_.append(location)
-        t_.append(t)
-        f_.append(float(str(f*100)[:5]))
-    d = {'location': l_, 'total': t_, 'fractional': f_}
-    df = pd.DataFrame(d)
-    return df
+    return get_rates(dropdown_input, months, coordinates=False)
     
 
 
 # Get statistics from db
-def get_category(location: str) -> pd.DataFrame:
+def get_category(location: str, months: list[str] | None = None) -> pd.DataFrame:
     """Total and fractional counts for each category in 'location' derived and stored in pandas dataframe
     
+    Ratios are percentages of the location's crimes, rounded to 1 decimal place.
+    
     Args:
         location (str): A city name in the UK
+        months (list[str] | None): The months to sum over in the format 'YYYY-MM', or None for the latest month
         
     Returns:
         pd.DataFrame: a dataframe containing total and fractional counts for each city
     """
-    df = df_g[df_g['city'] == location]
-    lat = float(df.lat)
-    lng = float(df.lng)
-    p = int(df.population)
-    data = fetch_data(lat, lng)
-    t = len(data)
-    c = []
-    cc = []
-    if t != 0:
-        df = pd.DataFrame(data)
-        df = df['category'].value_counts()
-        l = list(df)
-        for x in df.index:
-            c.append(' '.join(x.split('-')).capitalize())
-        for x in l:
-            cc.append(float(str((x/sum(l))*100)[:3]))
-    d = {'category':c,'ratio':cc}
-    df = pd.DataFrame(d)
-    return df
+    import pandas as pd
+    lat, lng, p = get_gazetteer().lookup(location)
+    with metrics.stage('fetch'):
+        counts = get_category_counts(location, lat, lng, months)
+    with metrics.stage('aggregate'):
+        if len(counts) == 0:
+            return pd.DataFrame({'category': pd.Series(dtype=object), 'ratio': pd.Series(dtype=float)})
+        values = counts.to_numpy()
+        return pd.DataFrame({
+            'category': [category.replace('-', ' ').capitalize() for category in counts.index],
+            'ratio': np.round(values / values.sum() * 100, 1),
+        })
 
 
     
 # Get statistics from db
-def get_count_map(dropdown_input: list[str]) -> pd.DataFrame:
+def get_count_map(dropdown_input: list[str], months: list[str] | None = None, progress: Callable[[int, int], None] | None = None) -> pd.DataFrame:
     """Total and fractional counts, including latitude and longitude coordinates, for each city in dropdown_input derived and stored in pandas dataframe
     
     Args:
         dropdown_input (list[str]): A list of city names
+        months (list[str] | None): The months to sum over in the format 'YYYY-MM', or None for the latest month
+        progress (Callable | None): Called with (done, total) as requests to the Police API complete
         
     Returns:
         pd.DataFrame: a dataframe containing total and fractional counts, including latitude and longitude coordinates, for each city
     """
-    l_ = []
-    t_ = []
-    f_ = []
-    la_ = []
-    ln_ = []
-    for location in dropdown_input:
-        df = df_g[df_g['city'] == location]
-        lat = float(df.lat)
-        lng = float(df.lng)
-        p = int(df.population)
-        data = fetch_data(lat, lng)
-        t = len(data)
-        f = t/p
-        l_.append(location)
-        t_.append(t)
-        f_.append(float(str(f*100)[:5]))
-        la_.append(lat)
-        ln_.append(lng)
-    d = {'location':l_, 'total':t_, 'fractional':f_, 'lat':la_, 'lng':ln_}
-    df = pd.DataFrame(d)
-    return df
-
-dashboard_layout = html.Div(
-    children=[
-        DeferScript(src="assets/tutorial.js"),
-        html.Div(style={'color':COLORS['general'], 'font-weight':'100', 'background-color':'black', 'height':'100vh', 'width':'100vw'}, id='mist-id'),
-        html.Div([
-            html.H6('Welcome!'),
-            html.P('Follow this brief tutorial to get started.'),
-            html.Button('next', id='tutorial-1-btn-forward')
-            ],
-            id='tutorial-1',
-            className='visible'
-        ),
-        html.Div([
-            html.H6('Header'),
-            html.P('Hover over the headers for more information'),
-            html.Button('.', id='tutorial-2-btn-back'),
-            html.Button('.', id='tutorial-2-btn-forward')
-            ],
-            id='tutorial-2',
-            className='hidden',
-        ),
-        html.Div([
-            html.H6('Locations'),
-            html.P('Choose locations from a list of 10 cities'),
-            html.Button('.', id='tutorial-3-btn-back'),
-            html.Button('.', id='tutorial-3-btn-forward')
-            ],
-            id='tutorial-3',
-            className='hidden',
-        ),
-        html.Div([
-            html.H6('Config'),
-            html.P('Adjust date periods and the statistical metric displayed'),
-            html.Button('.', id='tutorial-4-btn-back'),
-            html.Button('.', id='tutorial-4-btn-forward')
-            ],
-            id='tutorial-4',
-            className='hidden',
-        ),
-        html.Div([
-            html.H6('Location graph'),
-            html.P('This graph shows the statistical metric per location'),
-            html.Button('.', id='tutorial-5-btn-back'),
-            html.Button('.', id='tutorial-5-btn-forward')
-            ],
-            id='tutorial-5',
-            className='hidden',
-        ),
-        html.Div([
-            html.H6('Category graph'),
-            html.P('This graph shows the statistical metric per category'),
-            html.Button('.', id='tutorial-6-btn-back'),
-            html.Button('.', id='tutorial-6-btn-forward')
-            ],
-            id='tutorial-6',
-            className='hidden',
-        ),
-        html.Div([
-            html.H6('Map'),
-            html.P('This map illustrates the crime intensity in cities visually'),
-            html.Button('.', id='tutorial-7-btn-back'),
-            html.Button('.', id='tutorial-7-btn-forward')
-            ],
-            id='tutorial-7',
-            className='hidden',
-        ),
-        html.Div([
-            html.H6('End of tutorial'),
-            html.P('Thank you for following the tutorial!'),
-            html.Button('.', id='tutorial-8-btn-back'),
-            html.Button('.', id='tutorial-8-btn-forward')
-            ],
-            id='tutorial-8',
-            className='hidden',
-        ),
+    return get_rates(dropdown_input, months, progress)
+
+
+def get_density(dropdown_input: list[str], months: list[str] | None = None, progress: Callable[[int, int], None] | None = None) -> pd.DataFrame:
+    """Crime counts per cell of the density grid around every city in dropdown_input
+    
+    Each response is binned as it is read, so only the occupied cells are kept per (city, month)
+    and the rows returned are bounded by the area covered rather than by the number of crimes.
+    The database holds no coordinates, so the cells always come from the Police API.
+    
+    Args:
+        dropdown_input (list[str]): A list of city names
+        months (list[str] | None): The months to sum over in the format 'YYYY-MM', or None for the latest month
+        progress (Callable | None): Called with (done, total) as requests to the Police API complete
         
+    Returns:
+        pd.DataFrame: a dataframe with the lat and lng of the centre of each occupied cell and its crimes
+    """
+    import pandas as pd
+    lat, lng, _ = get_gazetteer().lookup_many(dropdown_input)
+    with metrics.stage('fetch'):
+        summaries = []
+        if API_FALLBACK:
+            keys = [(y, x, month) for y, x in zip(lat.tolist(), lng.tolist()) for month in (months or [None])]
+            summaries = fetch_cache.get_all(keys, progress=progress)
+    with metrics.stage('aggregate'):
+        keys, counts = merge_cells([summary.cells for summary in summaries if summary is not None])
+        centre_lat, centre_lng = cell_centres(keys, GRID_RESOLUTION)
+        return pd.DataFrame({'lat': np.round(centre_lat, 5), 'lng': np.round(centre_lng, 5), 'crimes': counts})
 
-        html.Div(
-            children=[
-                html.Div(
-                    children=[
-                        html.Div(
-                            children=[
-                                html.A(
-                                    children=[
-                                        html.Img(src='assets/github.png', id='github-logo', height=70, style={'display':'inline', 'float':'right', 'padding-bottom':'16px'})
-                                    ],
-                                    href='https://github.com/narobinson1',
-                                    target='_blank'
-                                ),
-                                html.Div(
-                                    children=[
-                                        html.H1('UK Crime rates', id='app-heading', style={'margin-right': '0.5rem', 'display':'inline', 'width':'20vw', 'margin-bottom':'10rem', 'font-weight':'300', 'color':COLORS['general']}),
-                                        html.H1('| a statistical dashboard', id='app-sub-heading', style={'font-weight':'10', 'margin-right':'0', 'padding':'0', 'width':'25vw', 'display':'inline', 'color':COLORS['general']}),
-                                        html.Button('GUIDE', id='app-guide-header', className='menu-btn-guide', name='menu', style={'color':COLORS['general'], 'background-color':COLORS['content-background'], 'font-weight':'100', 'font-size':'30px', 'position':'relative', 'left':'28rem'}),
-                                        html.P('''Under the section 'Choose locations' there is an extensive list of locations in the UK to choose from. These locations are used in the Dashboard configuration section, before being represented in the form of figures. The 'Dashboard configuration' section provides the possibility to illustrate either total or fractional crime counts. The fractional crime counts are the total divided by the population of the location the crimes occured, and the total crime counts is the sum of all crimes, regardless of category, which occurred in a specific location. The 'Dashboard configuration' section also provides the ability to control the time period in which the crimes occured.''', style={'color':COLORS['general'], 'font-weight':'100', 'background-color':COLORS['content-background'], 'margin-left':'-32px', 'padding':'20px','margin-top':'36px', 'border':'10px solid #0e0340'}, className='guide-text'),
-                                        
-                                        html.Button('NOTES', id='app-notes-header', className='menu-btn-notes', name='menu', style={'color':COLORS['general'], 'background-color':COLORS['content-background'], 'font-weight':'100', 'font-size':'30px', 'position':'relative', 'left':'30rem'}),
-                                        html.P('''The data functionality of the dashboard is currently unavailable. This version of the dashboard queries data directly from the UK Police Application Programming Interface, and therefore the time needed to process data in real-time would be too significant. Developed on a separate branch from the main git repository, another version of the dashboard has this data functionality available as it queries pre-processed data from a local mysql database instead of performing real-time processing. The upkeep of renting storage space on a cloud service like AWS, Google Cloud or Microsoft Azure is too expensive, so the database version of this dashboard is not accessible remotely.''', style={'color':COLORS['general'], 'font-weight':'100', 'background-color':COLORS['content-background'], 'margin-left':'-32px', 'padding':'20px','margin-top':'36px', 'border':'10px solid #0e0340'}, className='notes-text'),
+@functools.lru_cache(maxsize=None)
+def dashboard_layout() -> Component:
+    """Builds the central dashboard component once, its location dropdown offering the most populous cities
+    
+    Returns:
+        Component: the dashboard
+    """
+    gazetteer = get_gazetteer()
+    return html.Div(
+        children=[
+            DeferScript(src="assets/tutorial.js"),
+            dcc.Store(id='locations-request'),
+            dcc.Store(id='category-request'),
+            html.Div(style={'color':COLORS['general'], 'font-weight':'100', 'background-color':'black', 'height':'100vh', 'width':'100vw'}, id='mist-id'),
+            html.Div([
+                html.H6('Welcome!'),
+                html.P('Follow this brief tutorial to get started.'),
+                html.Button('next', id='tutorial-1-btn-forward')
+                ],
+                id='tutorial-1',
+                className='visible'
+            ),
+            html.Div([
+                html.H6('Header'),
+                html.P('Hover over the headers for more information'),
+                html.Button('.', id='tutorial-2-btn-back'),
+                html.Button('.', id='tutorial-2-btn-forward')
+                ],
+                id='tutorial-2',
+                className='hidden',
+            ),
+            html.Div([
+                html.H6('Locations'),
+                html.P('Search for locations among the cities and towns of the UK'),
+                html.Button('.', id='tutorial-3-btn-back'),
+                html.Button('.', id='tutorial-3-btn-forward')
+                ],
+                id='tutorial-3',
+                className='hidden',
+            ),
+            html.Div([
+                html.H6('Config'),
+                html.P('Adjust date periods and the statistical metric displayed'),
+                html.Button('.', id='tutorial-4-btn-back'),
+                html.Button('.', id='tutorial-4-btn-forward')
+                ],
+                id='tutorial-4',
+                className='hidden',
+            ),
+            html.Div([
+                html.H6('Location graph'),
+                html.P('This graph shows the statistical metric per location'),
+                html.Button('.', id='tutorial-5-btn-back'),
+                html.Button('.', id='tutorial-5-btn-forward')
+                ],
+                id='tutorial-5',
+                className='hidden',
+            ),
+            html.Div([
+                html.H6('Category graph'),
+                html.P('This graph shows the statistical metric per category'),
+                html.Button('.', id='tutorial-6-btn-back'),
+                html.Button('.', id='tutorial-6-btn-forward')
+                ],
+                id='tutorial-6',
+                className='hidden',
+            ),
+            html.Div([
+                html.H6('Map'),
+                html.P('This map illustrates the crime intensity in cities visually'),
+                html.Button('.', id='tutorial-7-btn-back'),
+                html.Button('.', id='tutorial-7-btn-forward')
+                ],
+                id='tutorial-7',
+                className='hidden',
+            ),
+            html.Div([
+                html.H6('End of tutorial'),
+                html.P('Thank you for following the tutorial!'),
+                html.Button('.', id='tutorial-8-btn-back'),
+                html.Button('.', id='tutorial-8-btn-forward')
+                ],
+                id='tutorial-8',
+                className='hidden',
+            ),
+        
+
+            html.Div(
+                children=[
+                    html.Div(
+                        children=[
+                            html.Div(
+                                children=[
+                                    html.A(
+                                        children=[
+                                            html.Img(src='assets/github.png', id='github-logo', height=70, style={'display':'inline', 'float':'right', 'padding-bottom':'16px'})
+                                        ],
+                                        href='https://github.com/narobinson1',
+                                        target='_blank'
+                                    ),
+                                    html.Div(
+                                        children=[
+                                            html.H1('UK Crime rates', id='app-heading', style={'margin-right': '0.5rem', 'display':'inline', 'width':'20vw', 'margin-bottom':'10rem', 'font-weight':'300', 'color':COLORS['general']}),
+                                            html.H1('| a statistical dashboard', id='app-sub-heading', style={'font-weight':'10', 'margin-right':'0', 'padding':'0', 'width':'25vw', 'display':'inline', 'color':COLORS['general']}),
+                                            html.Button('GUIDE', id='app-guide-header', className='menu-btn-guide', name='menu', style={'color':COLORS['general'], 'background-color':COLORS['content-background'], 'font-weight':'100', 'font-size':'30px', 'position':'relative', 'left':'28rem'}),
+                                            html.P('''Under the section 'Choose locations' there is an extensive list of locations in the UK to choose from. These locations are used in the Dashboard configuration section, before being represented in the form of figures. The 'Dashboard configuration' section provides the possibility to illustrate either total or fractional crime counts. The fractional crime counts are the total divided by the population of the location the crimes occured, and the total crime counts is the sum of all crimes, regardless of category, which occurred in a specific location. The 'Dashboard configuration' section also provides the ability to control the time period in which the crimes occured.''', style={'color':COLORS['general'], 'font-weight':'100', 'background-color':COLORS['content-background'], 'margin-left':'-32px', 'padding':'20px','margin-top':'36px', 'border':'10px solid #0e0340'}, className='guide-text'),
                                         
-                                        html.Button('ABOUT', id='app-about-header', className='menu-btn-about', name='menu', style={'color':COLORS['general'], 'background-color':COLORS['content-background'], 'font-weight':'100', 'font-size':'30px', 'position':'relative', 'left':'8rem'}),
-                                        html.P('''This dashboard presents police data offered through the openly-available United Kingdom Government Police Application Programming Interface
-                                        in JSON format. The data is presented as clearly as possible through interactive graphs and a central interactive map. Functionalities available include total and fractional crime count among a list of selected locations, and the ratio of specific crime categories for individual locations. The main value this dashboard offers is the possibility to shed light on the reported intensity and frequency of crimes amongst locations in the UK, through the observation of Police data.''', style={'color':COLORS['general'], 'font-weight':'100', 'background-color':COLORS['content-background'], 'margin-left':'-32px', 'padding':'20px','margin-top':'36px', 'border':'10px solid #0e0340'}, className='about-text'),
-                                    ],
-                                    style={'padding-bottom':'0rem'}
-                                ),
-                            ],
-                        ),
-                    ],
-                    style={"padding":"2rem 2rem 2rem 2rem", "background-color":COLORS['content-background']}
-                ),
-            ],
-            id='header-id',
-            className='header'
-        ),
-        html.Div(
-            children=[
-                html.Div(
-                    children=[
-                        html.Div(
-                            children=[
-                                html.H6("Choose locations"),
-                                dcc.Dropdown(options=[{"label": x, "value": x} for x in ['London', 'Manchester', 'Liverpool', 'Bristol']],
-                                value=['London', 'Manchester', 'Liverpool'],
-                                multi=True,
-                                style={'background-color': COLORS['content-background'], 'font-weight':'100', 'color':COLORS['general']},
-                                id='dropdown-component-final')
-                            ],
-                            style={'padding':'10px 10px 10px 10px', 'color':COLORS['general'], 'margin-bottom':'16px', 'background-color':'#180373', 'border-radius':'10px'},
-                            id='location-dropdown-id',
-                            className='location-dropdown above'
-                        ),
-                        html.Div(
-                            children=[
-                                html.Div(
-                                    children=[
-                                        html.Div(
-                                            children=[
-                                                dcc.Markdown('''
-                                                    ###### Dashboard configuration
-                                                ''')
-                                            ],
-                                            style={'font-weight':'100', 'margin-bottom':'2rem', 'color':COLORS['general']}
-                                        ),
-                                        html.Div(
-                                            children=[
-                                                html.P('Statistical metric', style={'font-weight':'100'}),
-                                                dcc.Dropdown(
-                                                    options=[{"label": x, "value": x} for x in ['Total', 'Fractional']],
-                                                    value='Total',
-                                                    style={'background-color':COLORS['content-background'], 'color':COLORS['general'], 'font-weight':'100'},
-                                                    id='dropdown-stat-type'
-                                                ),
-                                            ],
-                                            style={'margin-bottom':'2rem'}
-                                        ),
-                                        html.Div(
-                                            children=[
-                                                html.P('Date period when crimes occured', style={'font-weight':'100'}),
-                                                
-                                                html.Div(
-                                                    children=[
-                                                        dcc.ConfirmDialog(
-                                                            id='date-selection-error',
-                                                            message='The date functionality is not currently available. Take a look at the "notes" section to discover the reason why.',
-                                                        ),
-                                                        html.Div(
-                                                            children=[
-                                                                dcc.Dropdown(
-                                                                    options=[{"label": str(x), "value": str(x)} for x in range(2000, 2024)],
-                                                                    value='2023',
-                                                                    style={'background-color':COLORS['content-background'], 'color':COLORS['general'], 'width':'7rem', 'margin-top': '0px', 'margin-bottom': '5px', 'font-weight':'100'},
-                                                                    placeholder='Start year',
-                                                                    id='dropdown-start-year'
-                                                                ),
-                                                                dcc.Dropdown(
-                                                                    options=[{"label": str(x), "value": str(x)} for x in range(1, 13)],
-                                                                    value='1',
-                                                                    style={'background-color':COLORS['content-background'], 'color':COLORS['general'], 'width':'7rem', 'font-weight':'100'},
-                                                                    placeholder='Start month',
-                                                                    id='dropdown-start-month'
-                                                                )
-                                                            ],
-                                                            style={'display':'inline-block', 'padding':'0px'}
-                                                        ),
-                                                        html.Div(
-                                                            children=[
-                                                                html.P('UNTIL')
-                                                            ],
-                                                            style={'display':'inline-block', 'position':'relative', 'left':'55px', 'bottom':'38px'}
-                                                        ),
-                                                        html.Div(
-                                                            children=[
-                                                                dcc.Dropdown(
-                                                                    options=[{"label": x, "value": x} for x in range(2000, 2024)],
-                                                                    value='2023',
-                                                                    style={'background-color':COLORS['content-background'], 'color':COLORS['general'], 'width':'7rem', 'margin-top': '0px', 'margin-bottom': '5px', 'font-weight':'100'},
-                                                                    placeholder='End year',
-                                                                    id='dropdown-end-year'
-                                                                ),
-                                                                dcc.Dropdown(
-                                                                    options=[{"label": x, "value": x} for x in range(1, 13)],
-                                                                    value='1',
-                                                                    style={'background-color':COLORS['content-background'], 'color':COLORS['general'], 'width':'7rem', 'font-weight':'100'},
-                                                                    placeholder='End month',
-                                                                    id='dropdown-end-month'
-                                                                )
-                                                            ],
-                                                            style={'display':'inline-block', 'padding':'0px', 'float':'right'}
-                                                        ),
-                                                    ],
-                                                    style={'padding':'0px 0px 0px 0px'}
-                                                ),
-                                                dcc.Markdown(id='date-markdown-1', style={"padding":"0px", 'font-weight': '200', 'font-size': '20px', 'margin-top':'1.6rem'}),
-                                                dcc.Markdown(id='date-markdown-2', style={"padding":"0px", 'font-weight': '200', 'font-size': '20px'})
-            
-                                            ],
-                                            style={'margin-bottom':'-1rem'}
-                                        ),
-                                    ],
-                                    style={'color':COLORS['general'], 'padding':'20px', 'margin-bottom':'16px', 'background-color':'#180373', 'border-radius':'10px'},
-                                    id='dashboard-configuration-id',
-                                    className='dashboard-configuration'
-                                ),
-                                html.Div(
-                                    children=[
-                                        dcc.Markdown('''
-                                            ###### Data provider
-                                            
-                                            The data used for this project was acquired through the uk.gov Police API.
-                                        ''', style={'color':COLORS['general'], 'font-size':'14px'}),
+                                            html.Button('NOTES', id='app-notes-header', className='menu-btn-notes', name='menu', style={'color':COLORS['general'], 'background-color':COLORS['content-background'], 'font-weight':'100', 'font-size':'30px', 'position':'relative', 'left':'30rem'}),
+                                            html.P('''Crime counts are kept per month, so any date period is summed from pre-computed monthly totals instead of being processed again. When the dashboard runs alongside the local mysql database filled by db_main.py, the monthly totals are read from it. Otherwise each month of each location is queried once from the UK Police Application Programming Interface, so the first selection of a long date period takes noticeably longer than later ones. The upkeep of renting storage space on a cloud service like AWS, Google Cloud or Microsoft Azure is too expensive, so the database version of this dashboard is not accessible remotely.''', style={'color':COLORS['general'], 'font-weight':'100', 'background-color':COLORS['content-background'], 'margin-left':'-32px', 'padding':'20px','margin-top':'36px', 'border':'10px solid #0e0340'}, className='notes-text'),
                                         
-                                    ],
-                                    style={'font-weight':'100', 'padding':'20px 20px 1px 20px', 'background-color':'#180373', 'border-radius':'10px'},
-                                    className='data-provider-statement',
-                                    id='data-provider-statement-id'
-                                ),
-                                html.Div(html.Div([html.P('Designed by Nicolas Robinson    Email: nicolas.alexander.robinson@gmail.com   '), html.P('Designed by Nicolas Robinson    Email: nicolas.alexander.robinson@gmail.com    ')], className='marquee'), className='wrapper', id='text-marquee-id')
-                            ],
-                            style={'width': '30%', 'display':'inline-block', 'height':'70.1vh', 'padding':'0px'},
-                            id='left-id'
-                        ),
-                        html.Div(
-                            children=[
-                                html.Div(
+                                            html.Button('ABOUT', id='app-about-header', className='menu-btn-about', name='menu', style={'color':COLORS['general'], 'background-color':COLORS['content-background'], 'font-weight':'100', 'font-size':'30px', 'position':'relative', 'left':'8rem'}),
+                                            html.P('''This dashboard presents police data offered through the openly-available United Kingdom Government Police Application Programming Interface
+                                            in JSON format. The data is presented as clearly as possible through interactive graphs and a central interactive map. Functionalities available include total and fractional crime count among a list of selected locations, and the ratio of specific crime categories for individual locations. The main value this dashboard offers is the possibility to shed light on the reported intensity and frequency of crimes amongst locations in the UK, through the observation of Police data.''', style={'color':COLORS['general'], 'font-weight':'100', 'background-color':COLORS['content-background'], 'margin-left':'-32px', 'padding':'20px','margin-top':'36px', 'border':'10px solid #0e0340'}, className='about-text'),
+                                        ],
+                                        style={'padding-bottom':'0rem'}
+                                    ),
+                                ],
+                            ),
+                        ],
+                        style={"padding":"2rem 2rem 2rem 2rem", "background-color":COLORS['content-background']}
+                    ),
+                ],
+                id='header-id',
+                className='header'
+            ),
+            html.Div(
+                children=[
+                    html.Div(
+                        children=[
+                            html.Div(
+                                children=[
+                                    html.H6("Choose locations"),
+                                    dcc.Dropdown(options=[{"label": x, "value": x} for x in gazetteer.names[:DROPDOWN_PAGE_SIZE]],
+                                    value=gazetteer.names[:10],
+                                    placeholder='Type to search for a location',
+                                    multi=True,
+                                    style={'background-color': COLORS['content-background'], 'font-weight':'100', 'color':COLORS['general']},
+                                    id='dropdown-component-final')
+                                ],
+                                style={'padding':'10px 10px 10px 10px', 'color':COLORS['general'], 'margin-bottom':'16px', 'background-color':'#180373', 'border-radius':'10px'},
+                                id='location-dropdown-id',
+                                className='location-dropdown above'
+                            ),
+                            html.Div(
+                                children=[
+                                    html.Div(
                                         children=[
                                             html.Div(
                                                 children=[
-                                                    dcc.Loading(
-                                                        children=[
-                                                            dcc.Graph(
-                                                                figure={
-                                                                    'layout':{
-                                                                        'height': 272
-                                                                    }
-                                                                },
-                                                                config={'displayModeBar':False, 'autosizable':True},
-                                                                id="output-map-1")
-                                                        ],
-                                                        id="map-loading-1",
-                                                        type='circle',
-                                                        color=COLORS['general']
-                                                    )
+                                                    dcc.Markdown('''
+                                                        ###### Dashboard configuration
+                                                    ''')
                                                 ],
-                                                style={'background-color':'#180373'},
-                                                id='map-id',
-                                                className='map'
+                                                style={'font-weight':'100', 'margin-bottom':'2rem', 'color':COLORS['general']}
                                             ),
-                                    html.Div(
-                                        children=[
                                             html.Div(
                                                 children=[
-                                                    html.Div(
-                                                        children=[
-                                                            html.Div(
-                                                                children=[
-                                                                    dcc.Loading(
-                                                                        children=[
-                                                                            dcc.Graph(
-                                                                                figure={
-                                                                                    'layout':{
-                                                                                        'height': 274,
-                                                                                        'autosize': False,
-                                                                                        'width': 440
-                                                                                    }
-                                                                                },
-                                                                                config={'displayModeBar':False, 'editSelection':False, 'editable':False, 'showAxisDragHandles':False, 'showAxisRangeEntryBoxes':False, 'responsive':False, 'autosizable':False, 'fillFrame':False, 'scrollZoom':False},
-                                                                                id="output-graph-1"
-                                                                            )
-                                                                        ],
-                                                                        id="graph-loading-1",
-                                                                        style={'position':'relative', 'left':'120px'},
-                                                                        color=COLORS['general'],
-                                                                        type='circle',
-                                                                    )
-                                                                ],
-                                                            )
-                                                        ],
-                                                        style={"width":"50%", 'padding':'0px 0px 0px 0px'}
+                                                    html.P('Statistical metric', style={'font-weight':'100'}),
+                                                    dcc.Dropdown(
+                                                        options=[{"label": x, "value": x} for x in ['Total', 'Fractional']],
+                                                        value='Total',
+                                                        style={'background-color':COLORS['content-background'], 'color':COLORS['general'], 'font-weight':'100'},
+                                                        id='dropdown-stat-type'
+                                                    ),
+                                                ],
+                                                style={'margin-bottom':'2rem'}
+                                            ),
+                                            html.Div(
+                                                children=[
+                                                    html.P('Map layer', style={'font-weight':'100'}),
+                                                    dcc.Dropdown(
+                                                        options=[{"label": x, "value": x} for x in MAP_LAYERS],
+                                                        value='Cities',
+                                                        clearable=False,
+                                                        style={'background-color':COLORS['content-background'], 'color':COLORS['general'], 'font-weight':'100'},
+                                                        id='dropdown-map-layer'
                                                     ),
                                                 ],
-                                                style={'margin-top':'1rem', 'padding':'0px 10px 0px 0px', 'position':'relative', 'display':'inline-block', 'background-color':'#180373'},
-                                                id='location-graph-id',
-                                                className='location-graph'
+                                                style={'margin-bottom':'2rem'}
                                             ),
                                             html.Div(
                                                 children=[
+                                                    html.P('Date period when crimes occured', style={'font-weight':'100'}),
+                                                
                                                     html.Div(
                                                         children=[
+                                                            dcc.ConfirmDialog(
+                                                                id='date-selection-error',
+                                                                message='The start of the date period must not be after its end.',
+                                                            ),
                                                             html.Div(
                                                                 children=[
-                                                                    dcc.Loading(
-                                                                        children=[
-                                                                            dcc.Graph(
-                                                                                figure={
-                                                                                    'layout':{
-                                                                                        'height': 274,
-                                                                                        'autosize': False,
-                                                                                        'width': 450
-                                                                                    }
-                                                                                },
-                                                                                config={'displayModeBar':False, 'scrollZoom':False},
-                                                                                id="output-graph-2"
-                                                                            )
-                                                                        ],
-                                                                        id="graph-loading-2",
-                                                                        style={'position':'relative', 'left':'120px'},
-                                                                        type='circle',
-                                                                        color=COLORS['general']
+                                                                    dcc.Dropdown(
+                                                                        options=[{"label": str(x), "value": str(x)} for x in range(2000, 2024)],
+                                                                        value='2023',
+                                                                        style={'background-color':COLORS['content-background'], 'color':COLORS['general'], 'width':'7rem', 'margin-top': '0px', 'margin-bottom': '5px', 'font-weight':'100'},
+                                                                        placeholder='Start year',
+                                                                        id='dropdown-start-year'
                                                                     ),
-                                                                    dcc.Store(id='graph-2-location-store', data='London')
+                                                                    dcc.Dropdown(
+                                                                        options=[{"label": str(x), "value": str(x)} for x in range(1, 13)],
+                                                                        value='1',
+                                                                        style={'background-color':COLORS['content-background'], 'color':COLORS['general'], 'width':'7rem', 'font-weight':'100'},
+                                                                        placeholder='Start month',
+                                                                        id='dropdown-start-month'
+                                                                    )
+                                                                ],
+                                                                style={'display':'inline-block', 'padding':'0px'}
+                                                            ),
+                                                            html.Div(
+                                                                children=[
+                                                                    html.P('UNTIL')
                                                                 ],
+                                                                style={'display':'inline-block', 'position':'relative', 'left':'55px', 'bottom':'38px'}
+                                                            ),
+                                                            html.Div(
+                                                                children=[
+                                                                    dcc.Dropdown(
+                                                                        options=[{"label": x, "value": x} for x in range(2000, 2024)],
+                                                                        value='2023',
+                                                                        style={'background-color':COLORS['content-background'], 'color':COLORS['general'], 'width':'7rem', 'margin-top': '0px', 'margin-bottom': '5px', 'font-weight':'100'},
+                                                                        placeholder='End year',
+                                                                        id='dropdown-end-year'
+                                                                    ),
+                                                                    dcc.Dropdown(
+                                                                        options=[{"label": x, "value": x} for x in range(1, 13)],
+                                                                        value='1',
+                                                                        style={'background-color':COLORS['content-background'], 'color':COLORS['general'], 'width':'7rem', 'font-weight':'100'},
+                                                                        placeholder='End month',
+                                                                        id='dropdown-end-month'
+                                                                    )
+                                                                ],
+                                                                style={'display':'inline-block', 'padding':'0px', 'float':'right'}
                                                             ),
                                                         ],
-                                                        style={"width":"50%", 'padding':'0px 0px 0px 10px'}
+                                                        style={'padding':'0px 0px 0px 0px'}
                                                     ),
+                                                    dcc.Markdown(id='date-markdown-1', style={"padding":"0px", 'font-weight': '200', 'font-size': '20px', 'margin-top':'1.6rem'}),
+                                                    dcc.Markdown(id='date-markdown-2', style={"padding":"0px", 'font-weight': '200', 'font-size': '20px'})
+            
                                                 ],
-                                                style={'margin-top': '1rem', 'padding':'0px 0px 0px 0px', 'display':'inline-block', 'background-color':'#180373', 'float':'right'},
-                                                id='category-graph-id',
-                                                className='category-graph'
-                                            )
+                                                style={'margin-bottom':'-1rem'}
+                                            ),
                                         ],
+                                        style={'color':COLORS['general'], 'padding':'20px', 'margin-bottom':'16px', 'background-color':'#180373', 'border-radius':'10px'},
+                                        id='dashboard-configuration-id',
+                                        className='dashboard-configuration'
                                     ),
-                                        ]
-                                )
-                            ],
-                            style={'width':'70%', 'display':'inline-block', 'background-color':'#0e0340', 'float':'right', 'padding': '0px 0px 0px 18px', 'height':'68vh'}
-                        ),
-                    ],
-                    style={'padding':'20px'},
-                    id='content-id'
-                ),
-                html.Div([dcc.Store(id='memory-output', storage_type='session', data=pd.read_csv("gb_latlon.csv", dtype=object).to_json(date_format='iso', orient='split'))])
-            ],
-            style=CONTENT_STYLE
-        ),
-    ], style={"fluid":True, "background-color": "#172952"}, id='app-id')
-
-
-
-@callback(
+                                    html.Div(
+                                        children=[
+                                            dcc.Markdown('''
+                                                ###### Data provider
+                                            
+                                                The data used for this project was acquired through the uk.gov Police API.
+                                            ''', style={'color':COLORS['general'], 'font-size':'14px'}),
+                                        
+                                        ],
+                                        style={'font-weight':'100', 'padding':'20px 20px 1px 20px', 'background-color':'#180373', 'border-radius':'10px'},
+                                        className='data-provider-statement',
+                                        id='data-provider-statement-id'
+                                    ),
+                                    html.Div(html.Div([html.P('Designed by Nicolas Robinson    Email: nicolas.alexander.robinson@gmail.com   '), html.P('Designed by Nicolas Robinson    Email: nicolas.alexander.robinson@gmail.com    ')], className='marquee'), className='wrapper', id='text-marquee-id')
+                                ],
+                                style={'width': '30%', 'display':'inline-block', 'height':'70.1vh', 'padding':'0px'},
+                                id='left-id'
+                            ),
+                            html.Div(
+                                children=[
+                                    html.Div(
+                                            children=[
+                                                html.Div(
+                                                    children=[
+                                                        dcc.Loading(
+                                                            children=[
+                                                                dcc.Graph(
+                                                                    figure={
+                                                                        'layout':{
+                                                                            'height': 272
+                                                                        }
+                                                                    },
+                                                                    config={'displayModeBar':False, 'autosizable':True},
+                                                                    id="output-map-1")
+                                                            ],
+                                                            id="map-loading-1",
+                                                            type='circle',
+                                                            color=COLORS['general']
+                                                        ),
+                                                        html.Progress(id='map-progress', value='0', max='1', style={**PROGRESS_STYLE, 'visibility':'hidden'})
+                                                    ],
+                                                    style={'background-color':'#180373'},
+                                                    id='map-id',
+                                                    className='map'
+                                                ),
+                                        html.Div(
+                                            children=[
+                                                html.Div(
+                                                    children=[
+                                                        html.Div(
+                                                            children=[
+                                                                html.Div(
+                                                                    children=[
+                                                                        dcc.Loading(
+                                                                            children=[
+                                                                                dcc.Graph(
+                                                                                    figure={
+                                                                                        'layout':{
+                                                                                            'height': 274,
+                                                                                            'autosize': False,
+                                                                                            'width': 440
+                                                                                        }
+                                                                                    },
+                                                                                    config={'displayModeBar':False, 'editSelection':False, 'editable':False, 'showAxisDragHandles':False, 'showAxisRangeEntryBoxes':False, 'responsive':False, 'autosizable':False, 'fillFrame':False, 'scrollZoom':False},
+                                                                                    id="output-graph-1"
+                                                                                )
+                                                                            ],
+                                                                            id="graph-loading-1",
+                                                                            style={'position':'relative', 'left':'120px'},
+                                                                            color=COLORS['general'],
+                                                                            type='circle',
+                                                                        )
+                                                                    ],
+                                                                )
+                                                            ],
+                                                            style={"width":"50%", 'padding':'0px 0px 0px 0px'}
+                                                        ),
+                                                    ],
+                                                    style={'margin-top':'1rem', 'padding':'0px 10px 0px 0px', 'position':'relative', 'display':'inline-block', 'background-color':'#180373'},
+                                                    id='location-graph-id',
+                                                    className='location-graph'
+                                                ),
+                                                html.Div(
+                                                    children=[
+                                                        html.Div(
+                                                            children=[
+                                                                html.Div(
+                                                                    children=[
+                                                                        dcc.Loading(
+                                                                            children=[
+                                                                                dcc.Graph(
+                                                                                    figure={
+                                                                                        'layout':{
+                                                                                            'height': 274,
+                                                                                            'autosize': False,
+                                                                                            'width': 450
+                                                                                        }
+                                                                                    },
+                                                                                    config={'displayModeBar':False, 'scrollZoom':False},
+                                                                                    id="output-graph-2"
+                                                                                )
+                                                                            ],
+                                                                            id="graph-loading-2",
+                                                                            style={'position':'relative', 'left':'120px'},
+                                                                            type='circle',
+                                                                            color=COLORS['general']
+                                                                        ),
+                                                                        dcc.Store(id='graph-2-location-store', data='London')
+                                                                    ],
+                                                                ),
+                                                            ],
+                                                            style={"width":"50%", 'padding':'0px 0px 0px 10px'}
+                                                        ),
+                                                    ],
+                                                    style={'margin-top': '1rem', 'padding':'0px 0px 0px 0px', 'display':'inline-block', 'background-color':'#180373', 'float':'right'},
+                                                    id='category-graph-id',
+                                                    className='category-graph'
+                                                )
+                                            ],
+                                        ),
+                                            ]
+                                    )
+                                ],
+                                style={'width':'70%', 'display':'inline-block', 'background-color':'#0e0340', 'float':'right', 'padding': '0px 0px 0px 18px', 'height':'68vh'}
+                            ),
+                        ],
+                        style={'padding':'20px'},
+                        id='content-id'
+                    ),
+                ],
+                style=CONTENT_STYLE
+            ),
+        ], style={"fluid":True, "background-color": "#172952"}, id='app-id')
+
+
+# Callbacks are recorded here and registered on every app made by create_app, as the callbacks
+# dash.callback records are only registered on the first app to serve a request
+CALLBACKS: list[tuple[tuple, dict, Callable]] = []
+CLIENTSIDE_CALLBACKS: list[tuple[tuple, dict]] = []
+
+
+def register_callback(*args, **kwargs) -> Callable[[Callable], Callable]:
+    """Records a server callback for create_app, taking the arguments of dash.callback, and returns it unchanged"""
+    def decorator(func: Callable) -> Callable:
+        CALLBACKS.append((args, kwargs, func))
+        return func
+    return decorator
+
+
+def register_clientside_callback(*args, **kwargs) -> None:
+    """Records a clientside callback for create_app, taking the arguments of dash.clientside_callback"""
+    CLIENTSIDE_CALLBACKS.append((args, kwargs))
+
+
+@register_callback(
     Output('page-content', 'children'),
     Input('url', 'pathname'),
 )
@@ -565,24 +829,113 @@ def display_page(pathname: str) -> Component | str:
         Component | str: the central dashboard_layout component or '404'
     """
     if pathname == '/':
-        return dashboard_layout
+        return dashboard_layout()
     else:
         return '404'
 
-@callback(
-    Output('date-selection-error','displayed'),
-    Output('dropdown-start-year', 'value'),
-    Output('dropdown-start-month', 'value'),
-    Output('dropdown-end-year', 'value'),
-    Output('dropdown-end-month', 'value'),
+def figure_key(name: str, locations: list[str], stat: str | None, months: list[str] | None) -> str:
+    """Builds the figure cache key of a callback's normalised inputs
+    
+    Args:
+        name (str): The figure's component id
+        locations (list[str]): The cities shown, in any order
+        stat (str | None): 'total' or 'fractional'
+        months (list[str] | None): The months covered
+        
+    Returns:
+        str: the cache key
+    """
+    period = [months[0], months[-1]] if months else None
+    parts = json.dumps([sorted(set(locations or [])), stat, period])
+    return '{}:{}'.format(name, hashlib.sha256(parts.encode()).hexdigest())
+
+
+def cached_figure(key: str) -> dict | None:
+    """Returns a cached figure as the plotly dictionary Dash serializes for the browser, or None"""
+    with metrics.stage('cache'):
+        hit = figure_cache.get(key)
+        metrics.inc('dashboard_cache_lookups_total', cache='figure', result='miss' if hit is None else 'hit')
+        return hit
+
+
+def cache_figure(key: str, figure: Figure) -> Figure:
+    """Stores a figure's plotly dictionary in the figure cache and returns the figure
+
+    The dictionary keeps its data as numpy arrays, so the cache pickles it without walking every
+    point, and a hit is returned as is: Dash encodes each callback's output itself, so there is
+    no way to hand it JSON that was encoded beforehand.
+    """
+    with metrics.stage('serialize'):
+        figure_cache.set(key, figure.to_plotly_json())
+    return figure
+
+
+def selected_months(start_year: str, start_month: str, end_year: str, end_month: str) -> list[str] | None:
+    """Converts the date dropdown values to the list of months they cover
+    
+    Args:
+        start_year (str): the start year
+        start_month (str): the start month
+        end_year (str): the end year
+        end_month (str): the end month
+        
+    Returns:
+        list[str] | None: a list of strings in the format 'YYYY-MM', None if a date is missing, or an empty list if the start is after the end
+    """
+    if None in (start_year, start_month, end_year, end_month):
+        return None
+    return date_range(int(start_year), int(start_month), int(end_year), int(end_month))
+
+
+def shown_selection(request: dict | None, months: list[str] | None) -> dict | None:
+    """Returns what the displayed figures show if they can be patched to the new selection
+    
+    Args:
+        request (dict | None): The request written by the browser, with a 'shown' entry holding the period, the statistic and the cities of the displayed figures
+        months (list[str] | None): The months now selected
+        
+    Returns:
+        dict | None: the 'shown' entry, or None if the figures must be drawn again
+    """
+    shown = (request or {}).get('shown')
+    if not shown or not months or shown['period'] != [months[0], months[-1]]:
+        return None
+    return shown
+
+
+def selection_change(shown: list[str], selected: list[str]) -> tuple[list[int], list[str]]:
+    """Compares the cities a figure shows with the cities selected
+    
+    Args:
+        shown (list[str]): The cities in the order of the figure's points
+        selected (list[str]): The cities selected
+        
+    Returns:
+        tuple[list[int], list[str]]: the positions of the points to remove, last first, and the cities to add
+    """
+    keep = set(selected)
+    removed = [i for i in range(len(shown) - 1, -1, -1) if shown[i] not in keep]
+    present = set(shown)
+    added = [city for city in selected if city not in present]
+    return removed, added
+
+
+DATE_INPUTS = [
     Input('dropdown-start-year', 'value'),
     Input('dropdown-start-month', 'value'),
     Input('dropdown-end-year', 'value'),
     Input('dropdown-end-month', 'value'),
+]
+
+DATE_STATES = [State(i.component_id, i.component_property) for i in DATE_INPUTS]
+
+@register_callback(
+    Output('date-selection-error','displayed'),
+    *DATE_INPUTS,
     prevent_initial_call=True
 )
-def confirm_dialog(start_year: str, start_month: str, end_year: str, end_month: str) -> tuple[bool, str, str, str, str]:
-    """Alerts user of the unavailability of the date functionality
+def confirm_dialog(start_year: str, start_month: str, end_year: str, end_month: str) -> bool:
+    """Alerts user when the start of the date period is after its end
     
     Args:
         start_year (str): the start year
@@ -591,194 +944,491 @@ def confirm_dialog(start_year: str, start_month: str, end_year: str, end_month:
         end_month (str): the end month
         
     Returns:
-        tuple[Boolean, str, str, str, str]: A tuple containing original dates entered and the Boolean True
+        bool: True if the alert should be displayed
     """
-    return True, start_year, start_month, end_year, end_month
+    return selected_months(start_year, start_month, end_year, end_month) == []
         
-@callback(
-    Output('output-graph-1', 'figure'),
+# The figures are first drawn in the browser from the 'lru-cache' store by the clientside
+# callbacks in assets/lru_cache.js, which only write to these request stores, and so reach the
+# server callbacks below, when a city or location is not cached
+register_clientside_callback(
+    ClientsideFunction(namespace='lru', function_name='routeLocations'),
+    Output('output-graph-1', 'figure', allow_duplicate=True),
+    Output('output-map-1', 'figure', allow_duplicate=True),
+    Output('locations-request', 'data'),
     Input('dropdown-component-final', 'value'),
+    *DATE_INPUTS,
+    Input('dropdown-map-layer', 'value'),
+    State('dropdown-stat-type', 'value'),
+    State('lru-cache', 'data'),
+    State('output-graph-1', 'figure'),
+    State('output-map-1', 'figure'),
+    prevent_initial_call='initial_duplicate'
+)
+
+register_clientside_callback(
+    ClientsideFunction(namespace='lru', function_name='routeCategory'),
+    Output('output-graph-2', 'figure', allow_duplicate=True),
+    Output('graph-2-location-store', 'data', allow_duplicate=True),
+    Output('category-request', 'data'),
+    Input('output-map-1', 'clickData'),
+    *DATE_INPUTS,
+    State('graph-2-location-store', 'data'),
+    State('lru-cache', 'data'),
+    State('output-graph-2', 'figure'),
+    prevent_initial_call='initial_duplicate'
+)
+
+# Both statistics travel in the customdata of graph 1 and the map, so switching between them only
+# swaps the displayed fields in the browser. Figures arriving from the server are switched too
+# when the statistic was changed while they were drawn
+register_clientside_callback(
+    ClientsideFunction(namespace='lru', function_name='toggleStat'),
+    Output('output-graph-1', 'figure', allow_duplicate=True),
+    Output('output-map-1', 'figure', allow_duplicate=True),
     Input('dropdown-stat-type', 'value'),
+    Input('output-graph-1', 'figure'),
+    Input('output-map-1', 'figure'),
+    prevent_initial_call=True
+)
+
+register_clientside_callback(
+    ClientsideFunction(namespace='lru', function_name='remember'),
+    Output('lru-cache', 'data'),
+    Input('output-map-1', 'figure'),
+    Input('output-graph-2', 'figure'),
+    State('lru-cache', 'data'),
+    prevent_initial_call=True
 )
-def update_graph_1(dropdown_input: list[str], stat_type: str) -> Figure:
+
+# A background job still running when its callback fires again is terminated by Dash, so a
+# superseded selection stops using a worker as soon as the dropdown changes. Leaving the page
+# cancels every job
+BACKGROUND = {
+    'background': True,
+    'cancel': [Input('url', 'pathname')],
+}
+
+@register_callback(
+    Output('output-graph-1', 'figure'),
+    State('dropdown-component-final', 'value'),
+    State('dropdown-stat-type', 'value'),
+    *DATE_STATES,
+    Input('locations-request', 'data'),
+    prevent_initial_call=True,
+    **BACKGROUND
+)
+@metrics.callback('update_graph_1')
+def update_graph_1(dropdown_input: list[str], stat_type: str, start_year: str, start_month: str, end_year: str, end_month: str, request: dict | None = None) -> Figure:
     """Creates a Figure object containing location-related data
     
     Args:
         dropdown_input (list[str]): A list of city names
         stat_type (str): Either 'total' or 'fractional' (divided by population count)
+        start_year (str): the start year
+        start_month (str): the start month
+        end_year (str): the end year
+        end_month (str): the end month
+        request (dict | None): The cities missing from the browser's cache and the cities already shown
         
     Returns:
-        Figure: a plotly figure
+        Figure | Patch: a plotly figure, or the changes to the displayed one when only cities were added or removed
     """
+    import plotly.express as px
+    if (request or {}).get('mapOnly'):
+        # The browser drew graph 1 from its cache and only needs the map's density layer
+        raise PreventUpdate
     if stat_type == 'Total':
         stat = 'total'
     if stat_type == 'Fractional':
         stat = 'fractional'
+    months = selected_months(start_year, start_month, end_year, end_month)
+    if months == []:
+        raise PreventUpdate
+    key = figure_key('output-graph-1', dropdown_input, stat, months)
+    figure = cached_figure(key)
+    if figure is not None:
+        return figure
+    shown = shown_selection(request, months)
+    if shown is not None:
+        removed, added = selection_change(shown['bars'], dropdown_input or [])
+        patch = Patch()
+        trace = patch['data'][0]
+        for i in removed:
+            del trace['x'][i]
+            del trace['y'][i]
+            del trace['customdata'][i]
+        if added:
+            df = get_count_graph(added, months)
+            trace['x'].extend(df[shown['stat']].tolist())
+            trace['y'].extend(df['location'].tolist())
+            trace['customdata'].extend(df[['total', 'fractional']].values.tolist())
+        return patch
         
-    df = get_count_graph(dropdown_input)
+    df = get_count_graph(dropdown_input, months)
     df.sort_values(axis=0, by=stat, ascending=True, inplace=True)
 
-    figure = px.bar(
-                df,
-                x=stat,
-                y='location',
-                height=274,
-                width=454,
-                color_discrete_sequence=[COLORS['general']]*len(df),
-                orientation='h')
-    
-    figure.update_traces(hovertemplate=None)
-    figure.layout.hovermode="y"
-    figure.layout.autosize=True
-    figure.layout.plot_bgcolor=COLORS['content-background']
-    figure.layout.paper_bgcolor=COLORS['content-background']
-    figure.layout.font.color=COLORS['general']
-    figure.layout.font.size=10
-    
-    figure.layout.yaxis.ticksuffix="  "
-    figure.layout.yaxis.title=""
-    figure.layout.xaxis.title="Graph 1: Incidents reported ({})".format(stat)
-    figure.layout.xaxis.gridcolor=COLORS['content-background']
-    figure.layout.yaxis.gridcolor=COLORS['content-background']
-    figure.layout.xaxis.tickangle=90
-    
-    figure.update_layout(
-                margin={'b':10,'r':10,'l':10,'t':10})
+    with metrics.stage('figure'):
+        figure = px.bar(
+                    df,
+                    x=stat,
+                    y='location',
+                    custom_data=['total', 'fractional'],
+                    height=274,
+                    width=454,
+                    color_discrete_sequence=[COLORS['general']]*len(df),
+                    orientation='h')
+
+        figure.update_traces(hovertemplate=None)
+        figure.layout.meta={'period': [months[0], months[-1]] if months else None, 'stat': stat}
+        figure.layout.hovermode="y"
+        figure.layout.autosize=True
+        figure.layout.plot_bgcolor=COLORS['content-background']
+        figure.layout.paper_bgcolor=COLORS['content-background']
+        figure.layout.font.color=COLORS['general']
+        figure.layout.font.size=10
+
+        figure.layout.yaxis.ticksuffix="  "
+        figure.layout.yaxis.title=""
+        # Keeps the bars sorted when cities are appended by a Patch
+        figure.layout.yaxis.categoryorder="total ascending"
+        figure.layout.xaxis.title="Graph 1: Incidents reported ({})".format(stat)
+        figure.layout.xaxis.gridcolor=COLORS['content-background']
+        figure.layout.yaxis.gridcolor=COLORS['content-background']
+        figure.layout.xaxis.tickangle=90
+
+        figure.update_layout(
+                    margin={'b':10,'r':10,'l':10,'t':10})
         
-    return figure
+    return cache_figure(key, figure)
     
         
-@callback(
+@register_callback(
     Output('output-graph-2', 'figure'),
-    Input('output-map-1', 'clickData'),
-    State('graph-2-location-store', 'data')
+    Output('graph-2-location-store', 'data'),
+    Input('category-request', 'data'),
+    *DATE_STATES,
+    State('graph-2-location-store', 'data'),
+    prevent_initial_call=True,
+    **BACKGROUND
 )
-def update_category(click_data_map: dict, location: str) -> Figure:
+@metrics.callback('update_category')
+def update_category(request: dict | None, start_year: str, start_month: str, end_year: str, end_month: str, location: str) -> tuple[Figure, str]:
     """Creates a Figure object containing category-related data for a desired location
     
     Args:
-        click_data_map (dict): Contains data related to last click event
-        location (str): A city in the UK
+        request (dict | None): The location, or the clicked map point, missing from the browser's cache
+        start_year (str): the start year
+        start_month (str): the start month
+        end_year (str): the end year
+        end_month (str): the end month
+        location (str): The city shown before
         
     Returns:
-        Figure: a plotly figure
+        tuple[Figure, str]: a plotly figure and the location it shows
     """
-    if ctx.triggered_id == 'output-map-1':
-        location = click_data_map['points'][0]['hovertext']
+    import plotly.express as px
+    request = request or {}
+    if request.get('point'):
+        location = get_gazetteer().nearest(request['point']['lat'], request['point']['lon'])
+    elif request.get('location'):
+        location = request['location']
+    months = selected_months(start_year, start_month, end_year, end_month)
+    if months == []:
+        raise PreventUpdate
+    key = figure_key('output-graph-2', [location], None, months)
+    figure = cached_figure(key)
+    if figure is not None:
+        return figure, location
         
-    df = get_category(location)
+    df = get_category(location, months)
     df.sort_values(axis=0, by='ratio', ascending=False, inplace=True)
     
-    figure = px.bar(
-                df,
-                x='ratio',
-                y='category',
-                height=274,
-                width=454,
-                color_discrete_sequence=[COLORS['general']]*len(df),
-                orientation='h',
-    )
-
-    figure.layout.title='{}'.format(location)
-    figure.layout.title.x=0.98
-    figure.layout.title.y=0.9
-    figure.layout.title.font.size=40
-    figure.update_traces(hovertemplate=None)
-    figure.layout.hovermode="y"
-    figure.layout.yaxis.ticksuffix="  "
-    figure.layout.xaxis.title="Graph 2: Category ratio percentage"
-    figure.layout.yaxis.title=""
-    figure.layout.xaxis.gridcolor=COLORS['content-background']
-    figure.layout.yaxis.gridcolor=COLORS['content-background']
-    
-    figure.update_layout(
-                autosize=True,
-                margin={'b':10,'r':10,'l':10,'t':10},
-                plot_bgcolor=COLORS['content-background'],
-                paper_bgcolor=COLORS['content-background'],
-                font={'color': COLORS['general'], 'size': 10},
-                showlegend=False)
+    with metrics.stage('figure'):
+        figure = px.bar(
+                    df,
+                    x='ratio',
+                    y='category',
+                    height=274,
+                    width=454,
+                    color_discrete_sequence=[COLORS['general']]*len(df),
+                    orientation='h',
+        )
+
+        figure.layout.title='{}'.format(location)
+        figure.layout.meta={'period': [months[0], months[-1]] if months else None, 'location': location}
+        figure.layout.title.x=0.98
+        figure.layout.title.y=0.9
+        figure.layout.title.font.size=40
+        figure.update_traces(hovertemplate=None)
+        figure.layout.hovermode="y"
+        figure.layout.yaxis.ticksuffix="  "
+        figure.layout.xaxis.title="Graph 2: Category ratio percentage"
+        figure.layout.yaxis.title=""
+        figure.layout.xaxis.gridcolor=COLORS['content-background']
+        figure.layout.yaxis.gridcolor=COLORS['content-background']
+
+        figure.update_layout(
+                    autosize=True,
+                    margin={'b':10,'r':10,'l':10,'t':10},
+                    plot_bgcolor=COLORS['content-background'],
+                    paper_bgcolor=COLORS['content-background'],
+                    font={'color': COLORS['general'], 'size': 10},
+                    showlegend=False)
         
-    return figure
+    return cache_figure(key, figure), location
     
     
 
-@callback(
+@register_callback(
     Output('dropdown-component-final', 'options'),
-    Output('dropdown-component-final', 'value'),
-    Input('memory-output', 'data')
+    Input('dropdown-component-final', 'search_value'),
+    State('dropdown-component-final', 'value')
 )
-def update_dropdown(json_data) -> tuple[list[dict], list[str]]:
-    """Updates the dropdown menu with a list of cities
+@metrics.callback('update_dropdown')
+def update_dropdown(search_value: str, value: list[str]) -> list[dict]:
+    """Updates the dropdown menu with the cities matching the text typed into it
     
     Args:
-        json_data: Contains cities with latitude, longitude and total population data
+        search_value (str): The text typed into the dropdown
+        value (list[str]): The cities already selected, which are always kept as options
         
     Returns:
-        tuple(list[dict], list[str]): a list of dictionaries and a list of strings
+        list[dict]: a list of dictionaries
     """
-    df = pd.read_json(json_data, orient="split")
-    dropdown_list = list(df['city'].unique())
-    options = [{"label": x, "value": x} for x in dropdown_list][:10]
-    values = dropdown_list[:10]
-    return options, values
+    if not search_value:
+        raise PreventUpdate
+    value = value or []
+    with metrics.stage('search'):
+        matches = get_gazetteer().search(search_value, limit=DROPDOWN_PAGE_SIZE)
+    return [{"label": x, "value": x} for x in value + [x for x in matches if x not in value]]
 
 
-@callback(
+@register_callback(
     Output('output-map-1', 'figure'),
-    Input('dropdown-component-final', 'value'),
-    Input('dropdown-stat-type', 'value'),
+    State('dropdown-component-final', 'value'),
+    State('dropdown-stat-type', 'value'),
+    *DATE_STATES,
+    Input('locations-request', 'data'),
+    State('dropdown-map-layer', 'value'),
+    progress=[Output('map-progress', 'value'), Output('map-progress', 'max')],
+    running=[(Output('map-progress', 'style'), {**PROGRESS_STYLE, 'visibility':'visible'}, {**PROGRESS_STYLE, 'visibility':'hidden'})],
+    prevent_initial_call=True,
+    **BACKGROUND
 )
-def update_map(dropdown_input: list[str], stat_type: str) -> Figure:
+@metrics.callback('update_map')
+def update_map(set_progress: Callable[[tuple[str, str]], None], dropdown_input: list[str], stat_type: str, start_year: str, start_month: str, end_year: str, end_month: str, request: dict | None = None,
+               layer: str = 'Cities') -> Figure:
     """Creates a Figure object containing location-related data, including latitude and longitude
     
     Args:
+        set_progress (Callable): Reports the number of Police API requests done and due to the progress bar
         dropdown_input (list[str]): A list of city names
+        stat_type (str): Either 'total' or 'fractional' (divided by population count)
+        start_year (str): the start year
+        start_month (str): the start month
+        end_year (str): the end year
+        end_month (str): the end month
+        request (dict | None): The cities missing from the browser's cache and the cities already shown
+        layer (str): 'Cities' for a marker per city, or 'Crime density' for the crimes per cell of the density grid
     
     Returns:
-        Figure: a plotly figure
+        Figure | Patch: a plotly figure, or the changes to the displayed one when only cities were added or removed
     """
-    df = get_count_map(dropdown_input)
-    scale = px.colors.sequential.Blues[2:]
+    import plotly.express as px
+    months = selected_months(start_year, start_month, end_year, end_month)
+    if months == []:
+        raise PreventUpdate
     if stat_type == 'Total':
         stat = 'total'
     if stat_type == 'Fractional':
         stat = 'fractional'
+    if layer == 'Crime density':
+        return density_map(set_progress, dropdown_input, months)
+    key = figure_key('output-map-1', dropdown_input, stat, months)
+    figure = cached_figure(key)
+    if figure is not None:
+        return figure
+    shown = shown_selection(request, months)
+    if shown is not None:
+        # Marker sizes are rescaled by the browser, which knows every point's value
+        removed, added = selection_change(shown['markers'], dropdown_input or [])
+        patch = Patch()
+        trace = patch['data'][0]
+        for i in removed:
+            for field in ('lat', 'lon', 'hovertext', 'customdata'):
+                del trace[field][i]
+            del trace['marker']['color'][i]
+            del trace['marker']['size'][i]
+        if added:
+            df = get_count_map(added, months, lambda done, total: set_progress((str(done), str(total))))
+            trace['lat'].extend(df['lat'].tolist())
+            trace['lon'].extend(df['lng'].tolist())
+            trace['hovertext'].extend(df['location'].tolist())
+            trace['customdata'].extend(df[['total', 'fractional']].values.tolist())
+            trace['marker']['color'].extend(df[shown['stat']].tolist())
+            trace['marker']['size'].extend(df[shown['stat']].tolist())
+        return patch
+    df = get_count_map(dropdown_input, months, lambda done, total: set_progress((str(done), str(total))))
+    with metrics.stage('figure'):
+        scale = px.colors.sequential.Blues[2:]
+
+        figure = px.scatter_mapbox(df,
+                    lat='lat',
+                    lon='lng',
+                    color=stat,
+                    size=stat,
+                    hover_name='location',
+                    custom_data=['total', 'fractional'],
+                    color_continuous_scale=scale,
+                    zoom=5,
+                    height=272
+        )
+
+        # Both statistics are sent with every figure so that the browser can cache them per city
+        figure.update_traces(hovertemplate='<b>%{hovertext}</b><br><br>total=%{customdata[0]}<br>fractional=%{customdata[1]}<extra></extra>')
+        figure.update_layout(
+                    meta={'period': [months[0], months[-1]] if months else None, 'stat': stat},
+                    mapbox_style="carto-positron",
+                    autosize=True,
+                    margin={'b':0,'r':0,'l':0,'t':0},
+                    paper_bgcolor=COLORS['content-background'],
+                    coloraxis_colorbar_showticklabels=False,
+                    coloraxis_colorbar_title="",
+                    coloraxis_colorbar_x=0.92,
+                    coloraxis_colorbar_thickness=50
+        )
         
-    figure = px.scatter_mapbox(df,
-                lat='lat',
-                lon='lng',
-                color=stat,
-                size=stat,
-                hover_name='location',
-                hover_data=stat,
-                color_continuous_scale=scale,
-                zoom=5,
-                height=272
-    )
-    
-    figure.update_layout(
-                mapbox_style="carto-positron",
-                autosize=True,
-                margin={'b':0,'r':0,'l':0,'t':0},
-                paper_bgcolor=COLORS['content-background'],
-                coloraxis_colorbar_showticklabels=False,
-                coloraxis_colorbar_title="",
-                coloraxis_colorbar_x=0.92,
-                coloraxis_colorbar_thickness=50
-    )
-                
-    return figure
+    return cache_figure(key, figure)
+
+
+def density_map(set_progress: Callable[[tuple[str, str]], None], dropdown_input: list[str], months: list[str] | None) -> Figure:
+    """Creates the map's density layer, a heatmap of the crimes per cell around the cities
+    
+    Args:
+        set_progress (Callable): Reports the number of Police API requests done and due to the progress bar
+        dropdown_input (list[str]): A list of city names
+        months (list[str] | None): The months covered
+    
+    Returns:
+        Figure: a plotly figure
+    """
+    import plotly.express as px
+    key = figure_key('output-map-1', dropdown_input, 'density', months)
+    figure = cached_figure(key)
+    if figure is not None:
+        return figure
+    df = get_density(dropdown_input, months, lambda done, total: set_progress((str(done), str(total))))
+    with metrics.stage('figure'):
+        figure = px.density_mapbox(df,
+                    lat='lat',
+                    lon='lng',
+                    z='crimes',
+                    radius=10,
+                    color_continuous_scale=px.colors.sequential.Blues[2:],
+                    zoom=5,
+                    height=272
+        )
+        figure.update_traces(hovertemplate='crimes=%{z}<extra></extra>')
+        figure.update_layout(
+                    meta={'period': [months[0], months[-1]] if months else None, 'layer': 'density'},
+                    mapbox_style="carto-positron",
+                    autosize=True,
+                    margin={'b':0,'r':0,'l':0,'t':0},
+                    paper_bgcolor=COLORS['content-background'],
+                    coloraxis_colorbar_showticklabels=False,
+                    coloraxis_colorbar_title="",
+                    coloraxis_colorbar_x=0.92,
+                    coloraxis_colorbar_thickness=50
+        )
+    return cache_figure(key, figure)
+
+
+def preload() -> None:
+    """Imports the modules the data callbacks use, so that background jobs forked from the server inherit them instead of importing them for every job"""
+    import pandas
+    import plotly.express
+
+
+def create_app(cache_dir: str | None = None) -> Dash:
+    """Creates the Dash app, its caches and its routes, and registers the callbacks on it
+    
+    Data-heavy callbacks run as background jobs so that slow Police API requests do not hold a
+    gunicorn worker. Jobs run in processes forked from the server and managed through a local
+    diskcache, or on Celery workers when CELERY_BROKER_URL is set. Figures are cached for every gunicorn worker in a FileSystemCache
+    by default, or any Flask-Caching backend such as CACHE_TYPE=RedisCache with CACHE_REDIS_URL.
+    
+    The app, its server and caches are also kept as this module's app, server, figure_cache,
+    background_cache, background_callback_manager and celery_app, the first app being made when
+    one of them is first used, e.g. by ``gunicorn app:server``.
+    
+    Args:
+        cache_dir (str | None): The directory to keep the background and figure caches in, by default BACKGROUND_CACHE_DIR and CACHE_DIR in the working directory
+    
+    Returns:
+        Dash: the app
+    """
+    global app, server, figure_cache, background_cache, background_callback_manager, celery_app
+    if cache_dir is not None:
+        background_dir, figure_dir = os.path.join(cache_dir, 'background_cache'), os.path.join(cache_dir, 'figure_cache')
+    else:
+        background_dir, figure_dir = os.environ.get('BACKGROUND_CACHE_DIR', 'background_cache'), os.environ.get('CACHE_DIR', 'figure_cache')
+    background_cache = diskcache.Cache(background_dir)
+    if 'CELERY_BROKER_URL' in os.environ:
+        from celery import Celery
+        celery_app = Celery(__name__, broker=os.environ['CELERY_BROKER_URL'], backend=os.environ['CELERY_BROKER_URL'])
+        background_callback_manager = CeleryManager(celery_app)
+    else:
+        celery_app = None
+        background_callback_manager = DiskcacheManager(background_cache)
+        preload()
+    fetch_cache.shared = background_cache
+    aggregates.shared = background_cache
+    metrics.shared = background_cache
+    if client.limiter is not None:
+        client.limiter.shared = background_cache
+
+    # Initialize the app - incorporate a Dash Bootstrap theme
+    external_stylesheets = [dbc.themes.CERULEAN]
+    app = Dash(__name__, external_stylesheets=external_stylesheets, background_callback_manager=background_callback_manager)
+    server = app.server
+    figure_cache = Cache(server, config={
+        'CACHE_TYPE': os.environ.get('CACHE_TYPE', 'FileSystemCache'),
+        'CACHE_DIR': figure_dir,
+        'CACHE_REDIS_URL': os.environ.get('CACHE_REDIS_URL', ''),
+        'CACHE_DEFAULT_TIMEOUT': int(os.environ.get('FIGURE_CACHE_TTL', '3600')),
+        'CACHE_THRESHOLD': int(os.environ.get('FIGURE_CACHE_SIZE', '500')),
+    })
+
+    server.before_request(start_timer)
+    server.after_request(record_request)
+    server.add_url_rule('/metrics', view_func=metrics_endpoint)
+    server.add_url_rule('/metrics/profile', view_func=profile_endpoint)
+
+    for args, kwargs, func in CALLBACKS:
+        app.callback(*args, **kwargs)(func)
+    for args, kwargs in CLIENTSIDE_CALLBACKS:
+        app.clientside_callback(*args, **kwargs)
+
+    app.layout = url_bar_and_content_div
+    app.validation_layout = html.Div([
+        dashboard_layout(),
+        url_bar_and_content_div,
+    ])
+    return app
+
 
+# Made by create_app on first use
+_APP_ATTRIBUTES = ('app', 'server', 'figure_cache', 'background_cache', 'background_callback_manager', 'celery_app')
 
-app.layout = url_bar_and_content_div
 
-app.validation_layout = html.Div([
-    dashboard_layout,
-    url_bar_and_content_div,
-])
+def __getattr__(name: str):
+    if name in _APP_ATTRIBUTES:
+        create_app()
+        return globals()[name]
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
 
     
 if __name__ == '__main__':
-    app.run_server(host='0.0.0.0', port=8050, debug=True)
+    create_app().run_server(host='0.0.0.0', port=8050, debug=True)
 
@@ -0,0 +1,255 @@
+// Client-side LRU of per-city results, kept in the 'lru-cache' session store.
+//
+// Entries are keyed by city and date period. 'remember' fills the cache from every figure the
+// server sends, and the 'route' functions redraw the figures from it when every city asked for
+// is already cached, so toggles and re-selections never reach the server. Anything missing is
+// written to a request store that triggers the server callbacks instead.
+//
+// Graph 1 and the map carry both statistics in their customdata as [total, fractional], which
+// 'toggleStat' swaps between without the cache. The map's density layer is binned by the server
+// and never cached here.
+
+function period(startYear, startMonth, endYear, endMonth) {
+	if ([startYear, startMonth, endYear, endMonth].some(function (x) { return x === null || x === undefined; })) {
+		return null;
+	}
+	var pad = function (m) { return ('0' + m).slice(-2); };
+	var start = startYear + '-' + pad(startMonth);
+	var end = endYear + '-' + pad(endMonth);
+	if (start > end) {
+		return null;
+	}
+	return start + ':' + end;
+}
+
+function cityKey(city, p) {
+	return 'city|' + city + '|' + p;
+}
+
+function categoryKey(location, p) {
+	return 'category|' + location + '|' + p;
+}
+
+function emptyCache(cache) {
+	return {size: (cache && cache.size) || 500, order: [], entries: {}};
+}
+
+// Returns a copy of the cache with the entries stored as the most recently used, evicting the
+// least recently used entries beyond the cache size
+function touch(cache, items) {
+	cache = cache && cache.entries ? cache : emptyCache(cache);
+	var order = cache.order.slice();
+	var entries = Object.assign({}, cache.entries);
+	items.forEach(function (item) {
+		var i = order.indexOf(item[0]);
+		if (i !== -1) {
+			order.splice(i, 1);
+		}
+		order.push(item[0]);
+		entries[item[0]] = item[1];
+	});
+	while (order.length > cache.size) {
+		delete entries[order.shift()];
+	}
+	return {size: cache.size, order: order, entries: entries};
+}
+
+function hasTrace(figure) {
+	return Boolean(figure && figure.data && figure.data.length);
+}
+
+function isDensity(figure) {
+	return Boolean(figure && figure.layout && figure.layout.meta && figure.layout.meta.layer === 'density');
+}
+
+function copy(figure) {
+	return JSON.parse(JSON.stringify(figure));
+}
+
+var STAT_COLUMN = {total: 0, fractional: 1};
+
+// Fills graph 1 with one bar per row, sorted by the statistic shown
+function setBars(figure, rows, stat) {
+	rows = rows.slice().sort(function (a, b) { return a[stat] - b[stat]; });
+	var trace = figure.data[0];
+	trace.x = rows.map(function (r) { return r[stat]; });
+	trace.y = rows.map(function (r) { return r.location; });
+	trace.customdata = rows.map(function (r) { return [r.total, r.fractional]; });
+	figure.layout.xaxis.title = {text: 'Graph 1: Incidents reported (' + stat + ')'};
+	figure.layout.meta = Object.assign({}, figure.layout.meta, {stat: stat});
+	return figure;
+}
+
+// Colours and sizes the map's markers by the statistic shown
+function setMarkers(figure, stat) {
+	var trace = figure.data[0];
+	var values = trace.customdata.map(function (c) { return c[STAT_COLUMN[stat]]; });
+	trace.marker.color = values;
+	trace.marker.size = values;
+	// The marker area scale px.scatter_mapbox uses for its default size_max of 20
+	trace.marker.sizeref = Math.max.apply(null, values.concat([0])) / (20 * 20);
+	figure.layout.meta = Object.assign({}, figure.layout.meta, {stat: stat});
+	return figure;
+}
+
+function drawGraph(figure, rows, stat, p) {
+	figure = copy(figure);
+	figure.layout.meta = {period: p.split(':')};
+	return setBars(figure, rows, stat);
+}
+
+function drawMap(figure, rows, stat, p) {
+	figure = copy(figure);
+	var trace = figure.data[0];
+	trace.lat = rows.map(function (r) { return r.lat; });
+	trace.lon = rows.map(function (r) { return r.lng; });
+	trace.hovertext = rows.map(function (r) { return r.location; });
+	trace.customdata = rows.map(function (r) { return [r.total, r.fractional]; });
+	figure.layout.meta = {period: p.split(':')};
+	return setMarkers(figure, stat);
+}
+
+// Whether a figure carries both statistics and records the one it shows
+function switchable(figure) {
+	return hasTrace(figure) && Boolean(figure.data[0].customdata) && Boolean(figure.layout.meta && figure.layout.meta.stat);
+}
+
+// Whether a figure can be switched to a statistic, i.e. carries both and shows the other
+function needsSwitch(figure, stat) {
+	return switchable(figure) && figure.layout.meta.stat !== stat;
+}
+
+// Whether the map's marker scale no longer matches its largest marker, e.g. after a Patch
+function needsRescale(figure) {
+	if (!switchable(figure)) {
+		return false;
+	}
+	var marker = figure.data[0].marker;
+	var expected = Math.max.apply(null, (marker.size || []).concat([0])) / (20 * 20);
+	return Math.abs((marker.sizeref || 0) - expected) > 1e-9 * Math.max(expected, 1);
+}
+
+function drawCategory(figure, location, entry, p) {
+	figure = copy(figure);
+	var trace = figure.data[0];
+	trace.x = entry.ratio;
+	trace.y = entry.category;
+	figure.layout.title = Object.assign({}, figure.layout.title, {text: location});
+	figure.layout.meta = {period: p.split(':'), location: location};
+	return figure;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+	lru: {
+		// Stores the cities shown on the map and the category breakdown shown in graph 2
+		remember: function (map, category, cache) {
+			var items = [];
+			if (hasTrace(map) && map.layout.meta && map.layout.meta.period) {
+				var p = map.layout.meta.period.join(':');
+				var trace = map.data[0];
+				(trace.hovertext || []).forEach(function (city, i) {
+					items.push([cityKey(city, p), {
+						location: city,
+						total: trace.customdata[i][0],
+						fractional: trace.customdata[i][1],
+						lat: trace.lat[i],
+						lng: trace.lon[i]
+					}]);
+				});
+			}
+			if (hasTrace(category) && category.layout.meta && category.layout.meta.period) {
+				var meta = category.layout.meta;
+				items.push([categoryKey(meta.location, meta.period.join(':')), {
+					category: category.data[0].y,
+					ratio: category.data[0].x
+				}]);
+			}
+			if (!items.length) {
+				return window.dash_clientside.no_update;
+			}
+			return touch(cache, items);
+		},
+
+		// Switches graph 1 and the map to the statistic selected, and rescales the map's markers
+		// after the server patched points into it
+		toggleStat: function (statType, graph, map) {
+			var no_update = window.dash_clientside.no_update;
+			if (!statType) {
+				return [no_update, no_update];
+			}
+			var stat = statType.toLowerCase();
+			var newGraph = no_update;
+			var newMap = no_update;
+			if (needsSwitch(graph, stat)) {
+				var trace = graph.data[0];
+				var rows = trace.y.map(function (city, i) {
+					return {location: city, total: trace.customdata[i][0], fractional: trace.customdata[i][1]};
+				});
+				newGraph = setBars(copy(graph), rows, stat);
+			}
+			if (needsSwitch(map, stat) || needsRescale(map)) {
+				newMap = setMarkers(copy(map), stat);
+			}
+			return [newGraph, newMap];
+		},
+
+		// Redraws graph 1 and the map from the cache, or requests the cities it is missing. The
+		// density layer is always requested, graph 1 still being drawn from the cache if it can
+		routeLocations: function (cities, startYear, startMonth, endYear, endMonth, layer, statType, cache, graph, map) {
+			var no_update = window.dash_clientside.no_update;
+			var p = period(startYear, startMonth, endYear, endMonth);
+			if (p === null || !statType) {
+				return [no_update, no_update, no_update];
+			}
+			cities = cities || [];
+			var entries = (cache && cache.entries) || {};
+			var missing = cities.filter(function (city) { return !(cityKey(city, p) in entries); });
+			var density = layer === 'Crime density';
+			var request = {missing: missing, at: Date.now()};
+			if (!missing.length && hasTrace(graph)) {
+				var rows = cities.map(function (city) { return entries[cityKey(city, p)]; });
+				var stat = statType.toLowerCase();
+				if (density) {
+					request.mapOnly = true;
+					return [drawGraph(graph, rows, stat, p), no_update, request];
+				}
+				if (hasTrace(map) && !isDensity(map)) {
+					return [drawGraph(graph, rows, stat, p), drawMap(map, rows, stat, p), no_update];
+				}
+			}
+			if (switchable(graph) && switchable(map) && graph.layout.meta.period) {
+				// Lets the server send only the points of the cities added or removed
+				request.shown = {
+					period: graph.layout.meta.period,
+					stat: graph.layout.meta.stat,
+					bars: graph.data[0].y,
+					markers: map.data[0].hovertext
+				};
+			}
+			return [no_update, no_update, request];
+		},
+
+		// Redraws graph 2 from the cache, or requests the location clicked on
+		routeCategory: function (clickData, startYear, startMonth, endYear, endMonth, location, cache, figure) {
+			var no_update = window.dash_clientside.no_update;
+			var p = period(startYear, startMonth, endYear, endMonth);
+			if (p === null) {
+				return [no_update, no_update, no_update];
+			}
+			var triggered = window.dash_clientside.callback_context.triggered.map(function (t) { return t.prop_id; });
+			if (triggered.indexOf('output-map-1.clickData') !== -1 && clickData) {
+				var point = clickData.points[0];
+				if (!point.hovertext) {
+					// Only the server knows the city nearest to a point without a name
+					return [no_update, no_update, {point: {lat: point.lat, lon: point.lon}, at: Date.now()}];
+				}
+				location = point.hovertext;
+			}
+			var entry = ((cache && cache.entries) || {})[categoryKey(location, p)];
+			if (entry && hasTrace(figure)) {
+				return [drawCategory(figure, location, entry, p), location, no_update];
+			}
+			return [no_update, no_update, {location: location, at: Date.now()}];
+		}
+	}
+});
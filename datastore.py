@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from urllib.parse import unquote
+
+DB_CONFIG = {
+    'user': os.environ.get('CRIME_DB_USER', 'root'),
+    'password': os.environ.get('CRIME_DB_PASSWORD', 'rootuser'),
+    'host': os.environ.get('CRIME_DB_HOST', '127.0.0.1'),
+    'database': os.environ.get('CRIME_DB_NAME', 'ukgovcrime'),
+}
+
+
+def __getattr__(name: str):
+    # mysql.connector and pyarrow are only imported once something handles a backend's errors, so
+    # importing the app without a database does not load them
+    if name == 'BACKEND_ERRORS':
+        import mysql.connector
+        import pyarrow
+        # Raised by a backend that cannot answer, e.g. an unreachable server, a missing file or a corrupt partition
+        return (mysql.connector.Error, pyarrow.lib.ArrowException, OSError)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def _placeholders(n: int) -> str:
+    return ', '.join(['%s'] * n)
+
+
+class MySQLBackend:
+    """Serves the dashboard's aggregates from the tables filled by db_main.py
+
+    Connections come from a pool created on first use, so importing the app does not need a
+    running database. A background callback job runs in a process of its own that ends with the
+    job, so there a single connection is opened instead of filling a pool nobody reuses. Queries
+    filter on (location, month), the leading columns of the primary keys created by db_main.py.
+
+    Args:
+        pool_size (int): The number of pooled connections
+        config (dict): Connection arguments passed to mysql.connector
+    """
+
+    def __init__(self, pool_size: int = 5, config: dict | None = None):
+        self.pool_size = pool_size
+        self.config = config or DB_CONFIG
+        self._pid = os.getpid()
+        self._pool = None
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        with self._lock:
+            if os.getpid() != self._pid:
+                # A forked job: its one connection is reused until the process exits
+                if self._connection is None or self._connection[0] != os.getpid():
+                    import mysql.connector
+                    self._connection = (os.getpid(), mysql.connector.connect(**self.config))
+                return self._connection[1], False
+            if self._pool is None:
+                from mysql.connector import pooling
+                self._pool = pooling.MySQLConnectionPool(pool_name='ukgovcrime', pool_size=self.pool_size, **self.config)
+        return self._pool.get_connection(), True
+
+    def _query(self, statement: str, params: tuple) -> list[tuple]:
+        cnx, pooled = self._connect()
+        try:
+            cursor = cnx.cursor()
+            cursor.execute(statement, params)
+            rows = cursor.fetchall()
+            cursor.close()
+        finally:
+            if pooled:
+                cnx.close()
+        return rows
+
+    def totals(self, locations: list[str]) -> dict[str, int]:
+        """Returns the total crime count of the latest ingested month for each location found
+
+        Args:
+            locations (list[str]): A list of city names
+
+        Returns:
+            dict: location mapped to its total crime count
+        """
+        if not locations:
+            return {}
+        statement = ("SELECT d.location, d.total FROM dropdown_data d "
+                     "JOIN (SELECT location, MAX(month) AS month FROM dropdown_data WHERE location IN ({}) GROUP BY location) m "
+                     "ON d.location = m.location AND d.month = m.month").format(_placeholders(len(locations)))
+        return {location: int(total) for location, total in self._query(statement, tuple(locations))}
+
+    def categories(self, location: str) -> dict[str, int]:
+        """Returns the crime count per category of the latest ingested month for a location
+
+        Args:
+            location (str): A city name in the UK
+
+        Returns:
+            dict: category mapped to its crime count, empty if the location has not been ingested
+        """
+        statement = ("SELECT k.name, c.total FROM category_data c JOIN crime_category k ON k.id = c.category_id "
+                     "WHERE c.location = %s AND c.month = (SELECT MAX(month) FROM category_data WHERE location = %s)")
+        return {category: int(total) for category, total in self._query(statement, (location, location))}
+
+    def monthly_categories(self, locations: list[str]) -> list[tuple[str, str, str, int]]:
+        """Returns every ingested (location, month, category, count) row for the given locations
+
+        Args:
+            locations (list[str]): A list of city names
+
+        Returns:
+            list: (location, month, category, count) tuples
+        """
+        if not locations:
+            return []
+        statement = ("SELECT c.location, DATE_FORMAT(c.month, '%%Y-%%m'), k.name, c.total FROM category_data c "
+                     "JOIN crime_category k ON k.id = c.category_id "
+                     "WHERE c.location IN ({})").format(_placeholders(len(locations)))
+        return [(location, month, category, int(total)) for location, month, category, total in self._query(statement, tuple(locations))]
+
+
+CRIME_SCHEMA = [
+    ('id', 'int64'),
+    ('persistent_id', 'string'),
+    ('category', 'string'),
+    ('lat', 'float64'),
+    ('lng', 'float64'),
+    ('street_id', 'int64'),
+    ('street_name', 'string'),
+    ('location_type', 'string'),
+    ('location_subtype', 'string'),
+]
+
+
+class ParquetBackend:
+    """Stores one row per crime in Parquet files partitioned by month and city
+
+    Files live at ``<root>/month=YYYY-MM/location=<city>/crimes.parquet``, one per ingested
+    (city, month), and are overwritten when that pair is ingested again. Queries filter on the
+    partition columns so only the matching files are read. Answers the same queries as
+    MySQLBackend without a running database server.
+
+    Args:
+        root (str): The directory holding the partitioned files
+        ttl (float): Number of seconds a discovered file listing is reused for
+    """
+
+    def __init__(self, root: str, ttl: float = 60):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+        self._pa, self._ds, self._pq = pa, ds, pq
+        self.root = root
+        self.ttl = ttl
+        self.schema = pa.schema(CRIME_SCHEMA)
+        self._dataset = None
+        self._loaded = 0.0
+        self._lock = threading.Lock()
+
+    def _path(self, location: str, month: str) -> str:
+        return os.path.join(self.root, 'month={}'.format(month), 'location={}'.format(location), 'crimes.parquet')
+
+    def write(self, location: str, month: str, crimes: list[dict], content_hash: str) -> None:
+        """Writes the crimes of one city and month, replacing any earlier file for the pair
+
+        Args:
+            location (str): A city name in the UK
+            month (str): A month in the format 'YYYY-MM'
+            crimes (list[dict]): Records with the columns of CRIME_SCHEMA
+            content_hash (str): The hash of the API response, kept in the file metadata
+        """
+        path = self._path(location, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        table = self._pa.Table.from_pylist(crimes, schema=self.schema)
+        table = table.replace_schema_metadata({'content_hash': content_hash})
+        self._pq.write_table(table, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        with self._lock:
+            self._dataset = None
+
+    def load_state(self) -> dict[tuple[str, str], str]:
+        """Returns (location, month) mapped to content hash for every written file"""
+        state = {}
+        if not os.path.isdir(self.root):
+            return state
+        for month_dir in os.listdir(self.root):
+            for location_dir in os.listdir(os.path.join(self.root, month_dir)):
+                path = os.path.join(self.root, month_dir, location_dir, 'crimes.parquet')
+                if os.path.exists(path):
+                    metadata = self._pq.read_schema(path).metadata or {}
+                    key = (location_dir.split('=', 1)[1], month_dir.split('=', 1)[1])
+                    state[key] = metadata.get(b'content_hash', b'').decode()
+        return state
+
+    def _get_dataset(self):
+        with self._lock:
+            if self._dataset is None or time.monotonic() - self._loaded > self.ttl:
+                if not os.path.isdir(self.root):
+                    return None
+                self._dataset = self._ds.dataset(self.root, format='parquet', partitioning='hive')
+                self._loaded = time.monotonic()
+            return self._dataset
+
+    def _scan(self, filter, columns: list[str]):
+        dataset = self._get_dataset()
+        if dataset is None:
+            return None
+        return dataset.to_table(columns=columns, filter=filter)
+
+    def _latest_months(self, locations: list[str]) -> dict[str, str]:
+        # Read from the file listing rather than the rows, so a month ingested without crimes still counts as the latest
+        dataset = self._get_dataset()
+        wanted = set(locations)
+        latest = {}
+        for path in dataset.files if dataset is not None else []:
+            partitions = dict(part.split('=', 1) for part in path.split('/') if '=' in part)
+            location, month = unquote(partitions.get('location', '')), unquote(partitions.get('month', ''))
+            if location in wanted and month > latest.get(location, ''):
+                latest[location] = month
+        return latest
+
+    def _counts(self, filter, keys: list[str]) -> list[dict]:
+        table = self._scan(filter, keys + ['id'])
+        if table is None or table.num_rows == 0:
+            return []
+        return table.group_by(keys).aggregate([('id', 'count')]).to_pylist()
+
+    def totals(self, locations: list[str]) -> dict[str, int]:
+        """Returns the total crime count of the latest ingested month for each location found, 0 if that month had no crimes"""
+        latest = self._latest_months(locations)
+        if not latest:
+            return {}
+        months = self._ds.field('month').isin(sorted(set(latest.values())))
+        rows = self._counts(self._ds.field('location').isin(list(latest)) & months, ['location', 'month'])
+        counts = {(row['location'], row['month']): row['id_count'] for row in rows}
+        return {location: counts.get((location, month), 0) for location, month in latest.items()}
+
+    def categories(self, location: str) -> dict[str, int]:
+        """Returns the crime count per category of the latest ingested month for a location, empty if that month had no crimes"""
+        month = self._latest_months([location]).get(location)
+        if month is None:
+            return {}
+        rows = self._counts((self._ds.field('location') == location) & (self._ds.field('month') == month), ['category'])
+        return {row['category']: row['id_count'] for row in rows}
+
+    def monthly_categories(self, locations: list[str]) -> list[tuple[str, str, str, int]]:
+        """Returns every ingested (location, month, category, count) row for the given locations"""
+        if not locations:
+            return []
+        rows = self._counts(self._ds.field('location').isin(locations), ['location', 'month', 'category'])
+        return [(row['location'], row['month'], row['category'], row['id_count']) for row in rows]
+
+
+def get_backend() -> MySQLBackend | ParquetBackend | None:
+    """Returns the backend selected by the CRIME_BACKEND environment variable, or None for the live API"""
+    backend = os.environ.get('CRIME_BACKEND', 'api')
+    if backend == 'mysql':
+        return MySQLBackend(int(os.environ.get('CRIME_DB_POOL_SIZE', '5')))
+    if backend == 'parquet':
+        return ParquetBackend(os.environ.get('CRIME_PARQUET_ROOT', 'crime_store'))
+    return None
@@ -1,10 +1,21 @@
-import pandas as pd
-import requests
+import argparse
 import hashlib
+import json
+import os
+import itertools
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import mysql.connector
 
-df = pd.read_csv("gb_latlon.csv")
-locations = list(df['city'])[:10]
+from police_api import API_URL, API_RATE, API_BURST, CONNECT_TIMEOUT, READ_TIMEOUT, PoliceClient, TokenBucket, client
+from datastore import DB_CONFIG, ParquetBackend
+from response_cache import NotCached, ResponseCache
+from gazetteer import load_gazetteer
+
+gazetteer = load_gazetteer(os.path.join(os.path.dirname(os.path.abspath(__file__)), "gb_latlon.csv"))
+locations = gazetteer.cities[:10]
 
 
 
@@ -24,7 +35,6 @@ def date_range(start_year, start_month, end_year, end_month):
             s = sm
             e = 13
         if y == ey:
-            s = 1
             e = em + 1
             
         y = str(y)
@@ -41,165 +51,420 @@ def date_range(start_year, start_month, end_year, end_month):
 
 d = date_range('2020', '1', '2023', '12')
 
-def fetch_data(lat, lng, date):
-        payload = {'lat':lat, 'lng':lng, 'date':date}
-        r = requests.post("https://data.police.uk/api/crimes-street/all-crime", params=payload)
-        if r.status_code == 404:
-            return ""
-        else:
-            res = r.json()
-            return res
-
-def store_cleaned_data(locations):
+def fetch_data(lat, lng, date, url=API_URL, retries=5, backoff=0.5, client=client):
+    payload = {'lat':lat, 'lng':lng, 'date':date}
+    try:
+        r = client.fetch(url, params=payload, retries=retries, backoff=backoff)
+    except NotCached:
+        # Offline, and never fetched: left for a later run like an unpublished month
+        return ""
+    if r.status_code == 404:
+        return ""
+    r.raise_for_status()
+    return r.json()
+
+
+class IngestionEngine:
+    """Fetches Police API data for many (location, month) pairs concurrently
+
+    At most ``concurrency`` requests are in flight at once and requests sent to the API are
+    started no faster than the client's token bucket allows, so a backfill stays inside the API's
+    rate limits while responses replayed from its cache are not held back. At most
+    ``window`` tasks are fetched ahead of the one the caller is given, so payloads waiting for a
+    slow consumer, such as the database writer, stay bounded however many tasks there are.
+
+    Args:
+        concurrency (int): The number of worker threads
+        rate (float): The number of requests the default client sends per second
+        burst (float): The number of requests the default client sends in a single burst
+        url (str): The all-crime endpoint, overridable to point at a stub server
+        client (PoliceClient | None): The HTTP client, by default one pooling a connection per worker and paced by rate and burst
+        window (int | None): The number of tasks submitted and not yet yielded, by default twice ``concurrency``
+    """
+
+    def __init__(self, concurrency=4, rate=API_RATE, burst=API_BURST, url=API_URL, client=None, window=None):
+        self.concurrency = concurrency
+        self.window = window or concurrency * 2
+        self.url = url
+        self.client = client or PoliceClient(pool_size=concurrency, limiter=TokenBucket(rate, burst))
+
+    def _fetch(self, task):
+        location, lat, lng, p, month = task
+        return task, fetch_data(lat, lng, month, url=self.url, client=self.client)
+
+    def tasks(self, locations, months, skip=()):
+        """Yields one (location, lat, lng, population, month) task per location and month not in skip"""
+        for location in locations:
+            lat, lng, p = gazetteer.lookup(location)
+            for month in months:
+                if (location, month) not in skip:
+                    yield (location, lat, lng, p, month)
+
+    def run(self, locations, months, skip=()):
+        """Yields (task, data) for every location and month not in skip, in task order"""
+        tasks = self.tasks(locations, months, skip)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = deque(executor.submit(self._fetch, task) for task in itertools.islice(tasks, self.window))
+            try:
+                while pending:
+                    result = pending.popleft().result()
+                    for task in itertools.islice(tasks, 1):
+                        pending.append(executor.submit(self._fetch, task))
+                    yield result
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+def month_date(m):
+    return m + '-01'
+
+
+def cleaned_rows(task, data, category_id=str):
+    """One row per crime, keyed by the Police API's own crime id and carrying its street location"""
+    location, lat, lng, p, m = task
     r = []
-    for location in locations:
-        df_ = df[df['city'] == location]
-        lat = float(df_.lat)
-        lng = float(df_.lng)
-
-        p = int(df_.population)
-
-        for x in d:
-            data = fetch_data(lat, lng, x)
-            t = len(data)
-            if t != 0:
-                for i in data:
-                    c = i['category']
-                    m = x
-                    input = [location, c, str(lat), str(lng), m]
-
-                    s = ""
-                    for j in input:
-                        s+=j
-
-                    p_key = hashlib.sha256(s.encode()).hexdigest()
-                    input.insert(0, p_key)
-                    r.append(tuple(input))
-                
+    for i in data:
+        l = i.get('location') or {}
+        street = l.get('street') or {}
+        persistent_id = bytes.fromhex(i['persistent_id']) if i.get('persistent_id') else None
+        r.append((i['id'], persistent_id, location, category_id(i['category']), month_date(m),
+                  l.get('latitude'), l.get('longitude'), street.get('id'), street.get('name'),
+                  i.get('location_type'), i.get('location_subtype') or None))
     return r
 
 
-def store_dropdown_data(locations):
-    r = []
-    for location in locations:
-        df_ = df[df['city'] == location]
-        lat = float(df_.lat)
-        lng = float(df_.lng)
-
-        p = int(df_.population)
-
-        for x in d:
-            data = fetch_data(lat, lng, x)
-            t = len(data)
-            if t != 0:
-                f = t/p
-                m = x
-                input = [location, str(t), str(f), str(lat), str(lng), m]
-
-                s = ""
-                for j in input:
-                    s+=j
-
-                p_key = hashlib.sha256(s.encode()).hexdigest()
-                input.insert(0, p_key)
-                r.append(tuple(input))
-    return r
+def dropdown_rows(task, data, category_id=str):
+    location, lat, lng, p, m = task
+    t = len(data)
+    f = t/p
+    return [(location, month_date(m), t, f, lat, lng)]
+
 
-def store_category_data(locations):
+def category_rows(task, data, category_id=str):
+    location, lat, lng, p, m = task
+    counts = {}
+    for i in data:
+        counts[i['category']] = counts.get(i['category'], 0) + 1
     r = []
-    for location in locations:
-        df_ = df[df['city'] == location]
-        lat = float(df_.lat)
-        lng = float(df_.lng)
-
-        p = int(df_.population)
-
-        for x in d:
-            data = fetch_data(lat, lng, x)
-            t = len(data)
-            if t != 0:
-                df_ = pd.DataFrame(data)
-                df_ = df_['category'].value_counts()
-                df_ = pd.DataFrame(df_)
-                
-                i_ = []
-                t_ = len(data)
-                if t != 0:
-                    i_ = []
-                    for j in df_.index:
-                        i_.append(j)
-
-                    
-                    for i in range(len(df_)):
-
-                        t = df_['category'][i]
-                        f = t/p
-                        
-                        input = [location, i_[i], str(t), str(f), x]
-                        s = ""
-                        for x in input:
-                            s += x
-
-                        p_key = hashlib.sha256(s.encode()).hexdigest()
-                        input.insert(0, p_key)
-
-                        r.append(tuple(input))
-                    
+    for category, t in sorted(counts.items(), key=lambda c: -c[1]):
+        f = t/p
+        r.append((location, month_date(m), category_id(category), t, f))
     return r
 
 
-cnx = mysql.connector.connect(
-                user='root',
-                password='rootuser',
-                host='127.0.0.1',
-                database='ukgovcrime')
-
-cursor = cnx.cursor()
-
-insert_clean_data = ("REPLACE INTO cleaned_data (hash, location, category, lat, lng, month) VALUES (%s, %s, %s, %s, %s, %s)")
-
-r = store_cleaned_data(locations)
-for t in r:
-    cursor.execute(insert_clean_data, t)
-
-insert_category_data = ("REPLACE INTO category_data (hash, location, category, total, fractional, month) VALUES (%s, %s, %s, %s, %s, %s)")
-
-r = store_category_data(locations)
-for t in r:
-    cursor.execute(insert_category_data, t)
-
-insert_dropdown_data = ("REPLACE INTO dropdown_data (hash, location, total, fractional, lat, lng, month) VALUES (%s, %s, %s, %s, %s, %s, %s)")
-
-r = store_dropdown_data(locations)
-for t in r:
-    cursor.execute(insert_dropdown_data, t)
-
-cnx.commit()
-cursor.close()
-cnx.close()
-
-# DB SCHEMA
+class CategoryLookup:
+    """Maps crime category names to their crime_category ids, adding unseen categories"""
 
-# table cleaned_data
+    def __init__(self, cnx):
+        self.cnx = cnx
+        cursor = cnx.cursor()
+        cursor.execute("SELECT name, id FROM crime_category")
+        self.ids = dict(cursor.fetchall())
+        cursor.close()
 
-# location varchar, category varchar, lat varchar, lng varchar, month varchar
-
-
-# table dropdown_data
-
-# hash varchar, total varchar, fractional varchar, lat varchar, lng varchar, month varchar
-
-
-# table category_data
-
-# location varchar, category varchar, total varchar, fractional varchar, month varchar
-
-
-
-
-    
-    
+    def __call__(self, name):
+        if name not in self.ids:
+            cursor = self.cnx.cursor()
+            cursor.execute("INSERT INTO crime_category (name) VALUES (%s)", (name,))
+            self.ids[name] = cursor.lastrowid
+            cursor.close()
+        return self.ids[name]
 
 
+def crime_records(task, data, category_id=str):
+    """One record per crime with the columns of datastore.CRIME_SCHEMA, for the Parquet store"""
+    r = []
+    for i in data:
+        l = i.get('location') or {}
+        street = l.get('street') or {}
+        r.append({
+            'id': i['id'],
+            'persistent_id': i.get('persistent_id') or None,
+            'category': i['category'],
+            'lat': float(l['latitude']) if l.get('latitude') else None,
+            'lng': float(l['longitude']) if l.get('longitude') else None,
+            'street_id': street.get('id'),
+            'street_name': street.get('name'),
+            'location_type': i.get('location_type'),
+            'location_subtype': i.get('location_subtype') or None,
+        })
+    return r
 
 
+STAGES = {
+    'cleaned_data': cleaned_rows,
+    'category_data': category_rows,
+    'dropdown_data': dropdown_rows,
+}
+
+PARQUET_STAGES = {
+    'crimes': crime_records,
+}
+
+
+def content_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def ingest(locations, engine, months=d, state=None, refresh=False, category_id=str, stages=STAGES):
+    """Fetches each (location, month) once and yields the rows it contributes to every table
+
+    Pairs recorded in ``state`` are not fetched again unless ``refresh`` is set, in which case
+    they are fetched but only yielded when their content hash has changed. Months the API has
+    not published yet (404) are skipped and left for a later run.
+
+    Args:
+        locations (list[str]): A list of city names
+        engine (IngestionEngine): The engine used to fetch the data
+        months (list[str]): A list of months in the format 'YYYY-MM'
+        state (dict): (location, month) mapped to the content hash of its last completed ingestion
+        refresh (bool): Whether to fetch pairs that are already in ``state``
+        category_id (callable): Maps a category name to the value stored in the category_id columns
+        stages (dict): Table name mapped to the function deriving its rows from one API response
+
+    Yields:
+        tuple: the task, the ingestion_state row and a dict of table name mapped to the rows
+        derived from one API response
+    """
+    state = state or {}
+    for task, data in engine.run(locations, months, skip=() if refresh else state):
+        if data == "":
+            continue
+        location, lat, lng, p, month = task
+        h = content_hash(data)
+        if state.get((location, month)) == h:
+            continue
+        rows = {}
+        if len(data) != 0:
+            rows = {table: stage(task, data, category_id) for table, stage in stages.items()}
+        yield task, (location, month, len(data), h), rows
+
+
+def load_state(cnx):
+    """Returns (location, month) mapped to content hash for every completed ingestion"""
+    cursor = cnx.cursor()
+    cursor.execute("SELECT location, month, content_hash FROM ingestion_state")
+    state = {(location, month): h for location, month, h in cursor}
+    cursor.close()
+    return state
+
+
+class BulkWriter:
+    """Buffers rows per table and writes them with executemany in batches
+
+    The connection is committed after every ``commit_every`` batches instead of once at the end,
+    and the time spent writing each table is recorded for throughput reporting. Rows passed to
+    ``complete`` are only written after every buffered data row, in the same transaction, so
+    ingestion_state never records a (location, month) whose rows were not committed.
+
+    Args:
+        cnx: An open database connection
+        statements (dict): Table name mapped to its parameterised insert statement
+        batch_size (int): The number of rows sent per executemany call
+        commit_every (int): The number of batches written between commits
+        deletes (dict): Table name mapped to its statement deleting the rows of a (location, month), used by ``replace``
+    """
+
+    def __init__(self, cnx, statements, batch_size=1000, commit_every=10, deletes=None):
+        self.cnx = cnx
+        self.cursor = cnx.cursor()
+        self.statements = statements
+        self.deletes = deletes or {}
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.buffers = {table: [] for table in statements}
+        self.rows = {table: 0 for table in statements}
+        self.seconds = {table: 0.0 for table in statements}
+        self.completed = []
+        self._batches = 0
+        self._commit_due = False
+
+    def add(self, table, rows):
+        buffer = self.buffers[table]
+        buffer.extend(rows)
+        while len(buffer) >= self.batch_size:
+            self._write(table, buffer[:self.batch_size])
+            del buffer[:self.batch_size]
+        if self._commit_due:
+            self.flush()
+
+    def replace(self, location, month):
+        """Deletes the rows and the ingestion_state row of a (location, month) about to be written again
+
+        Called before the pair's new rows are added. Its state row is deleted in the same
+        transaction, so a run stopped before the new rows are committed fetches the pair again.
+        """
+        self.cursor.executemany(DELETE_STATE, [(location, month)])
+        for table in self.statements:
+            if table in self.deletes:
+                self.cursor.executemany(self.deletes[table], [(location, month_date(month))])
+
+    def complete(self, state_row):
+        self.completed.append(state_row)
+
+    def _write(self, table, rows):
+        start = time.perf_counter()
+        self.cursor.executemany(self.statements[table], rows)
+        self.seconds[table] += time.perf_counter() - start
+        self.rows[table] += len(rows)
+        self._batches += 1
+        if self._batches % self.commit_every == 0:
+            self._commit_due = True
+
+    def flush(self):
+        for table, buffer in self.buffers.items():
+            if buffer:
+                self._write(table, buffer)
+                buffer.clear()
+        if self.completed:
+            self.cursor.executemany(INSERT_STATE, self.completed)
+            self.completed = []
+        self.cnx.commit()
+        self._commit_due = False
+
+    def close(self):
+        self.flush()
+        self.cursor.close()
+
+    def throughput(self):
+        """Returns table name mapped to (rows written, seconds spent writing, rows per second)"""
+        return {table: (self.rows[table], self.seconds[table], self.rows[table] / self.seconds[table] if self.seconds[table] else 0.0) for table in self.statements}
+
+
+# Typed schema, see migrate_schema.py for converting a database created with the earlier
+# all-varchar layout. Months are stored as the first day of the month.
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS crime_category ("
+    "id smallint unsigned NOT NULL AUTO_INCREMENT, name varchar(64) NOT NULL, "
+    "PRIMARY KEY (id), UNIQUE KEY name (name))",
+    "CREATE TABLE IF NOT EXISTS cleaned_data ("
+    "id bigint unsigned NOT NULL, persistent_id binary(32) NULL, location varchar(64) NOT NULL, "
+    "category_id smallint unsigned NOT NULL, month date NOT NULL, "
+    "lat decimal(9,6) NULL, lng decimal(9,6) NULL, street_id int unsigned NULL, street_name varchar(255) NULL, "
+    "location_type varchar(16) NULL, location_subtype varchar(64) NULL, "
+    # A crime near two cities, such as London and Westminster, is stored once for each of them
+    "PRIMARY KEY (location, month, id))",
+    "CREATE TABLE IF NOT EXISTS dropdown_data ("
+    "location varchar(64) NOT NULL, month date NOT NULL, total int unsigned NOT NULL, fractional double NOT NULL, "
+    "lat decimal(8,5) NOT NULL, lng decimal(8,5) NOT NULL, "
+    "PRIMARY KEY (location, month))",
+    "CREATE TABLE IF NOT EXISTS category_data ("
+    "location varchar(64) NOT NULL, month date NOT NULL, category_id smallint unsigned NOT NULL, "
+    "total int unsigned NOT NULL, fractional double NOT NULL, "
+    "PRIMARY KEY (location, month, category_id))",
+    "CREATE TABLE IF NOT EXISTS ingestion_state ("
+    "location varchar(64) NOT NULL, month char(7) NOT NULL, row_count int unsigned NOT NULL, "
+    "content_hash char(64) NOT NULL, "
+    "completed_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, "
+    "PRIMARY KEY (location, month))",
+]
+
+INSERTS = {
+    'cleaned_data': ("REPLACE INTO cleaned_data (id, persistent_id, location, category_id, month, lat, lng, "
+                     "street_id, street_name, location_type, location_subtype) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"),
+    'category_data': "REPLACE INTO category_data (location, month, category_id, total, fractional) VALUES (%s, %s, %s, %s, %s)",
+    'dropdown_data': "REPLACE INTO dropdown_data (location, month, total, fractional, lat, lng) VALUES (%s, %s, %s, %s, %s, %s)",
+}
+
+INSERT_STATE = "REPLACE INTO ingestion_state (location, month, row_count, content_hash) VALUES (%s, %s, %s, %s)"
+
+# A changed month is rewritten rather than merged, so crimes and categories it no longer has are removed
+DELETES = {table: "DELETE FROM {} WHERE location = %s AND month = %s".format(table) for table in INSERTS}
+
+DELETE_STATE = "DELETE FROM ingestion_state WHERE location = %s AND month = %s"
+
+
+def legacy_tables(cnx):
+    """Returns the crime tables still keyed by a hash column, or by the crime id alone, instead of the typed schema's keys"""
+    cursor = cnx.cursor()
+    cursor.execute("SELECT TABLE_NAME FROM information_schema.COLUMNS "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND COLUMN_NAME = 'hash' "
+                   "AND TABLE_NAME IN ('cleaned_data', 'dropdown_data', 'category_data') "
+                   "UNION SELECT TABLE_NAME FROM information_schema.STATISTICS "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'cleaned_data' AND INDEX_NAME = 'PRIMARY' "
+                   "GROUP BY TABLE_NAME HAVING COUNT(*) = 1")
+    tables = [table for (table,) in cursor.fetchall()]
+    cursor.close()
+    return tables
+
+
+def store_mysql(args, engine, months):
+    cnx = mysql.connector.connect(**DB_CONFIG)
+    if legacy_tables(cnx):
+        raise SystemExit('ukgovcrime uses an earlier schema, run migrate_schema.py first')
+
+    cursor = cnx.cursor()
+    for statement in SCHEMA:
+        cursor.execute(statement)
+    cursor.close()
+    state = load_state(cnx)
+
+    writer = BulkWriter(cnx, INSERTS, args.batch_size, args.commit_every, DELETES)
+    for task, state_row, rows in ingest(locations, engine, months, state, args.refresh, CategoryLookup(cnx)):
+        if state_row[:2] in state:
+            writer.replace(*state_row[:2])
+        for table, r in rows.items():
+            writer.add(table, r)
+        writer.complete(state_row)
+    writer.close()
+    cnx.close()
+    return writer.throughput()
+
+
+def store_parquet(args, engine, months):
+    store = ParquetBackend(args.parquet_root)
+    state = store.load_state()
+
+    n = 0
+    seconds = 0.0
+    for task, (location, month, row_count, h), rows in ingest(locations, engine, months, state, args.refresh, stages=PARQUET_STAGES):
+        start = time.perf_counter()
+        store.write(location, month, rows.get('crimes', []), h)
+        seconds += time.perf_counter() - start
+        n += row_count
+    return {'crimes': (n, seconds, n / seconds if seconds else 0.0)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loads Police API crime data into the ukgovcrime database')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of requests in flight at once')
+    parser.add_argument('--rate', type=float, default=API_RATE, help='requests allowed per second')
+    parser.add_argument('--burst', type=float, default=API_BURST, help='requests allowed in a single burst')
+    parser.add_argument('--url', default=API_URL, help='all-crime endpoint')
+    parser.add_argument('--connect-timeout', type=float, default=CONNECT_TIMEOUT, help='seconds allowed to connect to the API')
+    parser.add_argument('--read-timeout', type=float, default=READ_TIMEOUT, help='seconds allowed between bytes received from the API')
+    parser.add_argument('--batch-size', type=int, default=1000, help='rows sent per executemany call')
+    parser.add_argument('--commit-every', type=int, default=10, help='batches written between commits')
+    parser.add_argument('--start', default='2020-01', help='first month to ingest, YYYY-MM')
+    parser.add_argument('--end', default='2023-12', help='last month to ingest, YYYY-MM')
+    parser.add_argument('--refresh', action='store_true', help='refetch months already ingested and rewrite those that changed')
+    parser.add_argument('--store', choices=['mysql', 'parquet'], default='mysql', help='where ingested data is written')
+    parser.add_argument('--parquet-root', default=os.environ.get('CRIME_PARQUET_ROOT', 'crime_store'), help='directory of the Parquet store')
+    parser.add_argument('--cache-dir', default=os.environ.get('POLICE_CACHE_DIR', 'police_cache'), help='directory of recorded API responses, empty to turn recording off')
+    parser.add_argument('--offline', action='store_true', default=os.environ.get('POLICE_OFFLINE', '0') == '1', help='only use recorded API responses')
+    args = parser.parse_args()
+
+    # A refresh asks the API again for every month, recording the responses over the old ones
+    cache = ResponseCache(args.cache_dir, int(os.environ.get('POLICE_CACHE_SIZE', str(2 ** 30))), args.offline, args.refresh) if args.cache_dir else None
+    client = PoliceClient(args.concurrency, args.connect_timeout, args.read_timeout, cache, TokenBucket(args.rate, args.burst))
+    engine = IngestionEngine(args.concurrency, url=args.url, client=client)
+    months = date_range(*args.start.split('-'), *args.end.split('-'))
+
+    if args.store == 'parquet':
+        throughput = store_parquet(args, engine, months)
+    else:
+        throughput = store_mysql(args, engine, months)
+
+    for table, (n, seconds, rate) in throughput.items():
+        print('{}: {} rows in {:.2f}s ({:.0f} rows/sec)'.format(table, n, seconds, rate))
+    if cache is not None:
+        print('Recorded responses: {}'.format(cache.stats))
+    timings = engine.client.timings.snapshot()
+    requests_made = sum(timings['statuses'].values())
+    if requests_made:
+        print('API: {} requests, {:.0f} ms on average, by status {}'.format(
+            requests_made, timings['seconds'] / requests_made * 1e3, timings['statuses']))
+
+if __name__ == '__main__':
+    main()
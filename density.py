@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import numpy as np
+
+# Width in degrees of the density grid's square cells, about 330 m north to south and 200 m east
+# to west in the UK. An all-crime request covers a mile around its point, about 150 cells
+GRID_RESOLUTION = 0.003
+
+# A cell's key holds its row in the high 32 bits and its column, offset to be positive, in the low 32
+_COLUMN_OFFSET = 2 ** 31
+
+
+def grid_cells(lat: np.ndarray, lng: np.ndarray, resolution: float = GRID_RESOLUTION) -> tuple[np.ndarray, np.ndarray]:
+    """Counts points per cell of a square grid aligned with (0, 0)
+
+    Args:
+        lat (np.ndarray): The latitude of each point
+        lng (np.ndarray): The longitude of each point
+        resolution (float): The width of a cell in degrees
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: the sorted keys of the cells holding points and the number of points in each
+    """
+    rows = np.floor(np.asarray(lat, dtype=np.float64) / resolution).astype(np.int64)
+    cols = np.floor(np.asarray(lng, dtype=np.float64) / resolution).astype(np.int64)
+    keys, counts = np.unique((rows << 32) + (cols + _COLUMN_OFFSET), return_counts=True)
+    return keys, counts.astype(np.int64)
+
+
+def merge_cells(grids: list[tuple[np.ndarray, np.ndarray] | None]) -> tuple[np.ndarray, np.ndarray]:
+    """Adds up the counts of grids made with the same resolution, skipping None
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: the sorted keys of the cells holding points and the number of points in each
+    """
+    grids = [grid for grid in grids if grid is not None]
+    if not grids:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    keys, inverse = np.unique(np.concatenate([keys for keys, counts in grids]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([counts for keys, counts in grids]), minlength=len(keys))
+    return keys, counts.astype(np.int64)
+
+
+def cell_centres(keys: np.ndarray, resolution: float = GRID_RESOLUTION) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the latitude and longitude of the centre of each cell"""
+    keys = np.asarray(keys, dtype=np.int64)
+    rows = keys >> 32
+    cols = (keys & 0xFFFFFFFF) - _COLUMN_OFFSET
+    return (rows + 0.5) * resolution, (cols + 0.5) * resolution
@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import csv
+import functools
+import math
+
+import numpy as np
+
+
+class Gazetteer:
+    """Indexed, in-memory copy of gb_latlon.csv
+
+    Coordinates and populations are held in numpy arrays with a dictionary from city name to
+    row, so looking a city up does not scan the table. A few city names appear twice in the
+    CSV; the first, most populous, row is used for them. Cities are also bucketed into a grid
+    of ``cell`` degree squares for nearest-city lookups.
+
+    Args:
+        cities (list[str]): The city names, most populous first
+        lat (np.ndarray): The latitude of each city
+        lng (np.ndarray): The longitude of each city
+        population (np.ndarray): The population of each city
+        cell (float): The size in degrees of the spatial index's grid cells
+    """
+
+    def __init__(self, cities: list[str], lat: np.ndarray, lng: np.ndarray, population: np.ndarray, cell: float = 0.5):
+        self.cities = list(cities)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+        self.population = np.asarray(population, dtype=np.int64)
+        self.index = {}
+        for i, city in enumerate(self.cities):
+            self.index.setdefault(city, i)
+        self.names = list(self.index)
+        self._folded = [name.casefold() for name in self.names]
+        self.cell = cell
+        self._grid: dict[tuple[int, int], list[int]] = {}
+        for i in range(len(self.cities)):
+            self._grid.setdefault(self._cell_of(self.lat[i], self.lng[i]), []).append(i)
+
+    @classmethod
+    def from_csv(cls, path: str) -> Gazetteer:
+        """Builds the gazetteer from a CSV with city, lat, lng and population columns"""
+        with open(path, newline='', encoding='utf-8') as f:
+            rows = [(row['city'], row['lat'], row['lng'], row['population']) for row in csv.DictReader(f)]
+        cities, lat, lng, population = zip(*rows) if rows else ((), (), (), ())
+        return cls(list(cities), np.array(lat, dtype=np.float64), np.array(lng, dtype=np.float64), np.array(population, dtype=np.int64))
+
+    def _cell_of(self, lat: float, lng: float) -> tuple[int, int]:
+        return (math.floor(lat / self.cell), math.floor(lng / self.cell))
+
+    def __contains__(self, city: str) -> bool:
+        return city in self.index
+
+    def __len__(self) -> int:
+        return len(self.cities)
+
+    def lookup(self, city: str) -> tuple[float, float, int]:
+        """Returns the latitude, longitude and population of a city
+
+        Raises:
+            KeyError: if the city is not in the gazetteer
+        """
+        i = self.index[city]
+        return float(self.lat[i]), float(self.lng[i]), int(self.population[i])
+
+    def lookup_many(self, cities: list[str]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns arrays of the latitude, longitude and population of each city, in the order given"""
+        rows = np.fromiter((self.index[city] for city in cities), dtype=np.int64, count=len(cities))
+        return self.lat[rows], self.lng[rows], self.population[rows]
+
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> list[str]:
+        """Returns one page of the unique city names matching a search, most populous first
+
+        Names starting with the query come before names that only contain it.
+
+        Args:
+            query (str): The text to search for, case-insensitively
+            limit (int): The maximum number of names returned
+            offset (int): The number of matching names skipped
+
+        Returns:
+            list[str]: the matching city names
+        """
+        q = query.casefold().strip()
+        prefix = [name for name, folded in zip(self.names, self._folded) if folded.startswith(q)]
+        contains = [name for name, folded in zip(self.names, self._folded) if q in folded and not folded.startswith(q)]
+        return (prefix + contains)[offset:offset + limit]
+
+    def nearest(self, lat: float, lng: float, max_ring: int = 4) -> str:
+        """Returns the city closest to a point
+
+        Grid cells are searched in rings of growing size around the point's cell until the
+        closest city found is nearer than any unsearched cell could be. Points further than
+        ``max_ring`` cells from every city fall back to comparing all cities.
+        """
+        if not self.cities:
+            raise KeyError('the gazetteer is empty')
+        ci, cj = self._cell_of(lat, lng)
+        scale = math.cos(math.radians(lat))
+        best, best_d = None, math.inf
+        for ring in range(max_ring + 1):
+            for i, j in self._ring(ci, cj, ring):
+                for row in self._grid.get((i, j), ()):
+                    d = (self.lat[row] - lat) ** 2 + ((self.lng[row] - lng) * scale) ** 2
+                    if d < best_d:
+                        best, best_d = row, d
+            # Cities in the next ring are at least `ring` whole cells away from the point
+            if best is not None and (ring * self.cell * scale) ** 2 >= best_d:
+                return self.cities[best]
+        d = (self.lat - lat) ** 2 + ((self.lng - lng) * scale) ** 2
+        return self.cities[int(np.argmin(d))]
+
+    @staticmethod
+    def _ring(ci: int, cj: int, ring: int):
+        if ring == 0:
+            yield ci, cj
+            return
+        for j in range(cj - ring, cj + ring + 1):
+            yield ci - ring, j
+            yield ci + ring, j
+        for i in range(ci - ring + 1, ci + ring):
+            yield i, cj - ring
+            yield i, cj + ring
+
+
+@functools.lru_cache(maxsize=None)
+def load_gazetteer(path: str) -> Gazetteer:
+    """Returns the gazetteer of a CSV, read on the first call only, so every module of a process shares one copy"""
+    return Gazetteer.from_csv(path)
@@ -0,0 +1,290 @@
+from __future__ import annotations
+
+import bisect
+import contextvars
+import functools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+from dash.exceptions import PreventUpdate
+
+from police_api import TIMING_BUCKETS, RequestTimings
+
+# A sample is identified by its name and its labels, e.g. ('x_bucket', (('stage', 'fetch'), ('le', '0.5')))
+Sample = tuple[str, tuple[tuple[str, str], ...]]
+
+_callback: contextvars.ContextVar[str] = contextvars.ContextVar('callback', default='')
+
+
+def _labels(labels: dict[str, Any]) -> tuple[tuple[str, str], ...]:
+    return tuple((k, str(v)) for k, v in labels.items())
+
+
+def _bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def histogram_samples(name: str, buckets: tuple[float, ...], counts: list[int], seconds: float, **labels) -> dict[Sample, float]:
+    """Converts per-bucket counts, the last counting values above every bound, to Prometheus histogram samples"""
+    base = _labels(labels)
+    samples = {}
+    total = 0
+    for bound, count in zip(tuple(buckets) + (float('inf'),), counts):
+        total += count
+        samples[(name + '_bucket', base + (('le', _bound(bound)),))] = total
+    samples[(name + '_sum', base)] = seconds
+    samples[(name + '_count', base)] = total
+    return samples
+
+
+def request_samples(timings: RequestTimings, name: str = 'police_api') -> dict[Sample, float]:
+    """Samples of an HTTP client's RequestTimings: requests by status and a duration histogram"""
+    snapshot = timings.snapshot()
+    samples = {(name + '_requests_total', (('status', status),)): n for status, n in snapshot['statuses'].items()}
+    samples.update(histogram_samples(name + '_request_seconds', snapshot['buckets'], snapshot['histogram'], snapshot['seconds']))
+    return samples
+
+
+def cache_samples(stats: dict[str, int], cache: str, name: str = 'dashboard_cache_lookups_total') -> dict[Sample, float]:
+    """Samples of a cache's lookups by result, e.g. the stats of a FetchCache"""
+    return {(name, (('cache', cache), ('result', result))): n for result, n in stats.items()}
+
+
+class SamplingProfiler:
+    """Samples the stacks of registered threads at a fixed interval, for flame graphs
+
+    Stacks are counted in the folded format read by flamegraph.pl and speedscope, one
+    ``outermost;...;innermost count`` line per distinct stack.
+
+    Args:
+        interval (float): Seconds between samples
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks: dict[str, int] = {}
+        self._threads: dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._pid = None
+
+    @contextmanager
+    def sampling(self) -> Iterator[None]:
+        """Samples the calling thread's stack while the block runs"""
+        ident = threading.get_ident()
+        with self._lock:
+            if self._sampler is None or self._pid != os.getpid():
+                self._sampler = threading.Thread(target=self._run, daemon=True)
+                self._pid = os.getpid()
+                self._sampler.start()
+            self._threads[ident] = self._threads.get(ident, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._threads[ident] -= 1
+                if not self._threads[ident]:
+                    del self._threads[ident]
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._threads:
+                    continue
+                frames = sys._current_frames()
+                for ident in self._threads:
+                    frame = frames.get(ident)
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                        frame = frame.f_back
+                    if stack:
+                        folded = ';'.join(reversed(stack))
+                        self.stacks[folded] = self.stacks.get(folded, 0) + 1
+
+    def take(self) -> dict[str, int]:
+        """Returns and forgets the stacks counted so far"""
+        with self._lock:
+            stacks, self.stacks = self.stacks, {}
+            return stacks
+
+
+class Metrics:
+    """Latency histograms and counters of the dashboard, served in Prometheus' text format
+
+    Every sample only ever grows, so results from several processes are merged by adding them.
+    With a ``shared`` store each process adds what it recorded to the store at the end of every
+    callback and on every scrape, so background callback jobs, which run in processes of their
+    own, and every gunicorn worker are counted. Sources registered with ``register`` return
+    cumulative samples kept elsewhere, e.g. a PoliceClient's timings, of which only the growth
+    since the last flush is added. A forked process drops what it inherited from its parent,
+    which the parent adds itself.
+
+    Args:
+        shared (diskcache.Cache | None): A store shared between processes
+        buckets (tuple[float, ...]): Upper bounds in seconds of the duration histograms
+        profiler (SamplingProfiler | None): Samples the stacks of callbacks while they run
+        key (str): The entry holding the samples in the shared store
+    """
+
+    def __init__(self, shared=None, buckets: tuple[float, ...] = TIMING_BUCKETS, profiler: SamplingProfiler | None = None,
+                 key: str = 'metrics'):
+        self.shared = shared
+        self.buckets = buckets
+        self.profiler = profiler
+        self.key = key
+        self.families: dict[str, tuple[str, str]] = {}
+        self._values: dict[Sample, float] = {}
+        self._stacks: dict[str, int] = {}
+        self._sources: list[Callable[[], dict[Sample, float]]] = []
+        self._baselines: list[dict[Sample, float]] = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def describe(self, name: str, kind: str, help: str) -> None:
+        """Declares a metric family, with kind 'counter' or 'histogram'"""
+        self.families[name] = (kind, help)
+
+    def register(self, collect: Callable[[], dict[Sample, float]]) -> None:
+        """Adds a source of cumulative samples, counted from the moment it is registered"""
+        with self._lock:
+            self._sources.append(collect)
+            self._baselines.append(collect())
+
+    def _adopt(self) -> None:
+        # Called with the lock held; drops samples recorded by the parent of a forked process
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._values.clear()
+            self._stacks.clear()
+            self._baselines = [collect() for collect in self._sources]
+            if self.profiler is not None:
+                self.profiler.take()
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        """Adds a duration to a histogram"""
+        base = _labels(labels)
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self._adopt()
+            for j, bound in enumerate(tuple(self.buckets) + (float('inf'),)):
+                sample = (name + '_bucket', base + (('le', _bound(bound)),))
+                self._values[sample] = self._values.get(sample, 0) + (j >= i)
+            for suffix, value in (('_sum', seconds), ('_count', 1)):
+                self._values[(name + suffix, base)] = self._values.get((name + suffix, base), 0) + value
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Adds to a counter"""
+        sample = (name, _labels(labels))
+        with self._lock:
+            self._adopt()
+            self._values[sample] = self._values.get(sample, 0) + value
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """Times a block as a stage of the callback running it, in dashboard_stage_seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('dashboard_stage_seconds', time.perf_counter() - start, callback=_callback.get() or 'none', stage=stage)
+
+    def callback(self, name: str) -> Callable:
+        """Decorates a callback to time it in dashboard_callback_seconds and label the stages it runs"""
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                token = _callback.set(name)
+                start = time.perf_counter()
+                outcome = 'error'
+                try:
+                    if self.profiler is None:
+                        result = func(*args, **kwargs)
+                    else:
+                        with self.profiler.sampling():
+                            result = func(*args, **kwargs)
+                    outcome = 'ok'
+                    return result
+                except PreventUpdate:
+                    outcome = 'prevented'
+                    raise
+                finally:
+                    self.observe('dashboard_callback_seconds', time.perf_counter() - start, callback=name, outcome=outcome)
+                    _callback.reset(token)
+                    self.flush()
+            return wrapper
+        return decorator
+
+    def _collect(self) -> None:
+        # Called with the lock held; moves what the sources gained into the local samples
+        for i, collect in enumerate(self._sources):
+            current = collect()
+            baseline = self._baselines[i]
+            for sample, value in current.items():
+                # A source that went down was replaced or restarted, and counts from zero again
+                gained = value - baseline.get(sample, 0) if value >= baseline.get(sample, 0) else value
+                self._values[sample] = self._values.get(sample, 0) + gained
+            self._baselines[i] = current
+        if self.profiler is not None:
+            for stack, n in self.profiler.take().items():
+                self._stacks[stack] = self._stacks.get(stack, 0) + n
+
+    def flush(self) -> None:
+        """Adds the samples recorded by this process since the last flush to the shared store"""
+        if self.shared is None:
+            return
+        with self._lock:
+            self._adopt()
+            self._collect()
+            values, stacks = self._values, self._stacks
+            self._values, self._stacks = {}, {}
+        if not values and not stacks:
+            return
+        with self.shared.transact():
+            merged = self.shared.get(self.key, None) or {'values': {}, 'stacks': {}}
+            for sample, value in values.items():
+                merged['values'][sample] = merged['values'].get(sample, 0) + value
+            for stack, n in stacks.items():
+                merged['stacks'][stack] = merged['stacks'].get(stack, 0) + n
+            self.shared.set(self.key, merged)
+
+    def snapshot(self) -> dict[str, dict]:
+        """Returns every sample and profiled stack, of all processes when there is a shared store"""
+        if self.shared is not None:
+            self.flush()
+            merged = self.shared.get(self.key, None) or {'values': {}, 'stacks': {}}
+            return {'values': dict(merged['values']), 'stacks': dict(merged['stacks'])}
+        with self._lock:
+            self._adopt()
+            self._collect()
+            return {'values': dict(self._values), 'stacks': dict(self._stacks)}
+
+    def render(self) -> str:
+        """Returns every sample in Prometheus' text exposition format"""
+        families: dict[str, list[str]] = {}
+        for (name, labels), value in self.snapshot()['values'].items():
+            family = name
+            for suffix in ('_bucket', '_sum', '_count'):
+                if name.endswith(suffix) and self.families.get(name[:-len(suffix)], ('',))[0] == 'histogram':
+                    family = name[:-len(suffix)]
+            text = ','.join('{}="{}"'.format(k, v.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')) for k, v in labels)
+            families.setdefault(family, []).append('{}{} {}'.format(name, '{' + text + '}' if text else '', float(value)))
+        lines = []
+        for family in sorted(families):
+            kind, help = self.families.get(family, ('untyped', ''))
+            if help:
+                lines.append('# HELP {} {}'.format(family, help))
+            lines.append('# TYPE {} {}'.format(family, kind))
+            lines.extend(families[family])
+        return '\n'.join(lines) + '\n'
+
+    def folded(self) -> str:
+        """Returns the profiled stacks in the folded format, most sampled first"""
+        stacks = self.snapshot()['stacks']
+        return ''.join('{} {}\n'.format(stack, n) for stack, n in sorted(stacks.items(), key=lambda item: -item[1]))
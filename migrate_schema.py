@@ -0,0 +1,132 @@
+import argparse
+import time
+
+import mysql.connector
+
+from datastore import DB_CONFIG
+from db_main import SCHEMA, legacy_tables
+
+TABLES = ['cleaned_data', 'dropdown_data', 'category_data']
+
+# The same aggregates the dashboard needs, written once per layout
+LEGACY_QUERIES = {
+    'totals per location': "SELECT location, SUM(CAST(total AS UNSIGNED)) FROM dropdown_data GROUP BY location",
+    'categories of a location': "SELECT category, SUM(CAST(total AS UNSIGNED)) FROM category_data WHERE location = 'London' GROUP BY category",
+}
+
+TYPED_QUERIES = {
+    'totals per location': "SELECT location, SUM(total) FROM dropdown_data GROUP BY location",
+    'categories of a location': ("SELECT k.name, SUM(c.total) FROM category_data c JOIN crime_category k ON k.id = c.category_id "
+                                 "WHERE c.location = 'London' GROUP BY k.name"),
+}
+
+MONTH = "STR_TO_DATE(CONCAT({}, '-01'), '%Y-%m-%d')"
+
+CATEGORIES = ("INSERT IGNORE INTO crime_category (name) "
+              "SELECT DISTINCT category FROM category_data")
+
+# cleaned_data is not copied: its legacy rows were keyed without the crime id and collapsed every
+# crime of a category in a city-month into one, or by the crime id alone so that a city lost the
+# crimes it shares with a city nearby, so it is refilled by the next db_main.py run
+COPIES = {
+    'dropdown_data': "REPLACE INTO dropdown_data_typed (location, month, total, fractional, lat, lng) "
+                     "SELECT location, " + MONTH.format('month') + ", CAST(total AS UNSIGNED), fractional + 0E0, "
+                     "CAST(lat AS DECIMAL(8,5)), CAST(lng AS DECIMAL(8,5)) FROM dropdown_data",
+    'category_data': "REPLACE INTO category_data_typed (location, month, category_id, total, fractional) "
+                     "SELECT c.location, " + MONTH.format('c.month') + ", k.id, CAST(c.total AS UNSIGNED), c.fractional + 0E0 "
+                     "FROM category_data c JOIN crime_category k ON k.name = c.category",
+}
+
+
+def table_sizes(cursor):
+    """Returns table name mapped to its data and index size in bytes"""
+    for table in TABLES:
+        cursor.execute("ANALYZE TABLE {}".format(table))
+        cursor.fetchall()
+    cursor.execute("SELECT TABLE_NAME, DATA_LENGTH + INDEX_LENGTH FROM information_schema.TABLES "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ('cleaned_data', 'dropdown_data', 'category_data')")
+    return {table: int(size) for table, size in cursor.fetchall()}
+
+
+def query_times(cursor, queries, repeat=5):
+    """Returns query name mapped to its fastest run time in seconds"""
+    r = {}
+    for name, statement in queries.items():
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cursor.execute(statement)
+            cursor.fetchall()
+            best = min(best, time.perf_counter() - start)
+        r[name] = best
+    return r
+
+
+def migrate(cnx, tables):
+    """Copies the given legacy tables into the typed schema and swaps them in with a single rename
+
+    The original tables are kept as <table>_legacy. When cleaned_data is migrated, ingestion_state
+    is cleared so that the next db_main.py run fetches every crime again. A <table>_typed left
+    by a run that failed before the rename is dropped first, so an interrupted migration can be
+    run again.
+    """
+    cursor = cnx.cursor()
+    for table in tables:
+        cursor.execute("DROP TABLE IF EXISTS {}_typed".format(table))
+    for statement in SCHEMA:
+        for table in tables:
+            prefix = "CREATE TABLE IF NOT EXISTS {} (".format(table)
+            if statement.startswith(prefix):
+                statement = "CREATE TABLE {}_typed (".format(table) + statement[len(prefix):]
+                break
+        cursor.execute(statement)
+    cursor.execute("ALTER TABLE ingestion_state MODIFY location varchar(64) NOT NULL, MODIFY row_count int unsigned NOT NULL")
+    if 'category_data' in tables:
+        cursor.execute(CATEGORIES)
+    for table in tables:
+        if table in COPIES:
+            cursor.execute(COPIES[table])
+    if 'cleaned_data' in tables:
+        cursor.execute("DELETE FROM ingestion_state")
+    cnx.commit()
+    cursor.execute("RENAME TABLE " + ", ".join(
+        "{0} TO {0}_legacy, {0}_typed TO {0}".format(table) for table in tables))
+    cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Converts the ukgovcrime tables from the all-varchar layout to the typed schema')
+    parser.add_argument('--drop-legacy', action='store_true', help='drop the original tables after migrating')
+    args = parser.parse_args()
+
+    cnx = mysql.connector.connect(**DB_CONFIG)
+    tables = legacy_tables(cnx)
+    if not tables:
+        raise SystemExit('ukgovcrime already uses the typed schema')
+    legacy_layout = 'dropdown_data' in tables
+
+    cursor = cnx.cursor()
+    sizes_before = table_sizes(cursor)
+    times_before = query_times(cursor, LEGACY_QUERIES if legacy_layout else TYPED_QUERIES)
+    cursor.close()
+
+    migrate(cnx, tables)
+
+    cursor = cnx.cursor()
+    sizes_after = table_sizes(cursor)
+    times_after = query_times(cursor, TYPED_QUERIES)
+    if args.drop_legacy:
+        cursor.execute("DROP TABLE " + ", ".join("{}_legacy".format(table) for table in tables))
+    cursor.close()
+    cnx.close()
+
+    for table in TABLES:
+        print('{}: {:.1f} MB -> {:.1f} MB'.format(table, sizes_before.get(table, 0) / 1e6, sizes_after.get(table, 0) / 1e6))
+    for name in TYPED_QUERIES:
+        print('{}: {:.1f} ms -> {:.1f} ms'.format(name, times_before[name] * 1e3, times_after[name] * 1e3))
+    if 'cleaned_data' in tables:
+        print('cleaned_data is now keyed by location, month and crime id and empty, run db_main.py to refill it')
+
+
+if __name__ == '__main__':
+    main()
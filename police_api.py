@@ -0,0 +1,549 @@
+from __future__ import annotations
+
+import bisect
+import io
+import logging
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, TYPE_CHECKING, Any, Callable, Hashable
+
+import ijson
+import numpy as np
+import psutil
+
+from density import grid_cells
+from response_cache import NotCached, ResponseCache
+
+if TYPE_CHECKING:
+    import requests
+
+API_URL = "https://data.police.uk/api/crimes-street/all-crime"
+
+# The Police API allows 15 requests per second with bursts of up to 30
+API_RATE = 15
+API_BURST = 30
+
+# Connections kept open to the API, the seconds allowed to connect and the seconds allowed
+# between bytes received
+POOL_SIZE = int(os.environ.get('POLICE_API_POOL_SIZE', '10'))
+CONNECT_TIMEOUT = float(os.environ.get('POLICE_API_CONNECT_TIMEOUT', '3.05'))
+READ_TIMEOUT = float(os.environ.get('POLICE_API_READ_TIMEOUT', '30'))
+
+# Statuses worth retrying after a pause, honouring Retry-After when the API sends it
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Upper bounds in seconds of the request duration histogram
+TIMING_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token-bucket rate limiter shared between threads
+
+    With a ``shared`` store the tokens are kept there instead, so every process using the store,
+    e.g. the dashboard's background callback jobs, draws from the same bucket.
+
+    Args:
+        rate (float): The number of tokens added per second
+        capacity (float): The maximum number of tokens held, i.e. the largest burst allowed
+        shared (diskcache.Cache | None): A store shared between processes
+        key (str): The entry holding the tokens in the shared store
+    """
+
+    def __init__(self, rate: float = API_RATE, capacity: float = API_BURST, shared=None, key: str = 'police_api_tokens'):
+        self.rate = rate
+        self.capacity = capacity
+        self.shared = shared
+        self.key = key
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens: float, updated: float, now: float) -> tuple[float, float]:
+        # Returns the tokens left and the seconds to wait before one is available, 0 if one was taken
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, 0
+        return tokens, (1 - tokens) / self.rate
+
+    def acquire(self) -> None:
+        """Blocks until a token is available and takes it"""
+        while True:
+            if self.shared is not None:
+                # Wall-clock time, as monotonic clocks are not comparable between processes
+                with self.shared.transact():
+                    now = time.time()
+                    tokens, updated = self.shared.get(self.key, None) or (self.capacity, now)
+                    tokens, wait = self._take(tokens, updated, now)
+                    self.shared.set(self.key, (tokens, now))
+            else:
+                with self._lock:
+                    now = time.monotonic()
+                    self._tokens, wait = self._take(self._tokens, self._updated, now)
+                    self._updated = now
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class RequestTimings:
+    """Counts and durations of HTTP requests, by response status
+
+    Durations are kept as a histogram over TIMING_BUCKETS, the last bucket counting requests
+    slower than every bound, so the totals stay the same size however many requests are made.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = TIMING_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._statuses: dict[str, int] = {}
+        self._histogram = [0] * (len(buckets) + 1)
+        self._seconds = 0.0
+
+    def record(self, status: int | str, seconds: float) -> None:
+        """Adds one request with its status, or the name of the error it raised, and duration"""
+        with self._lock:
+            self._statuses[str(status)] = self._statuses.get(str(status), 0) + 1
+            self._histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+            self._seconds += seconds
+
+    def snapshot(self) -> dict:
+        """Returns the number of requests per status, the histogram counts and the total seconds"""
+        with self._lock:
+            return {'statuses': dict(self._statuses), 'buckets': self.buckets, 'histogram': list(self._histogram), 'seconds': self._seconds}
+
+
+class PoliceClient:
+    """Pooled keep-alive HTTP client for the Police API
+
+    Requests share one requests.Session whose connection pool holds up to ``pool_size``
+    connections per host, so repeated calls skip the DNS lookup, TCP connect and TLS handshake.
+    Every request has connect and read timeouts, asks for a gzip-compressed body and has its
+    duration recorded in ``timings`` and logged at DEBUG level. A forked process, such as a
+    background callback job, opens a pool of its own rather than sharing the parent's sockets.
+    With a ``cache``, responses for a given month are answered from disk once recorded, and
+    only the requests that reach the API are timed and, with a ``limiter``, paced.
+
+    Args:
+        pool_size (int): The maximum number of connections kept open per host
+        connect_timeout (float): Seconds allowed to establish a connection
+        read_timeout (float): Seconds allowed between bytes received
+        cache (ResponseCache | None): Records and replays responses for given months
+        limiter (TokenBucket | None): Takes a token before each request sent to the API
+    """
+
+    def __init__(self, pool_size: int = POOL_SIZE, connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT,
+                 cache: ResponseCache | None = None, limiter: TokenBucket | None = None):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.cache = cache
+        self.limiter = limiter
+        self.timings = RequestTimings()
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        # requests is imported with the first session, so importing the app does not load it
+        import requests
+        from requests.adapters import HTTPAdapter
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, pool_block=True)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers['Accept-Encoding'] = 'gzip'
+                self._session, self._pid = session, os.getpid()
+            return self._session
+
+    def post(self, url: str, params: dict, stream: bool = False) -> requests.Response:
+        """Sends a POST request through the pool
+
+        The recorded duration runs until the response headers arrive when ``stream`` is set,
+        and until the whole body arrived otherwise.
+
+        Args:
+            url (str): The endpoint
+            params (dict): The query parameters
+            stream (bool): Whether to leave the body to be read from the response
+
+        Returns:
+            requests.Response: the response
+
+        Raises:
+            NotCached: if the cache is offline and has not recorded the response, or never records it
+        """
+        import requests
+        key = self.cache.key(url, params) if self.cache is not None else None
+        if key is None and self.cache is not None and self.cache.offline:
+            # Responses for the latest month are never recorded, so offline there is nothing to answer with
+            raise NotCached((url, params.get('lat'), params.get('lng'), None))
+        if key is not None:
+            body = self.cache.get(key)
+            if body is not None:
+                return _replayed(url, body, stream)
+        if self.limiter is not None:
+            self.limiter.acquire()
+        start = time.perf_counter()
+        try:
+            r = self.session.post(url, params=params, timeout=self.timeout, stream=stream or key is not None)
+            if key is not None and r.status_code == 200:
+                compressed = r.headers.get('Content-Encoding') == 'gzip'
+                body = self.cache.put(key, r.raw.read(decode_content=False), compressed)
+                r.close()
+                r = _replayed(url, body, stream)
+            elif key is not None and not stream:
+                r.content
+        except requests.RequestException as e:
+            self.timings.record(type(e).__name__, time.perf_counter() - start)
+            raise
+        seconds = time.perf_counter() - start
+        self.timings.record(r.status_code, seconds)
+        logger.debug('POST %s %s %d in %.1f ms', url, params, r.status_code, seconds * 1e3)
+        return r
+
+    def fetch(self, url: str, params: dict, stream: bool = False, retries: int = 5, backoff: float = 0.5) -> requests.Response:
+        """Sends a POST request, retrying connection errors, timeouts and RETRY_STATUSES
+
+        A retried status waits for the seconds given by Retry-After, or else backs off exponentially.
+
+        Args:
+            url (str): The endpoint
+            params (dict): The query parameters
+            stream (bool): Whether to leave the body to be read from the response
+            retries (int): The number of attempts after the first
+            backoff (float): Seconds waited before the first retry, doubled for each one after
+
+        Returns:
+            requests.Response: the first response not retried, which may still be an error once the retries ran out
+
+        Raises:
+            NotCached: if the cache is offline and has not recorded the response, or never records it
+        """
+        import requests
+        for attempt in range(retries + 1):
+            try:
+                r = self.post(url, params=params, stream=stream)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == retries:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+                continue
+            if r.status_code in RETRY_STATUSES and attempt < retries:
+                retry_after = r.headers.get('Retry-After', '')
+                r.close()
+                time.sleep(float(retry_after) if retry_after.isdigit() else backoff * 2 ** attempt)
+                continue
+            return r
+
+
+def _replayed(url: str, body: bytes, stream: bool) -> requests.Response:
+    """A 200 response whose gzip-compressed body is read from memory, as if it had just been received"""
+    import requests
+    from urllib3 import HTTPResponse
+    r = requests.Response()
+    r.status_code = 200
+    r.url = url
+    r.encoding = 'utf-8'
+    r.headers = requests.structures.CaseInsensitiveDict({'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+    r.raw = HTTPResponse(body=io.BytesIO(body), headers=dict(r.headers), status=200, preload_content=False, decode_content=True)
+    if not stream:
+        r.content
+    return r
+
+
+# Shared by every caller in a process that does not need a pool of its own. Responses for a given
+# month are kept in POLICE_CACHE_DIR, see ResponseCache.from_env, and requests sent to the API are
+# kept within its rate limits, across processes once create_app shares the limiter
+client = PoliceClient(cache=ResponseCache.from_env(), limiter=TokenBucket(API_RATE, API_BURST))
+
+
+class CrimeSummary:
+    """The parts of an all-crime response the dashboard uses
+
+    Args:
+        count (int): The number of crimes
+        categories (dict[str, int]): Category mapped to its crime count
+        lat (np.ndarray | None): The latitude of each crime, if requested
+        lng (np.ndarray | None): The longitude of each crime, if requested
+        cells (tuple[np.ndarray, np.ndarray] | None): The keys of the grid cells holding crimes and the crime count of each, see density.grid_cells
+    """
+
+    def __init__(self, count: int, categories: dict[str, int], lat: np.ndarray | None = None, lng: np.ndarray | None = None,
+                 cells: tuple[np.ndarray, np.ndarray] | None = None):
+        self.count = count
+        self.categories = categories
+        self.lat = lat
+        self.lng = lng
+        self.cells = cells
+
+    @classmethod
+    def from_crimes(cls, crimes: list[dict], coordinates: bool = False, grid: float | None = None) -> CrimeSummary:
+        """Summarises crimes that were already decoded"""
+        categories = {}
+        for crime in crimes:
+            categories[crime['category']] = categories.get(crime['category'], 0) + 1
+        lat = lng = cells = None
+        if coordinates or grid:
+            lat = np.array([float(crime['location']['latitude']) for crime in crimes])
+            lng = np.array([float(crime['location']['longitude']) for crime in crimes])
+        if grid:
+            cells = grid_cells(lat, lng, grid)
+        if not coordinates:
+            lat = lng = None
+        return cls(len(crimes), categories, lat, lng, cells)
+
+    def __len__(self) -> int:
+        return self.count
+
+
+def summarise_crimes(stream: IO[bytes], coordinates: bool = False, grid: float | None = None) -> CrimeSummary:
+    """Summarises an all-crime response body while it is read
+
+    The body is parsed incrementally into parser events, so no crime is ever held as a
+    dictionary and memory use does not grow with the number of crimes beyond the summary and,
+    while the body is read, the coordinates.
+
+    Args:
+        stream (IO[bytes]): The response body, e.g. a streamed response's raw stream
+        coordinates (bool): Whether to keep the latitude and longitude of each crime
+        grid (float | None): The width in degrees of the grid cells the crimes are counted in, if any
+
+    Returns:
+        CrimeSummary: the crime count, the count per category and, if requested, the coordinates and the grid cells
+    """
+    count = 0
+    categories = {}
+    located = coordinates or bool(grid)
+    lat, lng = array('d'), array('d')
+    for prefix, event, value in ijson.parse(stream):
+        if prefix == 'item' and event == 'start_map':
+            count += 1
+        elif prefix == 'item.category':
+            categories[value] = categories.get(value, 0) + 1
+        elif located and prefix == 'item.location.latitude':
+            lat.append(float(value))
+        elif located and prefix == 'item.location.longitude':
+            lng.append(float(value))
+    if not located:
+        return CrimeSummary(count, categories)
+    lat, lng = np.frombuffer(lat), np.frombuffer(lng)
+    cells = grid_cells(lat, lng, grid) if grid else None
+    if not coordinates:
+        return CrimeSummary(count, categories, cells=cells)
+    return CrimeSummary(count, categories, lat, lng, cells)
+
+
+class _Pending:
+    """An in-flight fetch that other callers for the same key wait on"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+_MISSING = object()
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+class FetchCache:
+    """Request-coalescing cache in front of a Police API fetch function, keyed on (lat, lng, month)
+
+    Concurrent callers asking for the same key share a single in-flight request and its result.
+    Results are kept for ``ttl`` seconds and the least recently used entry is evicted once more
+    than ``maxsize`` entries are held.
+
+    With a ``shared`` store, results are also written to it and processes coalesce on a lock
+    entry holding the fetching process's pid, so that background callback jobs, which each run
+    in a process of their own, reuse each other's results. A lock whose process has died, e.g.
+    a cancelled job, is taken over.
+
+    ``stats`` counts lookups answered from memory ('hit'), by waiting on another caller's request
+    ('coalesced'), from the shared store ('shared') and by calling the fetch function ('miss').
+
+    Args:
+        fetch (Callable): A function taking (lat, lng, month) and returning the crime data
+        ttl (float): Number of seconds a result stays valid
+        maxsize (int): The maximum number of results held
+        shared (diskcache.Cache | None): A store shared between processes
+        name (str): Prefixes this cache's keys in the shared store
+    """
+
+    def __init__(self, fetch: Callable[[float, float, str | None], Any], ttl: float = 3600, maxsize: int = 256, shared=None,
+                 name: str = 'fetch'):
+        self._fetch = fetch
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.shared = shared
+        self.name = name
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._pending: dict[Hashable, _Pending] = {}
+        self.stats = {'hit': 0, 'coalesced': 0, 'shared': 0, 'miss': 0}
+
+    def _count(self, result: str, n: int = 1) -> None:
+        with self._lock:
+            self.stats[result] += n
+
+    def get(self, lat: float, lng: float, month: str | None = None) -> Any:
+        """Returns the crime data for a location and month, fetching it at most once for concurrent callers
+
+        Args:
+            lat (float): The latitude of the desired city
+            lng (float): The longitude of the desired city
+            month (str | None): The month in the format 'YYYY-MM', or None for the latest month
+
+        Returns:
+            Any: the result of the fetch function
+        """
+        key = (lat, lng, month)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.stats['hit'] += 1
+                    return value
+                del self._entries[key]
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = _Pending()
+                self._pending[key] = pending
+
+        if not owner:
+            self._count('coalesced')
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+
+        try:
+            value = self._fetch_shared(key)
+        except BaseException as e:
+            pending.error = e
+            with self._lock:
+                del self._pending[key]
+            pending.event.set()
+            raise
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            del self._pending[key]
+        pending.value = value
+        pending.event.set()
+        return value
+
+    def _fetch_shared(self, key: tuple[float, float, str | None]) -> Any:
+        if self.shared is None:
+            self._count('miss')
+            return self._fetch(*key)
+        name = '{}:{}:{}:{}'.format(self.name, *key)
+        lock = 'lock:' + name
+        while True:
+            value = self.shared.get(name, _MISSING)
+            if value is not _MISSING:
+                self._count('shared')
+                return value
+            if self.shared.add(lock, os.getpid(), expire=self.ttl):
+                try:
+                    self._count('miss')
+                    value = self._fetch(*key)
+                    self.shared.set(name, value, expire=self.ttl)
+                    return value
+                finally:
+                    self.shared.delete(lock)
+            with self.shared.transact():
+                owner = self.shared.get(lock)
+                if owner is not None and not _process_alive(owner):
+                    self.shared.delete(lock)
+            time.sleep(0.02)
+
+    def get_many(self, coordinates: list[tuple[float, float]], month: str | None = None, max_workers: int = 8,
+                 progress: Callable[[int, int], None] | None = None) -> list[Any]:
+        """Fetches several locations concurrently, returning results in the order given
+
+        Args:
+            coordinates (list[tuple[float, float]]): A list of (lat, lng) pairs
+            month (str | None): The month in the format 'YYYY-MM', or None for the latest month
+            max_workers (int): The maximum number of requests in flight at once
+            progress (Callable | None): Called with (done, total) each time a location is fetched
+
+        Returns:
+            list: the crime data for each pair of coordinates
+        """
+        return self.get_all([(lat, lng, month) for lat, lng in coordinates], max_workers, progress)
+
+    def get_all(self, keys: list[tuple[float, float, str | None]], max_workers: int = 8,
+                progress: Callable[[int, int], None] | None = None) -> list[Any]:
+        """Fetches several (lat, lng, month) keys concurrently, returning results in the order given
+
+        Args:
+            keys (list[tuple[float, float, str | None]]): A list of (lat, lng, month) keys
+            max_workers (int): The maximum number of requests in flight at once
+            progress (Callable | None): Called with (done, total) each time a key is fetched
+
+        Returns:
+            list: the crime data for each key
+        """
+        # Keys already cached are answered here, so only the misses start worker threads
+        now = time.monotonic()
+        results = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(key)
+                    results.append(entry[1])
+                else:
+                    results.append(_MISSING)
+            self.stats['hit'] += sum(value is not _MISSING for value in results)
+        misses = [i for i, value in enumerate(results) if value is _MISSING]
+        done = [len(keys) - len(misses)]
+        lock = threading.Lock()
+        if progress is not None and done[0]:
+            progress(done[0], len(keys))
+
+        def get(key):
+            value = self.get(*key)
+            if progress is not None:
+                with lock:
+                    done[0] += 1
+                    progress(done[0], len(keys))
+            return value
+
+        if len(misses) <= 1:
+            fetched = [get(keys[i]) for i in misses]
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(misses))) as executor:
+                fetched = list(executor.map(get, [keys[i] for i in misses]))
+        for i, value in zip(misses, fetched):
+            results[i] = value
+        return results
+
+    def clear(self) -> None:
+        """Drops every cached result"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+
+class NotCached(LookupError):
+    """Raised by an offline ResponseCache for a request whose response was never recorded"""
+
+
+class ResponseCache:
+    """Police API responses for given months, kept on disk across restarts
+
+    A month the API has published does not change, so a response asked for by date is recorded
+    the first time it is received and answered from disk afterwards, by the dashboard and by
+    db_main.py alike. Requests without a date, for the latest month, and responses other than
+    200 are never recorded.
+
+    Bodies are stored gzip-compressed and content-addressed, at ``objects/ab/<sha256>.gz`` for
+    the SHA-256 of the uncompressed body, so a body returned for several keys is stored once.
+    Each (endpoint, lat, lng, date) key has a small JSON file under ``keys/`` naming its body.
+    Files are written to a temporary name and renamed, so processes sharing the directory never
+    read a partial file. Reading a body marks it as used; once the bodies take up more than
+    ``max_bytes``, the least recently used are removed, and keys left without a body are misses.
+
+    Args:
+        root (str): The directory holding the cache
+        max_bytes (int): The total compressed size of the bodies kept
+        offline (bool): Whether to answer from the cache alone, raising NotCached on a miss and, in PoliceClient, for the latest month
+        refresh (bool): Whether to ignore recorded responses and record every response again, unless offline
+    """
+
+    def __init__(self, root: str, max_bytes: int = 2 ** 30, offline: bool = False, refresh: bool = False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.refresh = refresh
+        self.stats = {'hit': 0, 'miss': 0, 'stored': 0, 'evicted': 0}
+        self._bytes = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> ResponseCache | None:
+        """The cache configured by POLICE_CACHE_DIR, POLICE_CACHE_SIZE and POLICE_OFFLINE, or None if POLICE_CACHE_DIR is empty"""
+        root = os.environ.get('POLICE_CACHE_DIR', 'police_cache')
+        if not root:
+            return None
+        return cls(root, int(os.environ.get('POLICE_CACHE_SIZE', str(2 ** 30))), os.environ.get('POLICE_OFFLINE', '0') == '1')
+
+    @staticmethod
+    def key(url: str, params: dict) -> tuple[str, float, float, str] | None:
+        """Returns the key of a request, or None if its response may still change"""
+        if params.get('date') is None:
+            return None
+        return (url, float(params['lat']), float(params['lng']), str(params['date']))
+
+    def _key_path(self, key: tuple) -> str:
+        name = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.root, 'keys', name[:2], name + '.json')
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.root, 'objects', digest[:2], digest + '.gz')
+
+    def _write(self, path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _count(self, result: str, n: int = 1) -> None:
+        with self._lock:
+            self.stats[result] += n
+
+    def get(self, key: tuple) -> bytes | None:
+        """Returns the gzip-compressed body recorded for a key, or None if there is none
+
+        Raises:
+            NotCached: if the cache is offline and holds no body for the key
+        """
+        if self.refresh and not self.offline:
+            return None
+        try:
+            with open(self._key_path(key), 'rb') as f:
+                path = self._object_path(json.load(f)['digest'])
+            with open(path, 'rb') as f:
+                body = f.read()
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            self._count('miss')
+            if self.offline:
+                raise NotCached(key)
+            return None
+        self._count('hit')
+        return body
+
+    def put(self, key: tuple, body: bytes, compressed: bool = False) -> bytes:
+        """Records a body for a key and returns it gzip-compressed
+
+        Args:
+            key (tuple): The key returned by ``key``
+            body (bytes): The response body
+            compressed (bool): Whether the body is already gzip-compressed, as sent by the API
+
+        Returns:
+            bytes: the compressed body
+        """
+        raw = gzip.decompress(body) if compressed else body
+        blob = body if compressed else gzip.compress(body)
+        digest = hashlib.sha256(raw).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            self._write(path, blob)
+            self._count('stored')
+            with self._lock:
+                self._bytes = self._size() if self._bytes is None else self._bytes + len(blob)
+                full = self._bytes > self.max_bytes
+            if full:
+                self.evict()
+        self._write(self._key_path(key), json.dumps({'key': list(key), 'digest': digest}).encode())
+        return blob
+
+    def _objects(self) -> list[os.DirEntry]:
+        entries = []
+        try:
+            for shard in os.scandir(os.path.join(self.root, 'objects')):
+                if shard.is_dir():
+                    entries.extend(entry for entry in os.scandir(shard.path) if entry.name.endswith('.gz'))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _size(self) -> int:
+        return sum(entry.stat().st_size for entry in self._objects())
+
+    def evict(self) -> None:
+        """Removes the least recently used bodies until the rest fit in max_bytes"""
+        with self._lock:
+            objects = []
+            for entry in self._objects():
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                objects.append((stat.st_mtime, stat.st_size, entry.path))
+            objects.sort()
+            total = sum(size for mtime, size, path in objects)
+            evicted = 0
+            for mtime, size, path in objects:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    evicted += 1
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._bytes = total
+            self.stats['evicted'] += evicted
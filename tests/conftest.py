@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from tests.police_stub import PoliceStub, Recordings, synthesise
+
+RECORDED_MONTHS = ['2023-01', '2023-02', '2023-03']
+GAZETTEER_CSV = os.path.join(os.path.dirname(__file__), '..', 'gb_latlon.csv')
+
+
+@pytest.fixture(scope='session', autouse=True)
+def app_caches(tmp_path_factory):
+    """Creates the app with its caches in a temporary directory rather than the working directory"""
+    import app
+    app.create_app(str(tmp_path_factory.mktemp('app')))
+    yield
+    app.fetch_cache.shared = app.aggregates.shared = app.metrics.shared = app.client.limiter.shared = None
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    """Keeps tests from sharing state through the stores create_app shares between processes, and
+    the Police API client shared by app.py and db_main.py from recording responses into the working directory"""
+    import app
+    monkeypatch.setattr(app.client, 'cache', None)
+    monkeypatch.setattr(app.client.limiter, 'shared', None)
+    monkeypatch.setattr(app.fetch_cache, 'shared', None)
+    monkeypatch.setattr(app.aggregates, 'shared', None)
+    monkeypatch.setattr(app.metrics, 'shared', None)
+
+
+@pytest.fixture(scope='session')
+def recordings(tmp_path_factory):
+    """Police API responses recorded into POLICE_RECORDINGS, or synthesised for RECORDED_MONTHS if it is not set"""
+    if os.environ.get('POLICE_RECORDINGS'):
+        return Recordings(os.environ['POLICE_RECORDINGS'])
+    from gazetteer import Gazetteer
+    gazetteer = Gazetteer.from_csv(GAZETTEER_CSV)
+    return synthesise(str(tmp_path_factory.mktemp('recordings')), gazetteer, RECORDED_MONTHS)
+
+
+@pytest.fixture(scope='session')
+def police_api(recordings):
+    """A PoliceStub replaying the recordings, each request delayed by POLICE_STUB_LATENCY seconds"""
+    with PoliceStub(payload=recordings, latency=float(os.environ.get('POLICE_STUB_LATENCY', '0'))) as stub:
+        yield stub
+
+
+@pytest.fixture
+def offline_app(monkeypatch, police_api):
+    """The app module reading every city from police_api, with empty caches and no database"""
+    from cachelib import SimpleCache
+    import app
+    from aggregates import MonthlyAggregates
+    from police_api import FetchCache
+    monkeypatch.setattr(app, 'API_URL', police_api.url)
+    monkeypatch.setattr(app, 'db', None)
+    monkeypatch.setattr(app, 'aggregates', MonthlyAggregates())
+    monkeypatch.setattr(app, 'figure_cache', SimpleCache())
+    monkeypatch.setattr(app, 'fetch_cache', FetchCache(lambda lat, lng, month: app.fetch_summary(lat, lng, month)))
+    # The stub is local, so its requests are not paced
+    monkeypatch.setattr(app.client, 'limiter', None)
+    return app
@@ -0,0 +1,207 @@
+import argparse
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class PoliceStub:
+    """Local stand-in for the Police API all-crime endpoint
+
+    Payloads returned as bytes are taken to be gzip-compressed JSON, as kept by Recordings, and
+    are sent as they are to clients accepting gzip. A payload of None is answered with a 404.
+
+    Args:
+        payload (callable): Returns the crimes, or their compressed JSON, for (lat, lng, date)
+        failures (list[int]): Status codes returned, in order, before any successful response
+        latency (float): Seconds each request is delayed by
+    """
+
+    def __init__(self, payload=None, failures=(), latency=0):
+        self.payload = payload or (lambda lat, lng, date: [{'category': 'burglary', 'id': 1, 'month': date}])
+        self.failures = list(failures)
+        self.latency = latency
+        self.requests = []
+        self.connections = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/api/crimes-street/all-crime'.format(self._server.server_port)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                with stub._lock:
+                    stub.requests.append(query)
+                    stub.connections.add(self.client_address)
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                    status = stub.failures.pop(0) if stub.failures else 200
+                try:
+                    time.sleep(stub.latency)
+                    body = b''
+                    compressed = False
+                    if status == 200:
+                        body = stub.payload(query.get('lat'), query.get('lng'), query.get('date'))
+                        if body is None:
+                            status, body = 404, b''
+                        elif isinstance(body, bytes):
+                            compressed = 'gzip' in self.headers.get('Accept-Encoding', '')
+                            if not compressed:
+                                body = gzip.decompress(body)
+                        else:
+                            body = json.dumps(body).encode()
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    if compressed:
+                        self.send_header('Content-Encoding', 'gzip')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class Recordings:
+    """Directory of recorded all-crime responses, kept gzip-compressed, replayed by PoliceStub
+
+    Each response is stored as ``<date>/<lat>_<lng>.json.gz``. Requests without a date are
+    answered with the latest month recorded for the coordinates, and requests for anything not
+    recorded with a 404, as the API does for months it has not published.
+
+    Args:
+        root (str): The directory holding the recordings
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._bodies = {}
+
+    def _path(self, lat, lng, date):
+        return os.path.join(self.root, date, '{}_{}.json.gz'.format(float(lat), float(lng)))
+
+    def save(self, lat, lng, date, crimes):
+        """Records the crimes the API returned for a location and month"""
+        path = self._path(lat, lng, date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(gzip.compress(json.dumps(crimes).encode(), mtime=0))
+
+    def months(self):
+        return sorted(os.listdir(self.root)) if os.path.isdir(self.root) else []
+
+    def __call__(self, lat, lng, date=None):
+        """Returns the compressed response recorded for a location and month, or None"""
+        dates = [date] if date else reversed(self.months())
+        for d in dates:
+            key = (float(lat), float(lng), d)
+            if key not in self._bodies:
+                path = self._path(lat, lng, d)
+                self._bodies[key] = open(path, 'rb').read() if os.path.exists(path) else None
+            if self._bodies[key] is not None:
+                return self._bodies[key]
+        return None
+
+
+# Crimes per month recorded for the cities the tests use, and the share of each category
+SYNTHETIC_TOTALS = {
+    'London': 6729, 'Birmingham': 1952, 'Manchester': 92, 'Liverpool': 1253, 'Portsmouth': 1190,
+    'Southampton': 978, 'Nottingham': 1534, 'Bristol': 1442, 'Leicester': 1417, 'Coventry': 1024,
+}
+CATEGORY_SHARES = {
+    'other-theft': 30.0, 'theft-from-the-person': 26.0, 'violent-crime': 9.4, 'anti-social-behaviour': 9.3,
+    'shoplifting': 5.6, 'robbery': 4.6, 'vehicle-crime': 3.2, 'public-order': 2.8, 'drugs': 2.3,
+    'criminal-damage-arson': 1.6, 'burglary': 1.4, 'bicycle-theft': 1.3, 'possession-of-weapons': 0.4,
+    'other-crime': 0.2,
+}
+
+
+def synthetic_crimes(total, lat, lng, month, seed=0):
+    """Returns ``total`` crimes shaped like the API's, split between categories by CATEGORY_SHARES
+
+    Crimes are scattered within about 5km of (lat, lng) and are the same for the same arguments.
+    """
+    rng = random.Random('{}:{}:{}:{}'.format(seed, lat, lng, month))
+    weight = sum(CATEGORY_SHARES.values())
+    counts = {category: round(share / weight * total) for category, share in CATEGORY_SHARES.items()}
+    counts['other-theft'] += total - sum(counts.values())
+    crimes = []
+    for category, n in counts.items():
+        for _ in range(n):
+            street = rng.randrange(100000, 2000000)
+            crimes.append({
+                'category': category,
+                'location_type': 'Force',
+                'location': {
+                    'latitude': '{:.6f}'.format(lat + rng.uniform(-0.05, 0.05)),
+                    'street': {'id': street, 'name': 'On or near Street {}'.format(street % 1000)},
+                    'longitude': '{:.6f}'.format(lng + rng.uniform(-0.05, 0.05)),
+                },
+                'context': '',
+                'outcome_status': None if category == 'anti-social-behaviour' else {'category': 'Under investigation', 'date': month},
+                'persistent_id': '' if category == 'anti-social-behaviour' else '{:064x}'.format(rng.getrandbits(256)),
+                'id': rng.randrange(100000000, 120000000),
+                'location_subtype': '',
+                'month': month,
+            })
+    return crimes
+
+
+def synthesise(root, gazetteer, months, totals=SYNTHETIC_TOTALS, seed=0):
+    """Fills a recordings directory with synthetic_crimes for each city and month, returning it"""
+    recordings = Recordings(root)
+    for city, total in totals.items():
+        lat, lng, p = gazetteer.lookup(city)
+        for month in months:
+            recordings.save(lat, lng, month, synthetic_crimes(total, lat, lng, month, seed))
+    return recordings
+
+
+def record(root, coordinates, months, fetch):
+    """Records the responses of ``fetch(lat, lng, month)`` for each (lat, lng) and month into a recordings directory"""
+    recordings = Recordings(root)
+    for lat, lng in coordinates:
+        for month in months:
+            data = fetch(lat, lng, month)
+            if data != "":
+                recordings.save(lat, lng, month, data)
+    return recordings
+
+
+if __name__ == '__main__':
+    # Run from the repository root as python -m tests.police_stub <dir> --month YYYY-MM
+    from db_main import fetch_data, gazetteer
+    parser = argparse.ArgumentParser(description='Records live Police API responses for PoliceStub to replay')
+    parser.add_argument('root', help='directory the recordings are written to')
+    parser.add_argument('--month', action='append', required=True, help='month to record, YYYY-MM, repeatable')
+    parser.add_argument('--city', action='append', help='city to record, repeatable, by default the ten the tests use')
+    args = parser.parse_args()
+    record(args.root, [gazetteer.lookup(city)[:2] for city in args.city or SYNTHETIC_TOTALS], args.month, fetch_data)
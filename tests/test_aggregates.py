@@ -0,0 +1,36 @@
+from aggregates import MonthlyAggregates, month_index
+
+def test_month_index_is_consecutive():
+    assert month_index('2023-01') - month_index('2022-12') == 1
+
+def test_range_totals_and_categories():
+    a = MonthlyAggregates()
+    a.add('London', '2023-01', {'burglary': 2, 'drugs': 1})
+    a.add('London', '2023-02', {'burglary': 1})
+    a.add('London', '2023-03', {'drugs': 4})
+    a.add('Bristol', '2023-02', {})
+    assert a.totals(['London', 'Bristol', 'Leeds'], '2023-01', '2023-03') == {'London': 8, 'Bristol': 0}
+    assert a.totals(['London'], '2023-02', '2023-02') == {'London': 1}
+    assert a.totals(['London'], '2022-01', '2022-12') == {'London': 0}
+    assert a.categories('London', '2023-02', '2023-03') == {'burglary': 1, 'drugs': 4}
+    assert a.categories('Leeds', '2023-01', '2023-03') == {}
+
+def test_add_invalidates_prefix_sums():
+    a = MonthlyAggregates()
+    a.add('London', '2023-01', {'burglary': 2})
+    assert a.totals(['London'], '2023-01', '2023-12') == {'London': 2}
+    a.add('London', '2023-06', {'robbery': 3})
+    assert a.has('London', '2023-06')
+    assert a.totals(['London'], '2023-01', '2023-12') == {'London': 5}
+
+def test_shared_store_outlives_the_process(tmp_path):
+    import diskcache
+    shared = diskcache.Cache(str(tmp_path))
+    a = MonthlyAggregates(shared=shared)
+    a.add('London', '2023-01', {'burglary': 2})
+    a.mark_fresh(['London'])
+    # A store in another process starts empty and reads what the first one shared
+    b = MonthlyAggregates(shared=shared)
+    assert b.fresh('London') and not b.fresh('Bristol')
+    assert b.has('London', '2023-01') and not b.has('London', '2023-02')
+    assert b.totals(['London'], '2023-01', '2023-12') == {'London': 2}
@@ -0,0 +1,157 @@
+import gzip
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from aggregates import MonthlyAggregates
+from db_main import IngestionEngine, category_rows, cleaned_rows, content_hash, crime_records, dropdown_rows, ingest
+from tests.conftest import RECORDED_MONTHS
+from tests.police_stub import SYNTHETIC_TOTALS
+
+# The cities police_stub.py synthesises, and records by default
+CITIES = list(SYNTHETIC_TOTALS)
+START, END = RECORDED_MONTHS[0].split('-'), RECORDED_MONTHS[-1].split('-')
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+# Run by a fresh interpreter, printing the modules loaded by importing app.py
+IMPORT = '''
+import json, sys
+import app
+print(json.dumps(sorted(sys.modules)))
+'''
+
+# Run by a fresh interpreter, serving what a browser asks for when it first opens the dashboard
+FIRST_REQUEST = '''
+import app
+client = app.server.test_client()
+for path in ('/', '/_dash-layout', '/_dash-dependencies'):
+    assert client.get(path).status_code == 200
+page = client.post('/_dash-update-component', json={
+    'output': 'page-content.children',
+    'outputs': {'id': 'page-content', 'property': 'children'},
+    'inputs': [{'id': 'url', 'property': 'pathname', 'value': '/'}],
+    'changedPropIds': ['url.pathname'],
+})
+assert page.status_code == 200
+'''
+
+
+def cold(app):
+    """Returns a pedantic setup emptying the caches, so every round reads the cities from the stub"""
+    def setup():
+        app.fetch_cache.clear()
+        app.figure_cache.clear()
+        app.aggregates = MonthlyAggregates()
+    return setup
+
+
+@pytest.mark.benchmark(group='fetch')
+def test_fetch_data(benchmark, offline_app):
+    lat, lng, p = offline_app.get_gazetteer().lookup('London')
+    data = benchmark(offline_app.fetch_data, lat, lng, RECORDED_MONTHS[0])
+    assert data
+
+@pytest.mark.benchmark(group='fetch')
+def test_fetch_summary(benchmark, offline_app):
+    lat, lng, p = offline_app.get_gazetteer().lookup('London')
+    summary = benchmark(offline_app.fetch_summary, lat, lng, RECORDED_MONTHS[0])
+    assert len(summary) == len(offline_app.fetch_data(lat, lng, RECORDED_MONTHS[0]))
+
+@pytest.mark.benchmark(group='data')
+def test_get_count_graph(benchmark, offline_app):
+    output = benchmark.pedantic(offline_app.get_count_graph, (CITIES,), setup=cold(offline_app), rounds=5)
+    assert list(output['location']) == CITIES
+
+@pytest.mark.benchmark(group='data')
+def test_get_count_graph_cached(benchmark, offline_app):
+    offline_app.get_count_graph(CITIES)
+    output = benchmark(offline_app.get_count_graph, CITIES)
+    assert list(output['location']) == CITIES
+
+@pytest.mark.benchmark(group='data')
+def test_get_category(benchmark, offline_app):
+    output = benchmark.pedantic(offline_app.get_category, ('London',), setup=cold(offline_app), rounds=5)
+    assert output['ratio'].sum() == pytest.approx(100, abs=0.5)
+
+@pytest.mark.benchmark(group='data')
+def test_get_count_map_date_range(benchmark, offline_app):
+    output = benchmark.pedantic(offline_app.get_count_map, (CITIES, RECORDED_MONTHS), setup=cold(offline_app), rounds=3)
+    assert list(output['location']) == CITIES
+
+@pytest.mark.benchmark(group='callbacks')
+def test_update_graph_1(benchmark, offline_app):
+    figure = benchmark.pedantic(offline_app.update_graph_1, (CITIES, 'Total', *START, *END), setup=cold(offline_app), rounds=3)
+    assert len(figure.data[0].y) == len(CITIES)
+
+@pytest.mark.benchmark(group='callbacks')
+def test_update_category(benchmark, offline_app):
+    figure, location = benchmark.pedantic(offline_app.update_category, ({'location': 'London'}, *START, *END, 'London'),
+                                          setup=cold(offline_app), rounds=3)
+    assert location == 'London'
+
+@pytest.mark.benchmark(group='callbacks')
+def test_update_map(benchmark, offline_app):
+    figure = benchmark.pedantic(offline_app.update_map, (lambda progress: None, CITIES, 'Fractional', *START, *END),
+                                setup=cold(offline_app), rounds=3)
+    assert list(figure.data[0].hovertext) == CITIES
+
+@pytest.mark.benchmark(group='callbacks')
+def test_update_map_density(benchmark, offline_app):
+    figure = benchmark.pedantic(offline_app.update_map, (lambda progress: None, CITIES, 'Total', *START, *END, None, 'Crime density'),
+                                setup=cold(offline_app), rounds=3)
+    # One point per occupied cell, however many crimes fall in it
+    crimes = sum(SYNTHETIC_TOTALS.values()) * len(RECORDED_MONTHS)
+    assert sum(figure.data[0].z) == crimes
+    assert len(figure.data[0].z) < crimes / 4
+
+
+@pytest.fixture(scope='module')
+def london(recordings):
+    task = ('London', 51.5072, -0.1275, 11262000, RECORDED_MONTHS[0])
+    return task, json.loads(gzip.decompress(recordings(*task[1:3], task[4])))
+
+@pytest.mark.benchmark(group='ingestion')
+def test_engine_run(benchmark, police_api):
+    engine = IngestionEngine(concurrency=4, rate=1000, burst=1000, url=police_api.url)
+    results = benchmark.pedantic(lambda: list(engine.run(CITIES, RECORDED_MONTHS[:1])), rounds=3)
+    assert [task[0] for task, data in results] == CITIES
+
+@pytest.mark.benchmark(group='ingestion')
+@pytest.mark.parametrize('stage', [cleaned_rows, category_rows, dropdown_rows, crime_records], ids=lambda stage: stage.__name__)
+def test_stage(benchmark, london, stage):
+    task, data = london
+    assert benchmark(stage, task, data)
+
+@pytest.mark.benchmark(group='ingestion')
+def test_content_hash(benchmark, london):
+    task, data = london
+    assert len(benchmark(content_hash, data)) == 64
+
+@pytest.mark.benchmark(group='ingestion')
+def test_ingest(benchmark, police_api):
+    engine = IngestionEngine(concurrency=4, rate=1000, burst=1000, url=police_api.url)
+    batches = benchmark.pedantic(lambda: list(ingest(CITIES, engine, RECORDED_MONTHS[:1])), rounds=3)
+    assert [task[0] for task, state_row, rows in batches] == CITIES
+
+
+@pytest.fixture
+def interpreter(tmp_path):
+    """Runs code in a fresh interpreter in the repository, with its caches in tmp_path, returning its output"""
+    env = dict(os.environ, BACKGROUND_CACHE_DIR=str(tmp_path / 'background_cache'), CACHE_DIR=str(tmp_path / 'figure_cache'))
+    def run(code):
+        return subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, check=True, capture_output=True, text=True).stdout
+    return run
+
+@pytest.mark.benchmark(group='startup')
+def test_import(benchmark, interpreter, tmp_path):
+    modules = json.loads(benchmark.pedantic(interpreter, (IMPORT,), rounds=3))
+    # Nothing heavy is loaded and nothing is created before the app is
+    assert not {'pandas', 'plotly.express', 'mysql.connector', 'requests'} & set(modules)
+    assert not os.listdir(tmp_path)
+
+@pytest.mark.benchmark(group='startup')
+def test_first_request(benchmark, interpreter):
+    benchmark.pedantic(interpreter, (FIRST_REQUEST,), rounds=3)
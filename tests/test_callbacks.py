@@ -2,11 +2,15 @@ from contextvars import copy_context
 from dash._callback_context import context_value
 from dash._utils import AttributeDict
 
+import json
+
+from plotly.io.json import to_json_plotly
+
 import pandas as pd
 import numpy as np
 
 # Callback functions imported
-from ..app import update_dropdown
+from app import update_dropdown
 
 #def test_update_dropdown_callback():
 #	json_data = pd.read_csv("gb_latlon.csv", dtype=object).to_json(date_format='iso', orient='split')
@@ -19,3 +23,116 @@ from ..app import update_dropdown
 
 
 
+
+def test_update_dropdown_search():
+	output = update_dropdown('ches', ['London'])
+	assert output[0] == {"label": 'London', "value": 'London'}
+	assert [o['value'] for o in output[1:]] == ['Chester', 'Cheshunt', 'Manchester', 'Colchester', 'Rochester', 'Chichester', 'Godmanchester']
+
+def test_update_graph_1_served_from_figure_cache(monkeypatch):
+	from cachelib import SimpleCache
+	import app
+	calls = []
+	def get_count_graph(dropdown_input, months=None):
+		calls.append(list(dropdown_input))
+		return pd.DataFrame({'location': dropdown_input, 'total': [3, 1], 'fractional': [0.1, 0.2]})
+	monkeypatch.setattr(app, 'figure_cache', SimpleCache())
+	monkeypatch.setattr(app, 'get_count_graph', get_count_graph)
+	first = app.update_graph_1(['London', 'Bristol'], 'Total', '2023', '1', '2023', '3')
+	second = app.update_graph_1(['Bristol', 'London'], 'Total', '2023', '1', '2023', '3')
+	assert calls == [['London', 'Bristol']]
+	# A hit is the figure's plotly dictionary, encoded by Dash like the figure itself
+	assert json.loads(to_json_plotly(second)) == json.loads(first.to_json())
+	app.update_graph_1(['Bristol', 'London'], 'Fractional', '2023', '1', '2023', '3')
+	app.update_graph_1(['Bristol', 'London'], 'Total', '2023', '1', '2023', '4')
+	assert len(calls) == 3
+
+def test_update_category_request_from_map_point(monkeypatch):
+	from cachelib import SimpleCache
+	import app
+	monkeypatch.setattr(app, 'figure_cache', SimpleCache())
+	monkeypatch.setattr(app, 'get_category', lambda location, months=None: pd.DataFrame({'category': ['Burglary'], 'ratio': [100.0]}))
+	figure, location = app.update_category({'point': {'lat': 51.51, 'lon': -0.13}}, '2023', '1', '2023', '3', 'Bristol')
+	assert location == 'London'
+	assert figure.layout.meta == {'period': ['2023-01', '2023-03'], 'location': 'London'}
+	figure, location = app.update_category({'location': 'Leeds'}, '2023', '1', '2023', '3', 'Bristol')
+	assert location == 'Leeds'
+
+def test_update_graph_1_carries_both_stats(monkeypatch):
+	from cachelib import SimpleCache
+	import app
+	monkeypatch.setattr(app, 'figure_cache', SimpleCache())
+	monkeypatch.setattr(app, 'get_count_graph', lambda dropdown_input, months=None: pd.DataFrame({'location': ['London', 'Bristol'], 'total': [3, 1], 'fractional': [0.1, 0.2]}))
+	figure = app.update_graph_1(['London', 'Bristol'], 'Fractional', '2023', '1', '2023', '3')
+	assert list(figure.data[0].x) == [0.1, 0.2]
+	assert [list(c) for c in figure.data[0].customdata] == [[3, 0.1], [1, 0.2]]
+	assert figure.layout.meta == {'period': ['2023-01', '2023-03'], 'stat': 'fractional'}
+
+def test_update_graph_1_patches_added_and_removed_cities(monkeypatch):
+	from cachelib import SimpleCache
+	from dash import Patch
+	import app
+	calls = []
+	def get_count_graph(dropdown_input, months=None):
+		calls.append(list(dropdown_input))
+		return pd.DataFrame({'location': dropdown_input, 'total': [7], 'fractional': [0.7]})
+	monkeypatch.setattr(app, 'figure_cache', SimpleCache())
+	monkeypatch.setattr(app, 'get_count_graph', get_count_graph)
+	shown = {'period': ['2023-01', '2023-03'], 'stat': 'total', 'bars': ['Bristol', 'Leeds', 'London'], 'markers': ['London', 'Bristol', 'Leeds']}
+	patch = app.update_graph_1(['London', 'Bristol', 'York'], 'Total', '2023', '1', '2023', '3', {'missing': ['York'], 'shown': shown})
+	assert isinstance(patch, Patch)
+	assert calls == [['York']]
+	operations = patch.to_plotly_json()['operations']
+	assert [o['location'] for o in operations if o['operation'] == 'Delete'] == [['data', 0, 'x', 1], ['data', 0, 'y', 1], ['data', 0, 'customdata', 1]]
+	assert {tuple(o['location']): o['params']['value'] for o in operations if o['operation'] == 'Extend'} == {
+		('data', 0, 'x'): [7], ('data', 0, 'y'): ['York'], ('data', 0, 'customdata'): [[7, 0.7]]}
+	# A different period is drawn again
+	figure = app.update_graph_1(['York'], 'Total', '2023', '1', '2023', '4', {'missing': ['York'], 'shown': shown})
+	assert not isinstance(figure, Patch)
+
+def run_background(manager, fn, *args):
+	"""Runs a callback as Dash runs a background callback, in a process of its own, and returns its result"""
+	import time
+	import uuid
+	key = uuid.uuid4().hex
+	job = manager.call_job_fn(key, manager.make_job_fn(fn, False), list(args), {})
+	deadline = time.monotonic() + 60
+	while not manager.result_ready(key):
+		assert time.monotonic() < deadline
+		time.sleep(0.05)
+	return manager.get_result(key, job)
+
+def test_background_jobs_reuse_loaded_months(offline_app, police_api, monkeypatch, tmp_path):
+	import diskcache
+	from dash import DiskcacheManager
+	from aggregates import MonthlyAggregates
+	shared = diskcache.Cache(str(tmp_path))
+	class Database:
+		def monthly_categories(self, locations):
+			shared.incr('queries', default=0)
+			return [('London', '2023-01', 'drugs', 5)] if 'London' in locations else []
+	monkeypatch.setattr(offline_app, 'db', Database())
+	monkeypatch.setattr(offline_app, 'aggregates', MonthlyAggregates(shared=shared))
+	manager = DiskcacheManager(shared)
+	before = len(police_api.requests)
+	first = run_background(manager, offline_app.update_graph_1, ['London', 'Bristol'], 'Total', '2023', '1', '2023', '3')
+	# The database had London's January, every other month came from the API
+	assert len(police_api.requests) - before == 5
+	second = run_background(manager, offline_app.update_graph_1, ['Bristol', 'London'], 'Total', '2023', '1', '2023', '3')
+	assert len(police_api.requests) - before == 5
+	assert shared.get('queries') == 1
+	assert list(second.data[0].y) == list(first.data[0].y)
+
+def test_background_jobs_remember_unpublished_months(offline_app, police_api, monkeypatch, tmp_path):
+	import diskcache
+	from dash import DiskcacheManager
+	from aggregates import MonthlyAggregates
+	shared = diskcache.Cache(str(tmp_path))
+	monkeypatch.setattr(offline_app, 'aggregates', MonthlyAggregates(shared=shared))
+	manager = DiskcacheManager(shared)
+	before = len(police_api.requests)
+	# The recordings stop at 2023-03, so the API answers 2023-04 with a 404
+	run_background(manager, offline_app.update_graph_1, ['London'], 'Total', '2023', '3', '2023', '4')
+	assert sorted(r['date'] for r in police_api.requests[before:]) == ['2023-03', '2023-04']
+	run_background(manager, offline_app.update_graph_1, ['London'], 'Total', '2023', '4', '2023', '4')
+	assert len(police_api.requests) - before == 2
@@ -0,0 +1,47 @@
+from datastore import ParquetBackend
+
+def crime(id, category):
+    return {'id': id, 'persistent_id': None, 'category': category, 'lat': 51.5, 'lng': -0.1,
+            'street_id': 1, 'street_name': 'On or near High Street', 'location_type': 'Force', 'location_subtype': None}
+
+def test_parquet_backend_round_trip(tmp_path):
+    store = ParquetBackend(str(tmp_path))
+    store.write('London', '2023-01', [crime(1, 'burglary'), crime(2, 'drugs'), crime(3, 'burglary')], 'h1')
+    store.write('London', '2023-02', [crime(4, 'robbery')], 'h2')
+    store.write('Bristol', '2023-01', [crime(5, 'drugs'), crime(6, 'drugs')], 'h3')
+    store.write('Leeds', '2023-01', [], 'h4')
+    assert store.totals(['London', 'Bristol', 'Cardiff']) == {'London': 1, 'Bristol': 2}
+    assert store.categories('London') == {'robbery': 1}
+    assert sorted(store.monthly_categories(['London'])) == [('London', '2023-01', 'burglary', 2), ('London', '2023-01', 'drugs', 1), ('London', '2023-02', 'robbery', 1)]
+    assert store.load_state() == {('London', '2023-01'): 'h1', ('London', '2023-02'): 'h2', ('Bristol', '2023-01'): 'h3', ('Leeds', '2023-01'): 'h4'}
+
+def test_parquet_backend_rewrite_replaces_pair(tmp_path):
+    store = ParquetBackend(str(tmp_path))
+    store.write('London', '2023-01', [crime(1, 'burglary')], 'h1')
+    assert store.totals(['London']) == {'London': 1}
+    store.write('London', '2023-01', [crime(1, 'burglary'), crime(2, 'burglary')], 'h2')
+    assert store.totals(['London']) == {'London': 2}
+
+def test_parquet_backend_latest_month_without_crimes(tmp_path):
+    store = ParquetBackend(str(tmp_path))
+    store.write('London', '2023-01', [crime(1, 'burglary')], 'h1')
+    store.write('London', '2023-02', [], 'h2')
+    store.write('Milton Keynes', '2023-01', [crime(2, 'drugs')], 'h3')
+    # The latest month is reported as empty rather than replaced by an earlier one
+    assert store.totals(['London', 'Milton Keynes']) == {'London': 0, 'Milton Keynes': 1}
+    assert store.categories('London') == {}
+
+def test_corrupt_partition_is_a_backend_error(tmp_path):
+    import pytest
+    import datastore
+    store = ParquetBackend(str(tmp_path))
+    store.write('London', '2023-01', [crime(1, 'burglary')], 'h1')
+    with open(tmp_path / 'month=2023-01' / 'location=London' / 'crimes.parquet', 'wb') as f:
+        f.write(b'PAR1 not parquet')
+    with pytest.raises(datastore.BACKEND_ERRORS):
+        ParquetBackend(str(tmp_path)).totals(['London'])
+
+def test_parquet_backend_empty_root(tmp_path):
+    store = ParquetBackend(str(tmp_path / 'missing'))
+    assert store.totals(['London']) == {}
+    assert store.load_state() == {}
@@ -0,0 +1,220 @@
+import time
+
+from db_main import DELETES, INSERTS, SCHEMA, BulkWriter, IngestionEngine, category_rows, cleaned_rows, content_hash, crime_records, date_range, dropdown_rows, fetch_data, ingest
+from police_api import TokenBucket
+from tests.police_stub import PoliceStub
+
+def test_fetch_data_retries_429_and_5xx():
+    with PoliceStub(failures=[429, 503]) as stub:
+        data = fetch_data(51.5072, -0.1275, '2023-01', url=stub.url, backoff=0.01)
+    assert data == [{'category': 'burglary', 'id': 1, 'month': '2023-01'}]
+    assert len(stub.requests) == 3
+
+def test_fetch_data_404_returns_empty():
+    with PoliceStub(failures=[404]) as stub:
+        assert fetch_data(51.5072, -0.1275, '2023-01', url=stub.url) == ""
+
+def test_engine_bounded_concurrency_and_order():
+    with PoliceStub(latency=0.05) as stub:
+        engine = IngestionEngine(concurrency=3, rate=1000, burst=1000, url=stub.url)
+        results = list(engine.run(['London', 'Birmingham'], ['2023-01', '2023-02', '2023-03']))
+    assert [(task[0], task[4]) for task, data in results] == [(l, m) for l in ['London', 'Birmingham'] for m in ['2023-01', '2023-02', '2023-03']]
+    assert all(data[0]['month'] == task[4] for task, data in results)
+    assert len(stub.requests) == 6
+    assert stub.max_in_flight <= 3
+
+def test_engine_fetches_a_bounded_window_ahead():
+    with PoliceStub() as stub:
+        engine = IngestionEngine(concurrency=2, rate=1000, burst=1000, url=stub.url, window=3)
+        results = engine.run(['London', 'Birmingham'], ['2023-01', '2023-02', '2023-03', '2023-04'])
+        next(results)
+        time.sleep(0.2)
+        # The task yielded, the three submitted behind it and none beyond
+        assert len(stub.requests) == 4
+        assert len(list(results)) == 7
+    assert len(stub.requests) == 8
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=50, capacity=5)
+    start = time.monotonic()
+    for _ in range(15):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.18
+
+def test_token_bucket_shared_between_processes(tmp_path):
+    import diskcache
+    shared = diskcache.Cache(str(tmp_path))
+    buckets = [TokenBucket(rate=50, capacity=5, shared=shared) for _ in range(2)]
+    start = time.monotonic()
+    for i in range(15):
+        buckets[i % 2].acquire()
+    assert time.monotonic() - start >= 0.18
+
+def test_ingest_fetches_each_month_once_for_all_tables():
+    crimes = [{'category': 'burglary', 'id': 1}, {'category': 'burglary', 'id': 2}, {'category': 'drugs', 'id': 3}]
+    with PoliceStub(payload=lambda lat, lng, date: crimes) as stub:
+        engine = IngestionEngine(concurrency=2, rate=1000, burst=1000, url=stub.url)
+        batches = list(ingest(['London'], engine, months=['2023-01', '2023-02']))
+    assert len(stub.requests) == 2
+    assert len(batches) == 2
+    task, state_row, rows = batches[0]
+    assert state_row == ('London', '2023-01', 3, content_hash(crimes))
+    assert len(rows['cleaned_data']) == 3
+    assert [(r[2], r[3]) for r in rows['category_data']] == [('burglary', 2), ('drugs', 1)]
+    assert rows['dropdown_data'][0][:3] == ('London', '2023-01-01', 3)
+
+def test_stages_produce_typed_rows():
+    task = ('London', 51.5072, -0.1275, 11262000, '2023-01')
+    street = {'latitude': '51.513775', 'longitude': '-0.127430', 'street': {'id': 960753, 'name': 'On or near Shaftesbury Avenue'}}
+    data = [
+        {'category': 'burglary', 'id': 1001, 'persistent_id': 'ab' * 32, 'location': street, 'location_type': 'Force', 'location_subtype': ''},
+        {'category': 'drugs', 'id': 1002, 'persistent_id': '', 'location': street, 'location_type': 'Force', 'location_subtype': ''},
+        {'category': 'burglary', 'id': 1003, 'persistent_id': 'cd' * 32, 'location': street, 'location_type': 'BTP', 'location_subtype': 'STATION'},
+    ]
+    ids = {'burglary': 1, 'drugs': 2}
+    cleaned = cleaned_rows(task, data, ids.get)
+    assert [r[0] for r in cleaned] == [1001, 1002, 1003]
+    assert cleaned[0] == (1001, b'\xab' * 32, 'London', 1, '2023-01-01', '51.513775', '-0.127430', 960753, 'On or near Shaftesbury Avenue', 'Force', None)
+    assert cleaned[1][1] is None
+    assert cleaned[2][-2:] == ('BTP', 'STATION')
+    assert category_rows(task, data, ids.get) == [('London', '2023-01-01', 1, 2, 2/11262000), ('London', '2023-01-01', 2, 1, 1/11262000)]
+    assert dropdown_rows(task, data) == [('London', '2023-01-01', 3, 3/11262000, 51.5072, -0.1275)]
+    records = crime_records(task, data)
+    assert records[0] == {'id': 1001, 'persistent_id': 'ab' * 32, 'category': 'burglary', 'lat': 51.513775, 'lng': -0.12743,
+                          'street_id': 960753, 'street_name': 'On or near Shaftesbury Avenue', 'location_type': 'Force', 'location_subtype': None}
+    assert records[1]['persistent_id'] is None
+
+def test_ingest_resumes_from_state():
+    crimes = [{'category': 'burglary', 'id': 1}]
+    state = {('London', '2023-01'): content_hash(crimes)}
+    with PoliceStub(payload=lambda lat, lng, date: crimes, failures=[404]) as stub:
+        engine = IngestionEngine(concurrency=1, rate=1000, burst=1000, url=stub.url)
+        batches = list(ingest(['London'], engine, ['2023-01', '2023-02', '2023-03'], state))
+    assert [r['date'] for r in stub.requests] == ['2023-02', '2023-03']
+    assert [state_row[1] for task, state_row, rows in batches] == ['2023-03']
+
+def test_ingest_refresh_skips_unchanged_months():
+    crimes = [{'category': 'burglary', 'id': 1}]
+    state = {('London', '2023-01'): content_hash(crimes), ('London', '2023-02'): 'stale'}
+    with PoliceStub(payload=lambda lat, lng, date: crimes) as stub:
+        engine = IngestionEngine(concurrency=1, rate=1000, burst=1000, url=stub.url)
+        batches = list(ingest(['London'], engine, ['2023-01', '2023-02'], state, refresh=True))
+    assert len(stub.requests) == 2
+    assert [state_row[1] for task, state_row, rows in batches] == ['2023-02']
+
+def test_ingest_refresh_bypasses_recorded_responses(tmp_path):
+    from police_api import PoliceClient
+    from response_cache import ResponseCache
+    crimes = [{'category': 'burglary', 'id': 1}]
+    with PoliceStub(payload=lambda lat, lng, date: crimes) as stub:
+        engine = IngestionEngine(concurrency=1, url=stub.url, client=PoliceClient(cache=ResponseCache(str(tmp_path))))
+        state = {('London', '2023-01'): list(ingest(['London'], engine, ['2023-01']))[0][1][3]}
+        crimes = crimes + [{'category': 'drugs', 'id': 2}]
+        cache = ResponseCache(str(tmp_path), refresh=True)
+        engine = IngestionEngine(concurrency=1, url=stub.url, client=PoliceClient(cache=cache))
+        batches = list(ingest(['London'], engine, ['2023-01'], state, refresh=True))
+    assert len(stub.requests) == 2
+    assert [state_row[2] for task, state_row, rows in batches] == [2]
+    # The new response replaced the recorded one
+    assert cache.stats['stored'] == 1
+    offline = PoliceClient(cache=ResponseCache(str(tmp_path), offline=True))
+    assert fetch_data(51.5072, -0.1275, '2023-01', url=stub.url, client=offline) == crimes
+
+def test_engine_paces_only_requests_sent_to_the_api(tmp_path):
+    from police_api import PoliceClient
+    from response_cache import ResponseCache
+    months = ['2023-01', '2023-02', '2023-03']
+    with PoliceStub() as stub:
+        client = PoliceClient(cache=ResponseCache(str(tmp_path)), limiter=TokenBucket(rate=1000, capacity=1000))
+        list(IngestionEngine(concurrency=1, url=stub.url, client=client).run(['London'], months))
+        # One token every 100 seconds: only replayed responses can finish in time
+        client = PoliceClient(cache=ResponseCache(str(tmp_path)), limiter=TokenBucket(rate=0.01, capacity=1))
+        start = time.monotonic()
+        assert len(list(IngestionEngine(concurrency=1, url=stub.url, client=client).run(['London'], months))) == 3
+    assert time.monotonic() - start < 5
+    assert len(stub.requests) == 3
+
+def primary_key(table):
+    statement = next(s for s in SCHEMA if s.startswith('CREATE TABLE IF NOT EXISTS {} ('.format(table)))
+    return statement[statement.index('PRIMARY KEY (') + len('PRIMARY KEY ('):].split(')')[0].split(', ')
+
+def test_overlapping_cities_keep_their_own_crimes():
+    # London and Westminster are 1.5 km apart, so the API returns the same crimes for both
+    street = {'latitude': '51.5', 'longitude': '-0.13', 'street': {'id': 1, 'name': 'On or near Whitehall'}}
+    data = [{'category': 'burglary', 'id': 1001, 'location': street}, {'category': 'drugs', 'id': 1002, 'location': street}]
+    columns = INSERTS['cleaned_data'].split('(')[1].split(')')[0].split(', ')
+    key = [columns.index(column) for column in primary_key('cleaned_data')]
+    stored = {}
+    for city in ['London', 'Westminster']:
+        for row in cleaned_rows((city, 51.5, -0.13, 1, '2023-01'), data, {'burglary': 1, 'drugs': 2}.get):
+            stored[tuple(row[i] for i in key)] = row
+    assert sorted(row[2] for row in stored.values()) == ['London', 'London', 'Westminster', 'Westminster']
+    # Rewriting one city's month removes only rows keyed by that city
+    assert DELETES['cleaned_data'].split('WHERE ')[1] == 'location = %s AND month = %s'
+    assert primary_key('cleaned_data')[:2] == ['location', 'month']
+
+def test_date_range_within_one_year():
+    assert date_range('2024', '03', '2024', '05') == ['2024-03', '2024-04', '2024-05']
+
+class FakeConnection:
+    def __init__(self):
+        self.calls = []
+        self.commits = 0
+
+    def cursor(self):
+        return self
+
+    def executemany(self, statement, rows):
+        self.calls.append((statement, list(rows)))
+
+    def commit(self):
+        self.commits += 1
+
+    def close(self):
+        pass
+
+def test_bulk_writer_batches_and_commits():
+    cnx = FakeConnection()
+    writer = BulkWriter(cnx, {'a': 'INSERT a', 'b': 'INSERT b'}, batch_size=3, commit_every=2)
+    writer.add('a', [(i,) for i in range(7)])
+    assert [len(rows) for statement, rows in cnx.calls] == [3, 3, 1]
+    assert cnx.commits == 1
+    writer.add('b', [(0,)])
+    writer.close()
+    assert [(statement, len(rows)) for statement, rows in cnx.calls] == [('INSERT a', 3), ('INSERT a', 3), ('INSERT a', 1), ('INSERT b', 1)]
+    assert cnx.commits == 2
+    assert writer.throughput()['a'][0] == 7
+    assert writer.throughput()['b'][0] == 1
+
+def test_bulk_writer_records_state_after_data():
+    cnx = FakeConnection()
+    writer = BulkWriter(cnx, {'a': 'INSERT a'}, batch_size=10)
+    writer.add('a', [(0,), (1,)])
+    writer.complete(('London', '2023-01', 2, 'h'))
+    writer.close()
+    assert [statement.split()[0:3] for statement, rows in cnx.calls] == [['INSERT', 'a'], ['REPLACE', 'INTO', 'ingestion_state']]
+    assert cnx.calls[1][1] == [('London', '2023-01', 2, 'h')]
+
+def test_bulk_writer_replace_deletes_before_rewriting():
+    cnx = FakeConnection()
+    writer = BulkWriter(cnx, {'a': 'INSERT a'}, batch_size=10, deletes={'a': 'DELETE a'})
+    writer.replace('London', '2023-01')
+    writer.add('a', [(0,)])
+    writer.complete(('London', '2023-01', 1, 'h2'))
+    writer.close()
+    assert [statement.split()[0:3] for statement, rows in cnx.calls] == [
+        ['DELETE', 'FROM', 'ingestion_state'], ['DELETE', 'a'], ['INSERT', 'a'], ['REPLACE', 'INTO', 'ingestion_state']]
+    assert cnx.calls[1][1] == [('London', '2023-01-01')]
+    assert cnx.commits == 1
+
+def test_stub_replays_recordings(tmp_path):
+    import requests
+    from tests.police_stub import Recordings
+    recordings = Recordings(str(tmp_path))
+    recordings.save(51.5072, -0.1275, '2023-01', [{'category': 'burglary', 'id': 1}])
+    recordings.save(51.5072, -0.1275, '2023-02', [{'category': 'drugs', 'id': 2}])
+    with PoliceStub(payload=recordings) as stub:
+        assert fetch_data(51.5072, -0.1275, '2023-01', url=stub.url) == [{'category': 'burglary', 'id': 1}]
+        r = requests.post(stub.url, params={'lat': 51.5072, 'lng': -0.1275}, headers={'Accept-Encoding': 'identity'})
+        assert 'Content-Encoding' not in r.headers and r.json() == [{'category': 'drugs', 'id': 2}]
+        assert fetch_data(51.5072, -0.1275, '2023-03', url=stub.url) == ""
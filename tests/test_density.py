@@ -0,0 +1,27 @@
+import numpy as np
+
+from density import cell_centres, grid_cells, merge_cells
+
+def test_grid_cells_counts_points_per_cell():
+    lat = np.array([51.5001, 51.5002, 51.5041, -33.9])
+    lng = np.array([-0.1201, -0.1202, -0.1201, 151.2])
+    keys, counts = grid_cells(lat, lng, 0.003)
+    assert sorted(counts.tolist()) == [1, 1, 2]
+    assert list(keys) == sorted(keys)
+
+def test_cell_centres_lie_in_their_cells():
+    rng = np.random.default_rng(0)
+    lat, lng = rng.uniform(-60, 60, 1000), rng.uniform(-180, 180, 1000)
+    keys, counts = grid_cells(lat, lng, 0.5)
+    centre_lat, centre_lng = cell_centres(keys, 0.5)
+    again, _ = grid_cells(centre_lat, centre_lng, 0.5)
+    assert (again == keys).all()
+    assert counts.sum() == 1000
+
+def test_merge_cells_adds_counts():
+    first = grid_cells(np.array([51.5, 51.5, 52.0]), np.array([-0.12, -0.12, -1.9]), 0.003)
+    second = grid_cells(np.array([51.5, 53.4]), np.array([-0.12, -2.24]), 0.003)
+    keys, counts = merge_cells([first, None, second])
+    assert dict(zip(keys.tolist(), counts.tolist())) == {first[0][0]: 3, first[0][1]: 1, second[0][1]: 1}
+    keys, counts = merge_cells([None])
+    assert len(keys) == len(counts) == 0
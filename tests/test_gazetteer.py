@@ -0,0 +1,31 @@
+import numpy as np
+
+from gazetteer import Gazetteer
+from tests.conftest import GAZETTEER_CSV
+
+def test_lookup_uses_first_row_for_duplicate_names():
+    g = Gazetteer.from_csv(GAZETTEER_CSV)
+    assert g.lookup('London') == (51.5072, -0.1275, 11262000)
+    assert g.lookup('Wellington') == (52.7001, -2.5157, 25554)
+    assert 'Atlantis' not in g
+
+def test_lookup_many_keeps_order():
+    g = Gazetteer.from_csv(GAZETTEER_CSV)
+    lat, lng, p = g.lookup_many(['Birmingham', 'London'])
+    assert list(lat) == [52.48, 51.5072]
+    assert list(p) == [2919600, 11262000]
+
+def test_nearest_matches_brute_force():
+    g = Gazetteer.from_csv(GAZETTEER_CSV)
+    assert g.nearest(51.51, -0.13) == 'London'
+    rng = np.random.default_rng(0)
+    for lat, lng in zip(rng.uniform(49, 59, 200), rng.uniform(-8, 2, 200)):
+        d = (g.lat - lat) ** 2 + ((g.lng - lng) * np.cos(np.radians(lat))) ** 2
+        assert g.nearest(lat, lng) == g.cities[int(np.argmin(d))]
+    assert g.nearest(0, 0) == g.cities[int(np.argmin(g.lat ** 2 + g.lng ** 2))]
+
+def test_search_prefix_first_and_paginated():
+    g = Gazetteer.from_csv(GAZETTEER_CSV)
+    assert g.search('ches') == ['Chester', 'Cheshunt', 'Manchester', 'Colchester', 'Rochester', 'Chichester', 'Godmanchester']
+    assert g.search('CHES', limit=3, offset=2) == ['Manchester', 'Colchester', 'Rochester']
+    assert g.search('wellington') == ['Wellington']
@@ -0,0 +1,88 @@
+import time
+
+import pytest
+from dash.exceptions import PreventUpdate
+
+from metrics import Metrics, SamplingProfiler, cache_samples, request_samples
+from police_api import RequestTimings
+
+def test_callback_and_stage_histograms():
+    metrics = Metrics(buckets=(0.1, 1))
+    metrics.describe('dashboard_callback_seconds', 'histogram', 'Callback duration')
+
+    @metrics.callback('update_graph_1')
+    def update_graph_1(prevent=False):
+        with metrics.stage('fetch'):
+            pass
+        if prevent:
+            raise PreventUpdate
+        return 'figure'
+
+    assert update_graph_1() == 'figure'
+    with pytest.raises(PreventUpdate):
+        update_graph_1(prevent=True)
+    text = metrics.render()
+    assert '# TYPE dashboard_callback_seconds histogram' in text
+    assert 'dashboard_callback_seconds_bucket{callback="update_graph_1",outcome="ok",le="0.1"} 1.0' in text
+    assert 'dashboard_callback_seconds_count{callback="update_graph_1",outcome="prevented"} 1.0' in text
+    assert 'dashboard_stage_seconds_bucket{callback="update_graph_1",stage="fetch",le="+Inf"} 2.0' in text
+
+def test_sources_count_from_registration():
+    timings = RequestTimings(buckets=(0.1, 1))
+    timings.record(200, 0.05)
+    stats = {'hit': 3, 'miss': 1}
+    metrics = Metrics()
+    metrics.register(lambda: request_samples(timings))
+    metrics.register(lambda: cache_samples(dict(stats), 'summary'))
+    timings.record(200, 0.5)
+    timings.record('ReadTimeout', 5)
+    stats['hit'] += 2
+    values = metrics.snapshot()['values']
+    assert values[('police_api_requests_total', (('status', '200'),))] == 1
+    assert values[('police_api_requests_total', (('status', 'ReadTimeout'),))] == 1
+    assert values[('police_api_request_seconds_bucket', (('le', '0.1'),))] == 0
+    assert values[('police_api_request_seconds_bucket', (('le', '1.0'),))] == 1
+    assert values[('police_api_request_seconds_count', ())] == 2
+    assert values[('dashboard_cache_lookups_total', (('cache', 'summary'), ('result', 'hit')))] == 2
+    assert values[('dashboard_cache_lookups_total', (('cache', 'summary'), ('result', 'miss')))] == 0
+
+def test_processes_add_up_in_the_shared_store(tmp_path):
+    import diskcache
+    shared = diskcache.Cache(str(tmp_path))
+    first, second = Metrics(shared), Metrics(shared)
+    first.inc('dashboard_cache_lookups_total', cache='figure', result='hit')
+    first.flush()
+    second.inc('dashboard_cache_lookups_total', cache='figure', result='hit')
+    second.inc('dashboard_cache_lookups_total', cache='figure', result='miss')
+    assert second.snapshot()['values'] == {
+        ('dashboard_cache_lookups_total', (('cache', 'figure'), ('result', 'hit'))): 2,
+        ('dashboard_cache_lookups_total', (('cache', 'figure'), ('result', 'miss'))): 1,
+    }
+    # Flushing again adds nothing twice
+    first.flush()
+    assert first.snapshot() == second.snapshot()
+
+def test_profiler_samples_callbacks():
+    metrics = Metrics(profiler=SamplingProfiler(0.001))
+
+    @metrics.callback('update_map')
+    def update_map():
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+
+    update_map()
+    folded = metrics.folded()
+    assert 'update_map (test_metrics.py:' in folded
+    stack, count = folded.splitlines()[0].rsplit(' ', 1)
+    assert int(count) > 0
+
+def test_metrics_endpoint(monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'metrics', Metrics())
+    client = app.server.test_client()
+    assert client.get('/metrics/profile').status_code == 404
+    client.get('/metrics')
+    response = client.get('/metrics')
+    assert response.mimetype == 'text/plain'
+    assert 'dashboard_http_request_seconds_count{route="/metrics"} 1.0' in response.get_data(as_text=True)
@@ -0,0 +1,181 @@
+import threading
+import time
+
+from police_api import FetchCache
+
+def test_fetch_cache_coalesces_concurrent_callers():
+    calls = []
+    def fetch(lat, lng, month):
+        calls.append((lat, lng, month))
+        time.sleep(0.1)
+        return [{'category': 'burglary'}]
+    cache = FetchCache(fetch)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(51.5072, -0.1275))) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert len(results) == 10
+    assert all(r is results[0] for r in results)
+
+def test_fetch_cache_get_many_one_call_per_city():
+    calls = []
+    cache = FetchCache(lambda lat, lng, month: calls.append((lat, lng)) or [lat, lng])
+    coordinates = [(51.5072, -0.1275), (52.48, -1.9025), (51.5072, -0.1275)]
+    assert cache.get_many(coordinates) == [[51.5072, -0.1275], [52.48, -1.9025], [51.5072, -0.1275]]
+    cache.get_many(coordinates)
+    assert sorted(calls) == sorted([(51.5072, -0.1275), (52.48, -1.9025)])
+
+def test_fetch_cache_ttl_and_eviction():
+    calls = []
+    cache = FetchCache(lambda lat, lng, month: calls.append(month) or month, ttl=0.05, maxsize=2)
+    cache.get(1, 1, '2023-01')
+    cache.get(1, 1, '2023-02')
+    cache.get(1, 1, '2023-03')
+    assert len(cache) == 2
+    cache.get(1, 1, '2023-01')
+    assert calls == ['2023-01', '2023-02', '2023-03', '2023-01']
+    time.sleep(0.1)
+    cache.get(1, 1, '2023-01')
+    assert calls[-1] == '2023-01' and len(calls) == 5
+
+def test_fetch_cache_error_is_not_cached():
+    calls = []
+    def fetch(lat, lng, month):
+        calls.append(month)
+        if len(calls) == 1:
+            raise ConnectionError
+        return []
+    cache = FetchCache(fetch)
+    try:
+        cache.get(1, 1)
+    except ConnectionError:
+        pass
+    assert cache.get(1, 1) == []
+    assert len(calls) == 2
+
+def test_fetch_cache_get_all_reports_progress():
+    cache = FetchCache(lambda lat, lng, month: month)
+    reported = []
+    cache.get_all([(1, 1, '2023-01'), (1, 1, '2023-02'), (1, 1, '2023-03')], progress=lambda done, total: reported.append((done, total)))
+    assert reported == [(1, 3), (2, 3), (3, 3)]
+
+def test_fetch_cache_get_all_answers_cached_keys_without_fetching():
+    calls = []
+    cache = FetchCache(lambda lat, lng, month: calls.append(month) or month)
+    cache.get(1, 1, '2023-02')
+    reported = []
+    keys = [(1, 1, '2023-01'), (1, 1, '2023-02'), (1, 1, '2023-03')]
+    assert cache.get_all(keys, progress=lambda done, total: reported.append((done, total))) == ['2023-01', '2023-02', '2023-03']
+    assert calls == ['2023-02', '2023-01', '2023-03']
+    assert reported == [(1, 3), (2, 3), (3, 3)]
+
+def test_fetch_cache_shared_between_instances(tmp_path):
+    import diskcache
+    shared = diskcache.Cache(str(tmp_path))
+    calls = []
+    first = FetchCache(lambda lat, lng, month: calls.append(month) or [month], shared=shared)
+    second = FetchCache(lambda lat, lng, month: calls.append(month) or [month], shared=shared)
+    assert first.get(1, 1, '2023-01') == ['2023-01']
+    assert second.get(1, 1, '2023-01') == ['2023-01']
+    assert calls == ['2023-01']
+    # A lock left behind by a process that no longer exists is taken over
+    shared.add('lock:fetch:1:1:2023-02', 2 ** 22 + 1)
+    assert second.get(1, 1, '2023-02') == ['2023-02']
+    assert 'lock:fetch:1:1:2023-02' not in shared
+
+def test_summarise_crimes_streams_counts_and_coordinates():
+    import io
+    import json
+    from police_api import summarise_crimes
+    crimes = [
+        {'category': 'burglary', 'location': {'latitude': '51.5', 'street': {'id': 1, 'name': 'On or near High Street'}, 'longitude': '-0.12'}, 'outcome_status': None},
+        {'category': 'drugs', 'location': {'latitude': '51.6', 'street': {'id': 2, 'name': 'On or near Park Road'}, 'longitude': '-0.13'}, 'outcome_status': {'category': 'Under investigation'}},
+        {'category': 'burglary', 'location': {'latitude': '51.7', 'street': {'id': 3, 'name': 'On or near Mill Lane'}, 'longitude': '-0.14'}, 'outcome_status': None},
+    ]
+    summary = summarise_crimes(io.BytesIO(json.dumps(crimes).encode()), coordinates=True)
+    assert len(summary) == 3
+    assert summary.categories == {'burglary': 2, 'drugs': 1}
+    assert list(summary.lat) == [51.5, 51.6, 51.7]
+    assert list(summary.lng) == [-0.12, -0.13, -0.14]
+    summary = summarise_crimes(io.BytesIO(b'[]'))
+    assert len(summary) == 0 and summary.categories == {} and summary.lat is None
+
+def test_police_client_reuses_connections_and_records_timings():
+    from police_api import PoliceClient
+    from tests.police_stub import PoliceStub
+    client = PoliceClient(pool_size=2)
+    with PoliceStub(failures=[404]) as stub:
+        for _ in range(3):
+            client.post(stub.url, params={'lat': 1, 'lng': 1}).close()
+    assert len(stub.connections) == 1
+    timings = client.timings.snapshot()
+    assert timings['statuses'] == {'404': 1, '200': 2}
+    assert sum(timings['histogram']) == 3
+
+def test_police_client_read_timeout():
+    import pytest
+    import requests
+    from police_api import PoliceClient
+    from tests.police_stub import PoliceStub
+    client = PoliceClient(read_timeout=0.05)
+    with PoliceStub(latency=0.5) as stub:
+        with pytest.raises(requests.Timeout):
+            client.post(stub.url, params={'lat': 1, 'lng': 1})
+    assert client.timings.snapshot()['statuses'] == {'ReadTimeout': 1}
+
+def test_response_cache_records_and_replays_past_months(tmp_path):
+    from police_api import PoliceClient, summarise_crimes
+    from response_cache import ResponseCache
+    from tests.police_stub import PoliceStub
+    client = PoliceClient(cache=ResponseCache(str(tmp_path)))
+    with PoliceStub() as stub:
+        first = client.post(stub.url, params={'lat': 1, 'lng': 1, 'date': '2023-01'}).json()
+        replayed = client.post(stub.url, params={'lat': 1, 'lng': 1, 'date': '2023-01'})
+        with client.post(stub.url, params={'lat': 1, 'lng': 1, 'date': '2023-01'}, stream=True) as streamed:
+            summary = summarise_crimes(streamed.raw)
+        # The latest month may still change, so it is never recorded
+        client.post(stub.url, params={'lat': 1, 'lng': 1}).json()
+        client.post(stub.url, params={'lat': 1, 'lng': 1}).json()
+    assert first == replayed.json() == [{'category': 'burglary', 'id': 1, 'month': '2023-01'}]
+    assert summary.categories == {'burglary': 1}
+    assert len(stub.requests) == 3
+    assert client.cache.stats == {'hit': 2, 'miss': 1, 'stored': 1, 'evicted': 0}
+    assert client.timings.snapshot()['statuses'] == {'200': 3}
+
+def test_response_cache_stores_identical_bodies_once_and_evicts(tmp_path):
+    import gzip
+    import os
+    from response_cache import ResponseCache
+    cache = ResponseCache(str(tmp_path), max_bytes=30)
+    cache.put(('url', 1.0, 1.0, '2023-01'), gzip.compress(b'[]'), compressed=True)
+    cache.put(('url', 2.0, 2.0, '2023-01'), b'[]')
+    assert len(os.listdir(tmp_path / 'objects')) == 1
+    assert gzip.decompress(cache.get(('url', 2.0, 2.0, '2023-01'))) == b'[]'
+    cache.put(('url', 3.0, 3.0, '2023-01'), b'[1]')
+    # The least recently used body went to make room, taking both keys naming it
+    assert cache.stats['evicted'] == 1
+    assert cache.get(('url', 1.0, 1.0, '2023-01')) is None
+    assert cache.get(('url', 2.0, 2.0, '2023-01')) is None
+    assert gzip.decompress(cache.get(('url', 3.0, 3.0, '2023-01'))) == b'[1]'
+
+def test_response_cache_offline(tmp_path):
+    import pytest
+    from db_main import fetch_data
+    from police_api import NotCached, PoliceClient, ResponseCache
+    from tests.police_stub import PoliceStub
+    with PoliceStub() as stub:
+        fetch_data(1, 1, '2023-01', url=stub.url, client=PoliceClient(cache=ResponseCache(str(tmp_path))))
+        offline = PoliceClient(cache=ResponseCache(str(tmp_path), offline=True))
+        assert fetch_data(1, 1, '2023-01', url=stub.url, client=offline) == [{'category': 'burglary', 'id': 1, 'month': '2023-01'}]
+        # A month never fetched is skipped, and left for a run with network access
+        assert fetch_data(1, 1, '2023-02', url=stub.url, client=offline) == ""
+        with pytest.raises(NotCached):
+            offline.post(stub.url, params={'lat': 1, 'lng': 1, 'date': '2023-02'})
+        # The latest month is never recorded, so it is not sent to the network either
+        assert fetch_data(1, 1, None, url=stub.url, client=offline) == ""
+        with pytest.raises(NotCached):
+            offline.post(stub.url, params={'lat': 1, 'lng': 1})
+    assert len(stub.requests) == 1
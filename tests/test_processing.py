@@ -6,26 +6,98 @@ import pandas as pd
 import numpy as np
 
 # Callback functions imported
-from ..app import date_range, get_count_graph, get_category, get_count_map
+from app import date_range, get_count_graph, get_category, get_count_map
 
 def test_date_range():
     output = date_range(2020, 1, 2023, 12)
     assert output == ['2020-01', '2020-02', '2020-03', '2020-04', '2020-05', '2020-06', '2020-07', '2020-08', '2020-09', '2020-10', '2020-11', '2020-12', '2021-01', '2021-02', '2021-03', '2021-04', '2021-05', '2021-06', '2021-07', '2021-08', '2021-09', '2021-10', '2021-11', '2021-12', '2022-01', '2022-02', '2022-03', '2022-04', '2022-05', '2022-06', '2022-07', '2022-08', '2022-09', '2022-10', '2022-11', '2022-12', '2023-01', '2023-02', '2023-03', '2023-04', '2023-05', '2023-06', '2023-07', '2023-08', '2023-09', '2023-10', '2023-11', '2023-12']
     
-def test_get_count_graph():
+def test_get_count_graph(offline_app):
     output = get_count_graph(['London', 'Birmingham', 'Manchester', 'Liverpool', 'Portsmouth', 'Southampton', 'Nottingham', 'Bristol', 'Leicester', 'Coventry'])
     l = ['London', 'Birmingham', 'Manchester', 'Liverpool', 'Portsmouth', 'Southampton', 'Nottingham', 'Bristol', 'Leicester', 'Coventry']
     t = [6729, 1952, 92, 1253, 1190, 978, 1534, 1442, 1417, 1024]
-    f = [0.059, 0.066, 0.003, 0.145, 0.139, 0.114, 0.199, 0.254, 0.278, 0.282]
+    f = [0.06, 0.067, 0.003, 0.145, 0.139, 0.114, 0.2, 0.254, 0.278, 0.282]
     df = pd.DataFrame({'location': l, 'total': t, 'fractional': f})
-    assert (output == df).all
+    assert (output == df).all().all()
     
-def test_get_category():
+def test_get_category(offline_app):
     output = get_category('London')
     c = ['Other theft', 'Theft from the person', 'Violent crime', 'Anti social behaviour', 'Shoplifting', 'Robbery', 'Vehicle crime', 'Public order', 'Drugs', 'Criminal damage arson', 'Burglary', 'Bicycle theft', 'Possession of weapons', 'Other crime']
-    ct = [30.0, 26.0, 9.4, 9.3, 5.6, 4.6, 3.2, 2.8, 2.3, 1.6, 1.4, 1.3, 0.4, 0.2]
+    ct = [30.6, 26.5, 9.6, 9.5, 5.7, 4.7, 3.3, 2.9, 2.3, 1.6, 1.4, 1.3, 0.4, 0.2]
     print(output)
     df = pd.DataFrame({'category': c, 'ratio': ct})
     print(df)
-    assert (output == df).all
+    assert (output == df).all().all()
 
+
+class FakeBackend:
+    def totals(self, locations):
+        return {'London': 1000}
+
+    def categories(self, location):
+        return {'burglary': 3, 'anti-social-behaviour': 1}
+
+def test_get_count_graph_reads_db_and_falls_back_to_api(monkeypatch):
+    import app
+    from police_api import CrimeSummary, FetchCache
+    calls = []
+    monkeypatch.setattr(app, 'db', FakeBackend())
+    monkeypatch.setattr(app, 'fetch_cache', FetchCache(lambda lat, lng, month: calls.append((lat, lng)) or CrimeSummary(500, {'drugs': 500})))
+    output = get_count_graph(['London', 'Birmingham'])
+    assert list(output['total']) == [1000, 500]
+    assert calls == [(52.48, -1.9025)]
+
+def test_get_category_reads_db(monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'db', FakeBackend())
+    output = get_category('London')
+    assert list(output['category']) == ['Burglary', 'Anti social behaviour']
+    assert list(output['ratio']) == [75.0, 25.0]
+
+def test_get_count_graph_date_range_fetches_each_month_once(monkeypatch):
+    import app
+    from aggregates import MonthlyAggregates
+    from police_api import CrimeSummary, FetchCache
+    calls = []
+    monkeypatch.setattr(app, 'db', None)
+    monkeypatch.setattr(app, 'aggregates', MonthlyAggregates())
+    monkeypatch.setattr(app, 'fetch_cache', FetchCache(lambda lat, lng, month: calls.append(month) or CrimeSummary.from_crimes([{'category': 'drugs'}] * int(month[-2:]))))
+    output = get_count_graph(['London'], date_range(2023, 1, 2023, 3))
+    assert list(output['total']) == [6]
+    output = get_count_graph(['London'], date_range(2023, 2, 2023, 3))
+    assert list(output['total']) == [5]
+    assert sorted(calls) == ['2023-01', '2023-02', '2023-03']
+
+def test_unpublished_months_are_not_fetched_again(monkeypatch):
+    import app
+    from aggregates import MonthlyAggregates
+    from police_api import CrimeSummary, FetchCache
+    calls = []
+    monkeypatch.setattr(app, 'db', None)
+    monkeypatch.setattr(app, 'aggregates', MonthlyAggregates())
+    monkeypatch.setattr(app, 'fetch_cache', FetchCache(lambda lat, lng, month: calls.append(month) or (CrimeSummary.from_crimes([{'category': 'drugs'}]) if month < '2023-03' else None)))
+    assert list(get_count_graph(['London'], date_range(2023, 1, 2023, 3))['total']) == [2]
+    # Expired entries do not bring back the month the API had not published
+    app.fetch_cache.clear()
+    assert list(get_count_graph(['London'], date_range(2023, 1, 2023, 3))['total']) == [2]
+    assert sorted(calls) == ['2023-01', '2023-02', '2023-03']
+
+def test_fetch_summary_retries_429(monkeypatch):
+    import app
+    from tests.police_stub import PoliceStub
+    with PoliceStub(failures=[429]) as stub:
+        monkeypatch.setattr(app, 'API_URL', stub.url)
+        summary = app.fetch_summary(51.5072, -0.1275, '2023-01')
+    assert summary.categories == {'burglary': 1}
+    assert len(stub.requests) == 2
+
+def test_get_density_bins_every_crime(offline_app):
+    from density import GRID_RESOLUTION
+    df = offline_app.get_density(['London', 'Birmingham'])
+    assert df['crimes'].sum() == 6729 + 1952
+    assert len(df) < 6729 + 1952
+    lat, lng, p = offline_app.get_gazetteer().lookup('London')
+    # The stub scatters crimes within about 5km of each city
+    near = (abs(df['lat'] - lat) < 0.06) & (abs(df['lng'] - lng) < 0.1)
+    assert df.loc[near, 'crimes'].sum() == 6729
+    assert (np.round(df['lat'] / GRID_RESOLUTION - 0.5, 6) % 1 == 0).all()
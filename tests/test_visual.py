@@ -2,5 +2,5 @@ import dash
 
 from dash import html
 
-from ..app import app
+import app
 